@@ -0,0 +1,49 @@
+import queue
+import threading
+
+"""
+Background worker thread.
+        The shared base of logger.AsyncWriter and checkpointing.CheckpointWriter: the
+        training loop queues function calls which a daemon thread runs in order. An
+        exception raised in the thread is kept and re-raised in the training loop by
+        the next queued call or when the worker is closed.
+"""
+
+
+class BackgroundWorker(object):
+    def __init__(self, max_queue):
+        """
+        Args:
+            max_queue: The number of queued calls, _put blocks when the thread falls behind.
+        """
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+
+    def _raise_error(self):
+        """Re-raise the last exception of the thread, once."""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _put(self, fn, *args):
+        """Queue fn(*args) for the thread."""
+        self._raise_error()
+        self.queue.put((fn, args))
+
+    def _join(self):
+        """Run the queued calls and stop the thread, the error is left to _raise_error."""
+        self.queue.put(None)
+        self.thread.join()
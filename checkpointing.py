@@ -0,0 +1,120 @@
+import os
+from collections import deque
+import torch
+from background import BackgroundWorker
+
+"""
+Background checkpoint writer.
+        save() snapshots the model, optimizer and scheduler state to CPU memory and
+        returns, a background thread writes the snapshot to a temporary file and renames
+        it into place, so that a checkpoint file is either complete or absent. The best
+        checkpoint is a hard link to (or, where hard links are not supported, a symlink
+        of) the checkpoint file instead of a second copy. With keep_last, only the last
+        keep_last checkpoints and the best one are kept.
+"""
+
+
+def _to_cpu(state):
+    """Copy of a (nested) state dict with its tensors copied to the CPU."""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, _to_cpu(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+
+class CheckpointWriter(BackgroundWorker):
+    def __init__(self, path, keep_last=None, filename='checkpoint.pth.tar', max_pending=2):
+        """
+        Args:
+            path: The folder of the checkpoints.
+            keep_last: The number of checkpoints kept besides the best one, None to keep all.
+            filename: The checkpoint files are named <epoch>[_<iteration>]_<filename>.
+            max_pending: The number of snapshots held in memory, save() blocks when the writer falls behind.
+        """
+        if keep_last is not None and keep_last < 1:
+            raise Exception('keep_last must be at least 1, got {}'.format(keep_last))
+        self.path = path
+        self.keep_last = keep_last
+        self.filename = filename
+        self.written = deque()
+        self.best = None
+        self.last = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+        super(CheckpointWriter, self).__init__(max_pending)
+
+    def name(self, epoch, iteration=None):
+        prefix = str(epoch) if iteration is None else '{}_{}'.format(epoch, iteration)
+        return os.path.join(self.path, prefix + '_' + self.filename)
+
+    def save(self, model, optimizer, scheduler, epoch, is_best=False, iteration=None, extra=None):
+        """Snapshot the states and queue them for writing.
+
+        Args:
+            epoch: The epoch of the checkpoint.
+            is_best: Also link the checkpoint as <epoch>_model_best.pth.tar.
+            iteration: Given for checkpoints saved within an epoch, part of the file name.
+            extra: Additional entries of the checkpoint dict.
+        """
+        name = self.name(epoch, iteration)
+        best = os.path.join(self.path, str(epoch) + '_model_best.pth.tar') if is_best else None
+        if name == self.last:
+            # the same checkpoint again, e.g. the periodic save of the epoch of a new best model
+            self._put(self._write, None, name, best)
+            return
+        self.last = name
+        state = {
+            'epoch': epoch,
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scheduler_state_dict': scheduler.state_dict(),
+        }
+        if iteration is not None:
+            state['iteration'] = iteration
+        state.update(extra or {})
+        self._put(self._write, _to_cpu(state), name, best)
+
+    def _write(self, state, name, best):
+        if state is not None:
+            tmp = name + '.tmp'
+            torch.save(state, tmp)
+            os.replace(tmp, name)
+            if name in self.written:
+                self.written.remove(name)
+            self.written.append(name)
+        if best is not None:
+            self._link_best(name, best)
+        self._prune()
+
+    def _link_best(self, name, best):
+        tmp = best + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(name, tmp)
+        except OSError:
+            os.symlink(os.path.basename(name), tmp)
+        os.replace(tmp, best)
+        # only the latest best checkpoint is kept when the checkpoints are pruned
+        if self.keep_last is not None and self.best is not None and self.best[1] != best and os.path.lexists(self.best[1]):
+            os.remove(self.best[1])
+        self.best = (name, best)
+
+    def _prune(self):
+        if self.keep_last is None:
+            return
+        # a hard link keeps the data of the best checkpoint, a symlink needs its target
+        protected = self.best[0] if self.best is not None and os.path.islink(self.best[1]) else None
+        removable = [name for name in self.written if name != protected]
+        for name in removable[:max(len(removable) - self.keep_last, 0)]:
+            self.written.remove(name)
+            if os.path.exists(name):
+                os.remove(name)
+
+    def close(self):
+        """Write the queued checkpoints and stop the thread."""
+        self._join()
+        self._raise_error()
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import scipy.io
 import random
+from torch.utils.data import get_worker_info
 
 
 def pdist(vectors):
@@ -63,6 +64,58 @@ def random_select_positive_matches(matches_in_1, matches_in_2, num_of_pairs=1024
     # return matches_in_1_random_selected, matches_in_2_random_selected
     return {'a': matches_in_1_random_selected[None, ...], 'b':matches_in_2_random_selected[None, ...]}
 
+def seeded_generator(*keys):
+    """A torch generator seeded from integer keys (e.g. seed, epoch, index), the same for the same keys."""
+    generator = torch.Generator()
+    generator.manual_seed(hash(keys) & (2 ** 63 - 1))
+    return generator
+
+
+def item_generator(seed, epoch, index):
+    """The generator of the sampled matches of a map-style dataset item.
+
+    Without DataLoader workers, the items are loaded by the prefetch thread of the training
+    process, which must not draw from the global torch RNG of the training loop. The matches
+    then follow from the seed, the epoch and the index. DataLoader workers have their own
+    torch RNG and return None, so that sample_fixed_matches draws from it.
+    """
+    if get_worker_info() is not None:
+        return None
+    return seeded_generator(seed, epoch, index)
+
+
+def sample_fixed_matches(matches_in_1, matches_in_2, num_of_pairs=1024, generator=None):
+    """Sample a fixed number of positive matches of one image pair, used by the dataset workers.
+
+    Matches are drawn without replacement. Pairs with fewer than num_of_pairs matches
+    keep all of them, the remaining rows are zero and marked invalid in the mask.
+    Args:
+        generator: The torch generator to draw from, the global torch RNG if None.
+    Returns:
+        {'a': num_of_pairs x 2, 'b': num_of_pairs x 2} float32 tensors and a num_of_pairs bool 'mask'.
+    """
+    n = matches_in_1.shape[0]
+    rand_idx = torch.randperm(n, generator=generator)[:num_of_pairs]
+    num_valid = rand_idx.shape[0]
+    sampled = {
+        'a': torch.zeros((num_of_pairs, 2), dtype=torch.float32),
+        'b': torch.zeros((num_of_pairs, 2), dtype=torch.float32),
+        'mask': torch.zeros(num_of_pairs, dtype=torch.bool)
+    }
+    sampled['a'][:num_valid] = torch.as_tensor(np.asarray(matches_in_1)[rand_idx.numpy()], dtype=torch.float32)
+    sampled['b'][:num_valid] = torch.as_tensor(np.asarray(matches_in_2)[rand_idx.numpy()], dtype=torch.float32)
+    sampled['mask'][:num_valid] = True
+    return sampled
+
+
+def collate_pairs(batch):
+    """Stack the image pairs and the fixed-size matches from sample_fixed_matches into a batch."""
+    imgs, corres = zip(*batch)
+    img_a = torch.stack([img[0] for img in imgs])
+    img_b = torch.stack([img[1] for img in imgs])
+    return (img_a, img_b), {key: torch.stack([c[key] for c in corres]) for key in corres[0]}
+
+
 def random_select_negative_matches_whole_image(matches_in_1, matches_in_2, h=768, w=1024, num_of_pairs=1024):
     if matches_in_1.shape[0] < num_of_pairs/2:
         # for each image, choose half of the points
@@ -0,0 +1,222 @@
+import os
+import numpy as np
+import torch
+import h5py  # for loading v7.3 .mat
+from fnmatch import fnmatch
+from multiprocessing import Pool
+
+"""
+Packed correspondence store.
+        All positive correspondences of a dataset are packed once into a single flat
+        float32 file, so that datasets open it with a memory map instead of reading
+        every correspondence/*.mat file at start up.
+
+        Layout of a store folder:
+            points.bin: float32 rows (x, y). The matches of pair i are stored as
+                        pt_i followed by pt_j, i.e. rows [2*offsets[i], 2*offsets[i+1]).
+            offsets.npy: (N+1) int64 cumulative number of matches per pair.
+            pairs.npy: N x 3 int64 ids into the string table (pair file, image a, image b).
+            strings.bin: utf-8 blob of the string table.
+            string_offsets.npy: (S+1) int64 offsets of each string in strings.bin.
+"""
+
+
+def decode_mat_string(data):
+    # MATLAB chars are stored as one uint16 code per element
+    return ''.join(map(chr, np.asarray(data).ravel()))
+
+
+def read_pair_header(pair_file):
+    """Read the image paths and the number of matches without loading the matches."""
+    with h5py.File(pair_file, 'r') as pair_info:
+        org_name_a = decode_mat_string(pair_info['im_i_path'])
+        org_name_b = decode_mat_string(pair_info['im_j_path'])
+        num_matches = int(np.prod(pair_info['pt_i'].shape)) // 2
+    return org_name_a, org_name_b, num_matches
+
+
+def read_pair_file(pair_file):
+    """Read one correspondence file.
+
+    Returns:
+        The original image paths (im_i_path, im_j_path) and the positive
+        matches (pt_i, pt_j) as N x 2 float32 arrays.
+    """
+    with h5py.File(pair_file, 'r') as pair_info:
+        org_name_a = decode_mat_string(pair_info['im_i_path'])
+        org_name_b = decode_mat_string(pair_info['im_j_path'])
+        pt_i = np.asarray(pair_info['pt_i'], dtype=np.float32).reshape(-1, 2)
+        pt_j = np.asarray(pair_info['pt_j'], dtype=np.float32).reshape(-1, 2)
+    return org_name_a, org_name_b, pt_i, pt_j
+
+
+class _StringTable(object):
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def id(self, s):
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+    def encode(self):
+        """The string_offsets array and the utf-8 blob."""
+        encoded = [s.encode('utf-8') for s in self.strings]
+        return np.cumsum([0] + [len(s) for s in encoded], dtype=np.int64), b''.join(encoded)
+
+
+def _pack(pair_files, points, num_workers=0):
+    """Write the matches of all pair files to the binary stream points.
+
+    Returns:
+        The offsets, pairs, string_offsets arrays and the encoded string table.
+    """
+    table = _StringTable()
+    offsets = [0]
+    pairs = []
+    pool = Pool(num_workers) if num_workers > 0 else None
+    records = pool.imap(read_pair_file, pair_files, chunksize=16) if pool else map(read_pair_file, pair_files)
+    for f, (org_name_a, org_name_b, pt_i, pt_j) in zip(pair_files, records):
+        assert len(pt_i) == len(pt_j), 'pt_i and pt_j differ in length in {}'.format(f)
+        points.write(pt_i.tobytes())
+        points.write(pt_j.tobytes())
+        offsets.append(offsets[-1] + len(pt_i))
+        pairs.append((table.id(os.path.basename(f)), table.id(org_name_a), table.id(org_name_b)))
+    if pool:
+        pool.close()
+        pool.join()
+
+    string_offsets, strings = table.encode()
+    return (np.asarray(offsets, dtype=np.int64), np.asarray(pairs, dtype=np.int64).reshape(-1, 3),
+            string_offsets, strings)
+
+
+def pack_correspondences(pair_files, store_dir, num_workers=0):
+    """Pack the given correspondence files into a store folder."""
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, 'points.bin'), 'wb') as points:
+        offsets, pairs, string_offsets, strings = _pack(pair_files, points, num_workers)
+    with open(os.path.join(store_dir, 'strings.bin'), 'wb') as f:
+        f.write(strings)
+    np.save(os.path.join(store_dir, 'string_offsets.npy'), string_offsets)
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(store_dir, 'pairs.npy'), pairs)
+    print('>> Packed {} image pairs ({} matches) into {}'.format(len(pairs), offsets[-1], store_dir))
+
+
+class CorrespondenceStore(object):
+    """Read-only view on packed correspondences.
+
+    Memory-maps the points of a store folder, or those packed next to a dataset
+    manifest (see from_manifest), and holds the small index arrays in shared memory.
+    There are no per-pair Python objects, so forked DataLoader workers do not copy
+    the store through refcount updates, spawned workers receive handles to the
+    shared memory instead of copies, and all workers share the mapped points through
+    the page cache. Slicing a pair returns views without copying.
+    """
+    def __init__(self, store_dir: str = None):
+        self.store_dir = store_dir
+        self._shared = None
+        self._points = None
+        self._strings = None
+        self._points_path = None
+        self._pair_root = None
+        self.rows = None
+        if store_dir is not None:
+            self._points_path = os.path.join(store_dir, 'points.bin')
+            self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+            self.pairs = np.load(os.path.join(store_dir, 'pairs.npy'))
+            self.string_offsets = np.load(os.path.join(store_dir, 'string_offsets.npy'))
+
+    @classmethod
+    def from_manifest(cls, manifest, names):
+        """Store of the pair files names of a dataset manifest, without reading them.
+
+        The names, match counts and rows of the matches in the points file are taken from
+        the manifest. The few pairs the manifest could not pack (see Manifest.refresh) are
+        read from their .mat file by matches().
+        """
+        table = _StringTable()
+        pairs = [(table.id(name), table.id(manifest[name]['im_i_path']), table.id(manifest[name]['im_j_path']))
+                 for name in names]
+        string_offsets, strings = table.encode()
+        store = cls()
+        store._points_path = manifest.points_path
+        store._pair_root = manifest.pair_file_root
+        store._share({
+            'strings': np.frombuffer(strings, dtype=np.uint8),
+            'offsets': np.cumsum([0] + [manifest[name]['num_matches'] for name in names], dtype=np.int64),
+            'rows': np.asarray([manifest[name].get('row', -1) for name in names], dtype=np.int64),
+            'pairs': np.asarray(pairs, dtype=np.int64).reshape(-1, 3),
+            'string_offsets': string_offsets
+        })
+        return store
+
+    def _share(self, arrays):
+        # torch reduces shared memory tensors to handles when the dataset is sent to a worker
+        self._shared = {key: torch.from_numpy(np.array(arr)).share_memory_() for key, arr in arrays.items()}
+        self._views_from_shared()
+
+    def _views_from_shared(self):
+        self._strings = self._shared['strings'].numpy()
+        self.offsets = self._shared['offsets'].numpy()
+        self.rows = self._shared['rows'].numpy()
+        self.pairs = self._shared['pairs'].numpy()
+        self.string_offsets = self._shared['string_offsets'].numpy()
+
+    def _open(self):
+        if self._points is None:
+            num_rows = os.path.getsize(self._points_path) // 8 if os.path.exists(self._points_path) else 0
+            # copy-on-write mapping: the file is never modified, but the views are writable for torch.as_tensor
+            self._points = np.memmap(self._points_path, dtype=np.float32,
+                                     mode='c', shape=(num_rows, 2)) if num_rows else np.zeros((0, 2), np.float32)
+        if self._strings is None:
+            self._strings = np.fromfile(os.path.join(self.store_dir, 'strings.bin'), dtype=np.uint8)
+
+    def __getstate__(self):
+        if self._shared is not None:
+            return {'store_dir': None, '_shared': self._shared, '_points': None,
+                    '_points_path': self._points_path, '_pair_root': self._pair_root}
+        # never pickle the mapped data, workers re-open the files lazily
+        state = self.__dict__.copy()
+        state['_points'] = None
+        state['_strings'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared is not None:
+            self._views_from_shared()
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def string(self, string_id):
+        if self._strings is None:
+            self._open()
+        start, end = self.string_offsets[string_id], self.string_offsets[string_id + 1]
+        return self._strings[start:end].tobytes().decode('utf-8')
+
+    def pair_file(self, idx):
+        return self.string(self.pairs[idx, 0])
+
+    def image_names(self, idx):
+        """The original (im_i_path, im_j_path) stored in the .mat file of pair idx."""
+        return self.string(self.pairs[idx, 1]), self.string(self.pairs[idx, 2])
+
+    def matches(self, idx):
+        """Zero-copy N x 2 views of pt_i and pt_j of pair idx."""
+        start = 2 * self.offsets[idx] if self.rows is None else self.rows[idx]
+        if start < 0:
+            _, _, pt_i, pt_j = read_pair_file(os.path.join(self._pair_root, self.pair_file(idx)))
+            return pt_i, pt_j
+        if self._points is None:
+            self._open()
+        num_matches = self.offsets[idx + 1] - self.offsets[idx]
+        return self._points[start:start + num_matches], self._points[start + num_matches:start + 2 * num_matches]
+
+    def select(self, pattern):
+        """Indices of the pairs whose correspondence file name matches the glob pattern."""
+        return np.asarray([i for i in range(len(self)) if fnmatch(self.pair_file(i), pattern)], dtype=np.int64)
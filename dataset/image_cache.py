@@ -0,0 +1,126 @@
+import os
+import json
+import numpy as np
+import torch
+from PIL import Image
+from functools import partial
+from multiprocessing import Pool
+
+"""
+Pre-decoded image cache.
+        Images are decoded once at the training resolution and stored as uint8
+        3 x H x W rows of a memory-mapped blob, so that a dataset item only copies
+        two rows instead of decoding and resizing two full resolution JPEGs.
+        One cache folder holds one resolution, the datasets keep them apart by img_scale.
+
+        Layout of a cache folder:
+            images.bin: uint8 rows of 3 x H x W.
+            index.json: the image size and the row of every image path.
+"""
+
+
+def load_resized(image_path, size):
+    """Decode an image directly at the target size.
+
+    Args:
+        image_path: Path to the image.
+        size: The target (height, width).
+    Returns:
+        A 3 x H x W uint8 array.
+    """
+    h, w = size
+    with Image.open(image_path) as img:
+        # for JPEGs, only decode at the smallest DCT scale that is still >= (w, h)
+        img.draft('RGB', (w, h))
+        img = img.convert('RGB').resize((w, h), Image.BILINEAR)
+    return np.asarray(img).transpose(2, 0, 1)
+
+
+class ImageCache(object):
+    def __init__(self, cache_dir: str, size, image_paths=None, num_workers: int = 8):
+        """Open the cache and add the images of image_paths that are missing.
+
+        Args:
+            cache_dir: The cache folder of this resolution.
+            size: The (height, width) images are stored at.
+            image_paths: The images which have to be in the cache.
+            num_workers: Number of processes decoding missing images.
+        """
+        self.cache_dir = cache_dir
+        self.size = tuple(size)
+        self.index = {}
+        self._images = None
+        os.makedirs(cache_dir, exist_ok=True)
+        index_path = os.path.join(cache_dir, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if tuple(index['size']) != self.size:
+                raise Exception('Image cache {} stores size {}, not {}'.format(cache_dir, index['size'], self.size))
+            self.index = index['rows']
+        if image_paths is not None:
+            self.add(image_paths, num_workers)
+
+    def add(self, image_paths, num_workers=8):
+        missing = sorted(set(str(p) for p in image_paths) - set(self.index))
+        if not missing:
+            return
+        print('>> Decoding {} images into the cache {}'.format(len(missing), self.cache_dir))
+        load = partial(load_resized, size=self.size)
+        pool = Pool(num_workers) if num_workers > 0 else None
+        images = pool.imap(load, missing, chunksize=8) if pool else map(load, missing)
+        images_path = os.path.join(self.cache_dir, 'images.bin')
+        row_bytes = 3 * self.size[0] * self.size[1]
+        indexed_bytes = len(self.index) * row_bytes
+        if os.path.exists(images_path):
+            if os.path.getsize(images_path) < indexed_bytes:
+                raise Exception('Image cache {} is missing rows of its index'.format(self.cache_dir))
+            # rows written by an interrupted build are not in the index, drop them
+            os.truncate(images_path, indexed_bytes)
+        with open(images_path, 'ab') as f:
+            for path, img in zip(missing, images):
+                # the row is where the image is written, not the number of indexed images
+                self.index[path] = f.tell() // row_bytes
+                f.write(np.ascontiguousarray(img).tobytes())
+        if pool:
+            pool.close()
+            pool.join()
+        tmp_path = os.path.join(self.cache_dir, 'index.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': list(self.size), 'rows': self.index}, f)
+        os.replace(tmp_path, os.path.join(self.cache_dir, 'index.json'))
+        self._images = None
+
+    def __getstate__(self):
+        # workers map the blob themselves
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __contains__(self, image_path):
+        return str(image_path) in self.index
+
+    def __getitem__(self, image_path):
+        """The cached image as a 3 x H x W uint8 tensor."""
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.cache_dir, 'images.bin'), dtype=np.uint8, mode='r',
+                                     shape=(len(self.index), 3) + self.size)
+        return torch.from_numpy(np.array(self._images[self.index[str(image_path)]]))
+
+
+class BatchNormalize(object):
+    """Normalize uint8 image batches from an ImageCache on the tensor side.
+
+    Float images (not from the cache) are returned unchanged.
+    """
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1) * 255
+        self.std = torch.tensor(std).view(1, -1, 1, 1) * 255
+
+    def __call__(self, img):
+        if img.dtype != torch.uint8:
+            return img
+        if self.mean.device != img.device:
+            self.mean = self.mean.to(img.device)
+            self.std = self.std.to(img.device)
+        return (img.float() - self.mean) / self.std
@@ -0,0 +1,182 @@
+import os
+import json
+import numpy as np
+from pathlib import Path
+from fnmatch import fnmatch
+from multiprocessing import Pool
+from dataset.corres_store import read_pair_header, read_pair_file
+
+"""
+Dataset manifest.
+        A json file cached next to the correspondence files (or at a given path),
+        shared by run.py, the dataset classes and tools/count.py so that the
+        correspondence folder is scanned and read only once.
+
+        For every pair file it records:
+            mtime, size: used to re-read only new or changed .mat files.
+            im_i_path, im_j_path: the original image paths stored in the .mat file.
+            num_matches: the number of positive correspondences.
+            row: the first row of its matches in the points file.
+
+        The matches of all pair files are packed into a points file next to the
+        manifest, as in a packed correspondence store: float32 rows (x, y), pt_i
+        followed by pt_j. The matches of new or changed .mat files are appended, and
+        the file is rewritten once the rows of removed or changed files outnumber the
+        others. The datasets build their pairs from these entries and memory-map the
+        points file (see CorrespondenceStore.from_manifest), so no .mat file is opened
+        at start up or when a pair is loaded.
+"""
+
+MANIFEST_VERSION = 2
+
+
+def _pool_imap(fn, items, num_workers):
+    if num_workers > 0 and len(items) > 1:
+        with Pool(num_workers) as pool:
+            yield from pool.imap(fn, items, chunksize=max(1, min(16, len(items) // (4 * num_workers))))
+        return
+    yield from map(fn, items)
+
+
+class Manifest(object):
+    def __init__(self, pair_file_root: str, manifest_path: str = None, num_workers: int = 8):
+        """Load the cached manifest of a correspondence folder.
+
+        Args:
+            pair_file_root: The folder containing the correspondence .mat files.
+            manifest_path: Where the manifest is cached, defaults to
+                manifest.json inside pair_file_root.
+            num_workers: Number of processes reading .mat files.
+        """
+        self.pair_file_root = str(pair_file_root)
+        self.manifest_path = manifest_path or str(Path(pair_file_root, 'manifest.json'))
+        self.num_workers = num_workers
+        self.pairs = {}
+        # the points file is renamed with every rewrite, so that a manifest always matches its file
+        self.generation = 0
+        self._dirty = False
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.pairs = manifest['pairs']
+                self.generation = manifest['generation']
+        points_rows = os.path.getsize(self.points_path) // 8 if os.path.exists(self.points_path) else 0
+        if any('row' in entry and entry['row'] + 2 * entry['num_matches'] > points_rows for entry in self.pairs.values()):
+            print('>> Manifest: points file {} is missing or incomplete, re-reading all pair files'.format(self.points_path))
+            self.pairs = {}
+
+    @property
+    def points_path(self):
+        return '{}.{}.points.bin'.format(os.path.splitext(self.manifest_path)[0], self.generation)
+
+    def refresh(self, save=True):
+        """Scan the correspondence folder and re-read only new or changed .mat files.
+
+        Args:
+            save: Write the manifest and the points file if they changed, False for processes
+                that only read them. Without a writable points file, the matches of new or
+                changed files are not packed and are read from their .mat file when the pair
+                is loaded.
+        """
+        found = {}
+        with os.scandir(self.pair_file_root) as it:
+            for entry in it:
+                if entry.name.endswith('.mat') and entry.is_file():
+                    stat = entry.stat()
+                    found[entry.name] = (stat.st_mtime, stat.st_size)
+        removed = [name for name in self.pairs if name not in found]
+        for name in removed:
+            del self.pairs[name]
+        changed = sorted(name for name, (mtime, size) in found.items()
+                         if name not in self.pairs or
+                         (self.pairs[name]['mtime'], self.pairs[name]['size']) != (mtime, size))
+        paths = [os.path.join(self.pair_file_root, name) for name in changed]
+        points = None
+        if save:
+            try:
+                points = open(self.points_path, 'ab')
+            except OSError as e:
+                print('>> Could not write points file {}: {}'.format(self.points_path, e))
+        if points is not None:
+            with points:
+                row = points.tell() // 8
+                for name, (org_name_a, org_name_b, pt_i, pt_j) in zip(changed, _pool_imap(read_pair_file, paths, self.num_workers)):
+                    if len(pt_i) != len(pt_j):
+                        raise Exception('pt_i and pt_j differ in length in {}'.format(name))
+                    points.write(pt_i.tobytes())
+                    points.write(pt_j.tobytes())
+                    self._add(name, found[name], org_name_a, org_name_b, len(pt_i), row)
+                    row += 2 * len(pt_i)
+        else:
+            for name, (org_name_a, org_name_b, num_matches) in zip(changed, _pool_imap(read_pair_header, paths, self.num_workers)):
+                self._add(name, found[name], org_name_a, org_name_b, num_matches, None)
+        if changed or removed:
+            print('>> Manifest: {} new or changed, {} removed, {} pair files in total'.format(
+                len(changed), len(removed), len(self.pairs)))
+            self._dirty = True
+        if points is not None:
+            self._compact()
+        if save:
+            self.save()
+
+    def _add(self, name, stat, org_name_a, org_name_b, num_matches, row):
+        self.pairs[name] = {
+            'mtime': stat[0],
+            'size': stat[1],
+            'im_i_path': org_name_a,
+            'im_j_path': org_name_b,
+            'num_matches': num_matches
+        }
+        if row is not None:
+            self.pairs[name]['row'] = row
+
+    def _compact(self):
+        """Rewrite the points file without the rows of removed or changed pair files, once they are the majority."""
+        total_rows = os.path.getsize(self.points_path) // 8
+        live_rows = sum(2 * entry['num_matches'] for entry in self.pairs.values() if 'row' in entry)
+        if total_rows - live_rows <= live_rows:
+            return
+        old_path = self.points_path
+        points = np.memmap(old_path, dtype=np.float32, mode='r', shape=(total_rows, 2)) if total_rows else None
+        self.generation += 1
+        with open(self.points_path, 'wb') as f:
+            row = 0
+            for name in sorted(self.pairs):
+                entry = self.pairs[name]
+                if 'row' not in entry:
+                    continue
+                f.write(points[entry['row']:entry['row'] + 2 * entry['num_matches']].tobytes())
+                entry['row'] = row
+                row += 2 * entry['num_matches']
+        del points
+        self._dirty = True
+        # the old file is still the one of the cached manifest until it is saved
+        self.save()
+        if not self._dirty:
+            os.remove(old_path)
+
+    def select(self, pattern):
+        """Sorted names of the pair files matching the glob pattern."""
+        return sorted(name for name in self.pairs if fnmatch(name, pattern))
+
+    def pair_path(self, name):
+        return os.path.join(self.pair_file_root, name)
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = self.manifest_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'generation': self.generation, 'pairs': self.pairs}, f)
+            os.replace(tmp_path, self.manifest_path)
+            self._dirty = False
+        except OSError as e:
+            print('>> Could not write manifest {}: {}'.format(self.manifest_path, e))
+
+    def __getitem__(self, name):
+        return self.pairs[name]
+
+    def __len__(self):
+        return len(self.pairs)
@@ -1,10 +1,11 @@
 import numpy as np
 from PIL import Image
 from pathlib import Path
-from glob import glob
-from corres_sampler import random_select_positive_matches, random_select_negative_matches_whole_image
+from corres_sampler import random_select_positive_matches, random_select_negative_matches_whole_image, sample_fixed_matches, item_generator
+from dataset.corres_store import CorrespondenceStore
+from dataset.manifest import Manifest
+from dataset.image_cache import ImageCache
 import scipy.io
-import h5py  # for loading v7.3 .mat
 
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import BatchSampler
@@ -18,12 +19,25 @@ Initialize Robotcar class attributes.
             pair_info_folder: The folder containing .mat file 
                         that stores image pairs and their positive correspondences.
             name: The dataset name.
-            image_pairs_name: The dict storing the path(name) to image pairs.
-            corres_pos_all: The dict storing all the positive correspondences given by .mat files. 
+            pair_indices: The indices of the used image pairs in the correspondence store.
+            corres_store: Optional folder of a packed correspondence store (see dataset/corres_store.py),
+                        used instead of reading the .mat files. Otherwise the pairs are taken from the
+                        manifest and their matches from the points file packed next to it.
+            manifest: Optional dataset manifest (see dataset/manifest.py) shared with run.py,
+                        loaded from the pair_info_folder if not given.
+            image_cache: Optional folder of pre-decoded images (see dataset/image_cache.py). Cached images
+                        are returned as uint8 and normalized batch-wise with dataset/image_cache.BatchNormalize.
+            sample_matches: Sample num_matches positive matches per pair in the dataset (with a validity mask),
+                        so that pairs can be batched with corres_sampler.collate_pairs.
+            seed: Without DataLoader workers, the matches of a pair are sampled from a generator seeded with
+                        the seed, the epoch (set_epoch) and the index (see corres_sampler.item_generator).
 """
 
 
 class RobotcarDataset(Dataset):
+    mean = [0.03001604,0.08044077,0.13968322]
+    std = [1.0841591,1.0996625,1.1056131]  # all image in robotcar
+
     def __init__(self, root: str,
                  image_folder: str,
                  pair_info_folder: str,
@@ -33,7 +47,12 @@ class RobotcarDataset(Dataset):
                  robotcar_weather: str = None,
                  transform=None,
                  img_scale: int = None,
-                 num_matches: int = None
+                 num_matches: int = None,
+                 corres_store: str = None,
+                 manifest: Manifest = None,
+                 image_cache: str = None,
+                 sample_matches: bool = False,
+                 seed: int = 0
                  ):
         self._data = {
             'name': 'robotcar',
@@ -42,24 +61,43 @@ class RobotcarDataset(Dataset):
             'pair_info_folder': pair_info_folder,
             'pair_file_names': None,
             'queries_folder': queries_folder,
-            'image_pairs_name': None,
-            'corres_pos_all': None,
+            'pair_indices': None,
             'scale': img_scale,
             'num_matches': num_matches
         }
-        self.load_pair_file_names(robotcar_weather, robotcar_weather_all)
-        self.load_image_pairs()
+        self._store = None
+        if corres_store is None:
+            if manifest is None:
+                manifest = Manifest(Path(root, self._data['name'], pair_info_folder))
+                manifest.refresh()
+            self.load_pair_file_names(robotcar_weather, robotcar_weather_all, manifest)
+            self.load_image_pairs(manifest)
+        else:
+            self.load_corres_store(corres_store, robotcar_weather, robotcar_weather_all)
         self.transform = transform
+        self.sample_matches = sample_matches
+        self.seed = seed
+        self.epoch = 0
         self.default_transform = self.default_transform()
+        self._image_cache = None
+        if image_cache is not None and transform:
+            cache_dir = Path(image_cache, '{}_scale{}'.format(self._data['name'], img_scale))
+            self._image_cache = ImageCache(str(cache_dir), self.image_size(), self.image_paths())
+
+    def pair_file_pattern(self, robotcar_weather, robotcar_weather_all):
+        if not robotcar_weather_all:
+            return 'correspondence_run1_overcast-reference_run2_{}*.mat'.format(robotcar_weather)
+        return '*.mat'
 
-    def load_pair_file_names(self, robotcar_weather, robotcar_weather_all):
+    def image_path(self, pair_file, org_name):
+        query_root = Path(self._data['root'], self._data['name'], self._data['image_folder'])
+        return Path(query_root, org_name)
+
+    def load_pair_file_names(self, robotcar_weather, robotcar_weather_all, manifest):
         # load image pairs for one slice
         pair_file_roots = Path(self._data['root'], self._data['name'], self._data['pair_info_folder'])
-        if not robotcar_weather_all:
-            suffix = 'correspondence_run1_overcast-reference_run2_{}*.mat'.format(robotcar_weather)
-        else:
-            suffix = '*.mat'
-        pair_files = glob(str(Path(pair_file_roots, suffix)))
+        suffix = self.pair_file_pattern(robotcar_weather, robotcar_weather_all)
+        pair_files = [manifest.pair_path(name) for name in manifest.select(suffix)]
         if not len(pair_files):
             raise Exception('No correspondence file found at {}'.format(pair_file_roots))
         if not robotcar_weather_all:
@@ -69,42 +107,62 @@ class RobotcarDataset(Dataset):
         
         self._data['pair_file_names'] = pair_files
 
-    def load_image_pairs(self):
-        N = len(self._data['pair_file_names'])  # number of image pairs
-        image_pairs = {'a': [], 'b': []}
-        corres_all_pos = {'a': [], 'b': []}
-        for f in self._data['pair_file_names']:
-            pair_info = h5py.File(f, 'r+')
-            org_name_a = u''.join(chr(c) for c in pair_info['im_i_path'])
-            org_name_b = u''.join(chr(c) for c in pair_info['im_j_path'])
-            query_root = Path(self._data['root'], self._data['name'], self._data['image_folder'])
-            image_pairs['a'].append(Path(query_root, org_name_a))
-            image_pairs['b'].append(Path(query_root, org_name_b))
-            corres_all_pos['a'].append(pair_info['pt_i'][()])
-            corres_all_pos['b'].append(pair_info['pt_j'][()])  # N x 2
-        self._data['image_pairs_name'] = image_pairs
-        self._data['corres_pos_all'] = corres_all_pos
+    def load_image_pairs(self, manifest):
+        # the pair and image names come from the manifest, the matches are sliced from the points file packed next to it
+        self._store = CorrespondenceStore.from_manifest(manifest, [Path(f).name for f in self._data['pair_file_names']])
+        self._data['pair_indices'] = np.arange(len(self._store))
+
+    def load_corres_store(self, store_dir, robotcar_weather, robotcar_weather_all):
+        self._store = CorrespondenceStore(store_dir)
+        pair_indices = self._store.select(self.pair_file_pattern(robotcar_weather, robotcar_weather_all))
+        if not len(pair_indices):
+            raise Exception('No correspondence file found in store {}'.format(store_dir))
+        if not robotcar_weather_all:
+            print('>> Found {} image pairs for weather {} in store'.format(len(pair_indices), robotcar_weather))
+        else:
+            print('>> Found {} image pairs for Robotcar dataset in store'.format(len(pair_indices)))
+        self._data['pair_indices'] = pair_indices
+
+    def image_size(self):
+        return (1024 // self._data['scale'], 1024 // self._data['scale'])
+
+    def image_paths(self):
+        for pair in self._data['pair_indices']:
+            pair_file = self._store.pair_file(pair)
+            for org_name in self._store.image_names(pair):
+                yield self.image_path(pair_file, org_name)
 
     def default_transform(self):
         return transforms.Compose([
-            transforms.Resize((1024 // self._data['scale'], 1024 // self._data['scale'])),
+            transforms.Resize(self.image_size()),
             transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.03001604,0.08044077,0.13968322], std=[1.0841591,1.0996625,1.1056131]), # all image in robotcar
+            transforms.Normalize(mean=self.mean, std=self.std),
         ])
 
+    def set_epoch(self, epoch):
+        """The epoch of the sampled matches."""
+        self.epoch = epoch
+
     def __getitem__(self, idx):
-        img_a = self._data['image_pairs_name']['a'][idx]
-        img_b = self._data['image_pairs_name']['b'][idx]
-        a = self._data['corres_pos_all']['a'][idx].squeeze()
-        b = self._data['corres_pos_all']['b'][idx].squeeze()
-        if self.transform:
+        pair = self._data['pair_indices'][idx]
+        pair_file = self._store.pair_file(pair)
+        org_name_a, org_name_b = self._store.image_names(pair)
+        img_a = self.image_path(pair_file, org_name_a)
+        img_b = self.image_path(pair_file, org_name_b)
+        a, b = self._store.matches(pair)
+        if self._image_cache is not None:
+            img_a = self._image_cache[img_a]
+            img_b = self._image_cache[img_b]
+        elif self.transform:
             img_a = self.default_transform(Image.open(img_a))
             img_b = self.default_transform(Image.open(img_b))
-        corres_ab_pos = {'a': a, 'b': b}
+        if self.sample_matches:
+            corres_ab_pos = sample_fixed_matches(a, b, int(self._data['num_matches']),
+                                                 item_generator(self.seed, self.epoch, idx))
+        else:
+            corres_ab_pos = {'a': a, 'b': b}
         return (img_a, img_b), (corres_ab_pos)
 
     def __len__(self):
-        assert len(self._data['image_pairs_name']['a']) == len(self._data['image_pairs_name']['b'])
-        return len(self._data['image_pairs_name']['a'])
+        return len(self._data['pair_indices'])
 
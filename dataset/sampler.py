@@ -0,0 +1,78 @@
+import torch
+from torch.utils.data import Sampler, DistributedSampler
+
+"""
+Resumable shuffling sampler.
+        Draws the permutation of every epoch like torch's RandomSampler (from a seed taken
+        from the global torch RNG when the epoch starts), but keeps it so that a checkpoint
+        can store the permutation and the number of samples consumed, and a resumed run
+        continues the epoch at the next sample without replaying the consumed ones.
+        ResumableDistributedSampler does the same for the part of each process of a
+        distributed run, whose order follows from the seed and the epoch.
+"""
+
+
+class ResumableRandomSampler(Sampler):
+    def __init__(self, data_source):
+        """
+        Args:
+            data_source: The dataset to sample from.
+        """
+        self.data_source = data_source
+        self.permutation = None
+        self.start = 0
+        self.current = None
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __iter__(self):
+        if self.permutation is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            self.permutation = torch.randperm(len(self.data_source), generator=generator)
+        # a restored permutation is only continued once, the next epoch draws a new one
+        self.current, start = self.permutation, self.start
+        self.permutation, self.start = None, 0
+        yield from self.current[start:].tolist()
+
+    def state_dict(self, consumed):
+        """
+        Args:
+            consumed: The number of samples of the current epoch used so far.
+        """
+        return {'permutation': self.current, 'position': consumed}
+
+    def load_state_dict(self, state):
+        """Continue the stored permutation at its position in the next epoch started."""
+        self.permutation = state['permutation'].cpu()
+        self.start = state['position']
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """DistributedSampler that can continue an epoch at the position of a checkpoint.
+
+    The order of every process is determined by the seed and the epoch (set_epoch), so
+    a checkpoint only stores the epoch and the position, which is the same for all processes.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ResumableDistributedSampler, self).__init__(*args, **kwargs)
+        self.start = 0
+
+    def __iter__(self):
+        indices = list(super(ResumableDistributedSampler, self).__iter__())
+        start, self.start = self.start, 0
+        yield from indices[start:]
+
+    def state_dict(self, consumed):
+        """
+        Args:
+            consumed: The number of samples of the current epoch used so far by each process.
+        """
+        return {'epoch': self.epoch, 'position': consumed}
+
+    def load_state_dict(self, state):
+        """Continue the epoch of the state at its position in the next epoch started."""
+        self.set_epoch(state['epoch'])
+        self.start = state['position']
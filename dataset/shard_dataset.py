@@ -0,0 +1,223 @@
+import io
+import os
+import json
+import struct
+import random
+import numpy as np
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+from torchvision.transforms import transforms
+from corres_sampler import sample_fixed_matches, seeded_generator
+from dataset.cmu_dataset import CMUDataset
+from dataset.robotcar_dataset import RobotcarDataset
+
+"""
+Streaming sharded dataset.
+        Image pairs (both encoded images and their correspondences) are written
+        sequentially into large shard files by tools/write_shards.py, so that
+        training reads a few large files instead of tens of thousands of small
+        JPEGs and .mat files.
+
+        Record layout inside a shard:
+            header: magic b'GNPR', uint32 length of image a, of image b, number of matches n.
+            image a bytes, image b bytes, pt_i as n x 2 float32, pt_j as n x 2 float32.
+        index.json lists the shards and their number of pairs for every split.
+"""
+
+RECORD_MAGIC = b'GNPR'
+RECORD_HEADER = struct.Struct('<4sIII')
+
+
+def write_shards(dataset, indices, shard_folder, split, shard_size=256 * 1024 ** 2):
+    """Write the pairs dataset[indices] into shards of about shard_size bytes.
+
+    The dataset has to be built with transform=False, so that it returns image paths.
+    Returns:
+        The list of {'file', 'num_pairs'} of the written shards.
+    """
+    os.makedirs(shard_folder, exist_ok=True)
+    shards = []
+    f = None
+    for idx in indices:
+        if f is None or f.tell() >= shard_size:
+            if f is not None:
+                f.close()
+            shards.append({'file': '{}-{:05d}.shard'.format(split, len(shards)), 'num_pairs': 0})
+            f = open(os.path.join(shard_folder, shards[-1]['file']), 'wb')
+        (img_a, img_b), corres = dataset[idx]
+        with open(img_a, 'rb') as img:
+            bytes_a = img.read()
+        with open(img_b, 'rb') as img:
+            bytes_b = img.read()
+        pt_i = np.ascontiguousarray(corres['a'], dtype=np.float32).reshape(-1, 2)
+        pt_j = np.ascontiguousarray(corres['b'], dtype=np.float32).reshape(-1, 2)
+        f.write(RECORD_HEADER.pack(RECORD_MAGIC, len(bytes_a), len(bytes_b), len(pt_i)))
+        f.write(bytes_a)
+        f.write(bytes_b)
+        f.write(pt_i.tobytes())
+        f.write(pt_j.tobytes())
+        shards[-1]['num_pairs'] += 1
+    if f is not None:
+        f.close()
+    return shards
+
+
+def read_shard(shard_path):
+    """Yield (bytes_a, bytes_b, pt_i, pt_j) of every record in a shard."""
+    with open(shard_path, 'rb', buffering=16 * 1024 ** 2) as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            magic, len_a, len_b, n = RECORD_HEADER.unpack(header)
+            if magic != RECORD_MAGIC:
+                raise Exception('Corrupted shard {}'.format(shard_path))
+            bytes_a = f.read(len_a)
+            bytes_b = f.read(len_b)
+            pt_i = np.frombuffer(f.read(8 * n), dtype=np.float32).reshape(n, 2)
+            pt_j = np.frombuffer(f.read(8 * n), dtype=np.float32).reshape(n, 2)
+            yield bytes_a, bytes_b, pt_i, pt_j
+
+
+class ShardedPairDataset(IterableDataset):
+    """Stream the image pairs of one split from the shards written by tools/write_shards.py.
+
+    Every DataLoader worker reads its own subset of the shards sequentially.
+    Pairs are shuffled by randomizing the shard order and passing them through
+    a bounded shuffle buffer. Items are the same as those of the map-style datasets.
+    The shard order, the shuffle buffer and the sampled matches follow from the seed
+    and the epoch (set_epoch) instead of the torch RNG, so that a resumed epoch reads
+    the pairs in the same order. In a distributed run (world_size > 1), all processes
+    use the same shard order and each keeps every world_size-th pair of it, the same
+    number of pairs in every process.
+    """
+    mean = None
+    std = None
+    # the original image size (height, width), scaled down by img_scale
+    base_size = None
+
+    def __init__(self, shard_folder: str,
+                 split: str = 'train',
+                 img_scale: int = None,
+                 num_matches: int = None,
+                 sample_matches: bool = False,
+                 shuffle_buffer: int = 0,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 seed: int = 0):
+        """
+        Args:
+            shard_folder: The folder containing the shards and index.json.
+            split: 'train' or 'val'.
+            img_scale: The scaling factor for the input image.
+            num_matches: The number of matches sampled per pair with sample_matches.
+            sample_matches: Sample num_matches matches per pair, see CMUDataset.
+            shuffle_buffer: The number of pairs to shuffle among, 0 keeps the shard order.
+            rank: The process of a distributed run.
+            world_size: The number of processes the pairs are split among.
+            seed: The seed of the shard order, the shuffle buffer and the sampled matches.
+        """
+        super(ShardedPairDataset, self).__init__()
+        with open(os.path.join(shard_folder, 'index.json'), 'r') as f:
+            self.shards = json.load(f)[split]
+        if not len(self.shards):
+            raise Exception('No {} shard found at {}'.format(split, shard_folder))
+        self.shard_folder = shard_folder
+        self.split = split
+        self.img_scale = img_scale
+        self.num_matches = num_matches
+        self.sample_matches = sample_matches
+        self.shuffle_buffer = shuffle_buffer
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        # the epochs read since set_epoch, counted by the copies of persistent DataLoader workers
+        self._iterations = 0
+        self.default_transform = transforms.Compose([
+            transforms.Resize(self.image_size()),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=self.mean, std=self.std),
+        ])
+
+    def image_size(self):
+        return (self.base_size[0] // self.img_scale, self.base_size[1] // self.img_scale)
+
+    def __len__(self):
+        return sum(shard['num_pairs'] for shard in self.shards) // self.world_size
+
+    def set_epoch(self, epoch):
+        """The epoch the shard order and the sampled matches are seeded with, the same in all processes."""
+        self.epoch = epoch
+        self._iterations = 0
+
+    def _epoch_seed(self):
+        # persistent workers keep the copy of the dataset made in their first epoch
+        epoch = self.epoch + self._iterations
+        self._iterations += 1
+        seed = hash((self.seed, epoch)) & (2 ** 31 - 1)
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return seed, 0, 1
+        return seed, worker_info.id, worker_info.num_workers
+
+    def _records(self, seed, worker_id, num_workers):
+        shards = list(self.shards)
+        if self.shuffle_buffer:
+            # same shard order in all workers, each reads its own part of it
+            random.Random(seed).shuffle(shards)
+        if self.world_size == 1:
+            for shard in shards[worker_id::num_workers]:
+                yield from read_shard(os.path.join(self.shard_folder, shard['file']))
+            return
+        # index of the first pair of every shard in the order, the processes keep the pairs
+        # rank, rank + world_size, ... up to the same count
+        offsets = np.cumsum([0] + [shard['num_pairs'] for shard in shards])
+        end = len(self) * self.world_size
+        for i in range(worker_id, len(shards), num_workers):
+            if offsets[i] >= end:
+                break
+            for j, record in enumerate(read_shard(os.path.join(self.shard_folder, shards[i]['file']))):
+                index = offsets[i] + j
+                if index < end and index % self.world_size == self.rank:
+                    yield record
+
+    def _item(self, record, generator):
+        bytes_a, bytes_b, a, b = record
+        img_a = self.default_transform(Image.open(io.BytesIO(bytes_a)))
+        img_b = self.default_transform(Image.open(io.BytesIO(bytes_b)))
+        if self.sample_matches:
+            corres_ab_pos = sample_fixed_matches(a, b, int(self.num_matches), generator)
+        else:
+            corres_ab_pos = {'a': a.copy(), 'b': b.copy()}
+        return (img_a, img_b), (corres_ab_pos)
+
+    def __iter__(self):
+        seed, worker_id, num_workers = self._epoch_seed()
+        rng = random.Random(seed + worker_id + 1)
+        generator = seeded_generator(seed, worker_id)
+        buffer = []
+        for record in self._records(seed, worker_id, num_workers):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            if self.shuffle_buffer:
+                # emit a random buffered pair and keep the new one in its place
+                i = rng.randrange(len(buffer))
+                buffer[i], record = record, buffer[i]
+            yield self._item(record, generator)
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self._item(record, generator)
+
+
+class CMUShardDataset(ShardedPairDataset):
+    mean = CMUDataset.mean
+    std = CMUDataset.std
+    base_size = (768, 1024)
+
+
+class RobotcarShardDataset(ShardedPairDataset):
+    mean = RobotcarDataset.mean
+    std = RobotcarDataset.std
+    base_size = (1024, 1024)
@@ -0,0 +1,110 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+"""
+Multi-process data-parallel training.
+        One process per device (or per group of CPU cores), launched by torchrun, which sets
+        RANK, LOCAL_RANK and WORLD_SIZE. DistributedDataParallel averages the gradients of
+        the processes in the backward pass, everything else (data loading, the loss and its
+        negative mining) runs per process on its own part of the data. Checkpoints,
+        TensorBoard events and validation are left to rank 0.
+"""
+
+
+def init_distributed(backend=None):
+    """Join the process group of a torchrun launch.
+
+    Args:
+        backend: 'nccl' or 'gloo', None for NCCL when CUDA and NCCL are available and gloo otherwise.
+
+    Returns:
+        (rank, local_rank, world_size)
+    """
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        raise Exception('--distributed needs RANK and WORLD_SIZE, launch run.py with torchrun')
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() and dist.is_nccl_available() else 'gloo'
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend)
+    return dist.get_rank(), local_rank, dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def wrap_model(model, local_rank=None, find_unused_parameters=False):
+    """The DistributedDataParallel module of model, model itself outside a process group."""
+    if not is_distributed():
+        return model
+    device_ids = [local_rank] if local_rank is not None and next(model.parameters()).is_cuda else None
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=find_unused_parameters)
+
+
+def unwrap_model(model):
+    """The module wrapped by DistributedDataParallel, e.g. for its state dict without the 'module.' prefix."""
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def broadcast_parameters(model, src=0):
+    """Copy the parameters of rank src to all processes, e.g. after a per-process re-initialization."""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for param in unwrap_model(model).parameters():
+            dist.broadcast(param.data, src)
+
+
+def all_reduce_mean(values):
+    """The means over the processes of a list of python numbers and tensors, in the same order."""
+    if not is_distributed():
+        return values
+    tensors = [torch.as_tensor(value, dtype=torch.float64).cpu() for value in values]
+    flat = torch.cat([tensor.reshape(-1) for tensor in tensors])
+    if dist.get_backend() == 'nccl':
+        flat = flat.cuda()
+    dist.all_reduce(flat)
+    flat = (flat / dist.get_world_size()).cpu()
+    means = []
+    offset = 0
+    for value, tensor in zip(values, tensors):
+        mean = flat[offset:offset + tensor.numel()].reshape(tensor.shape)
+        offset += tensor.numel()
+        means.append(mean.to(value.device, value.dtype) if torch.is_tensor(value) else mean.item())
+    return means
+
+
+def gather_to_main(obj):
+    """The list of obj of all processes in rank 0, ordered by rank, and None in the other processes."""
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size() if dist.get_rank() == 0 else None
+    dist.gather_object(obj, objs, dst=0)
+    return objs
+
+
+def barrier():
+    """Wait for all processes, e.g. for files written by rank 0 that the others read."""
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,107 @@
+import torch
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from background import BackgroundWorker
+
+"""
+Background TensorBoard and plot writer.
+        Wraps a SummaryWriter so that the events are queued by the training loop and
+        written by a background thread. Tensors (e.g. the per-level losses on the device)
+        are only converted to python values in that thread. Per-iteration series are
+        downsampled, and the loss figure is rendered in the same thread.
+"""
+
+
+def plot_losses(path, train_x, train_y, train_y_contras, train_y_gn, val_x, val_y, val_y_contras, val_y_gn):
+    """Draw the train and validation loss curves into path, without pyplot so that it runs outside the main thread."""
+    fig = Figure(figsize=(12, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(2, 1, 1)
+    ax.set_title("train_val_loss_pic")
+    ax.plot(val_x, val_y, "-s", label='val_total')
+    ax.plot(train_x, train_y, "+-", label='train_total')
+    ax.legend(bbox_to_anchor=(1.0, 1), loc=1, borderaxespad=0.)
+
+    ax = fig.add_subplot(2, 2, 3)
+    ax.set_title("triplet_loss")
+    ax.plot(val_x, val_y_contras, "-s", label='val_triplet')
+    ax.plot(train_x, train_y_contras, "+-", label='train_triplet')
+
+    ax = fig.add_subplot(2, 2, 4)
+    ax.set_title("gn_loss")
+    ax.plot(val_x, val_y_gn, "-s", label='val_gn')
+    ax.plot(train_x, train_y_gn, "+-", label='train_gn')
+    fig.savefig(path)
+
+
+class AsyncWriter(BackgroundWorker):
+    def __init__(self, writer, downsample=1, max_queue=10000):
+        """
+        Args:
+            writer: The SummaryWriter the events are written to.
+            downsample: Only every downsample-th step of the series passed to add_series is written.
+            max_queue: The number of queued events, add_* blocks when the writer falls behind.
+        """
+        self.writer = writer
+        self.downsample = max(downsample, 1)
+        super(AsyncWriter, self).__init__(max_queue)
+
+    def _write_scalar(self, tag, value, step):
+        if torch.is_tensor(value):
+            value = value.item()
+        self.writer.add_scalar(tag, value, step)
+
+    def _write_levels(self, tag, values, step):
+        for level, value in enumerate(values.tolist()):
+            self.writer.add_scalar('level{}/{}'.format(level, tag), value, step)
+
+    def _write_histogram(self, tag, values, step):
+        self.writer.add_histogram(tag, values.float().cpu().numpy(), step)
+
+    def add_scalar(self, tag, value, step):
+        """value: a number or a scalar tensor, which is only read back by the writer thread."""
+        self._put(self._write_scalar, tag, value.detach() if torch.is_tensor(value) else value, step)
+
+    def add_series(self, tag, value, step):
+        """A per-iteration scalar, written every downsample steps only."""
+        if step % self.downsample == 0:
+            self.add_scalar(tag, value, step)
+
+    def add_level_scalars(self, tag, values, step):
+        """A tensor with one entry per level, written as the scalars level<i>/tag."""
+        self._put(self._write_levels, tag, values.detach(), step)
+
+    def add_histogram(self, tag, values, step):
+        """values: a tensor, copied on its device so that later in-place updates do not change it."""
+        self._put(self._write_histogram, tag, values.detach().clone(), step)
+
+    def plot(self, fn, *args):
+        """Call fn(*args) in the writer thread, the arguments must not be changed afterwards."""
+        self._put(fn, *args)
+
+    def close(self):
+        """Write the queued events and stop the thread."""
+        self._join()
+        self.writer.close()
+        self._raise_error()
+
+
+class NullWriter(object):
+    """Drops the events and figures, the writer of the processes other than rank 0 in a distributed run."""
+    def add_scalar(self, tag, value, step):
+        pass
+
+    def add_series(self, tag, value, step):
+        pass
+
+    def add_level_scalars(self, tag, values, step):
+        pass
+
+    def add_histogram(self, tag, values, step):
+        pass
+
+    def plot(self, fn, *args):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+
+"""
+Running means of the training metrics, kept on the device between the logging steps.
+        Calling .item() on every loss of every step synchronizes the device each time. The
+        accumulator keeps the detached per-step values on the device and copies them to the
+        host in one transfer when sync() is called, e.g. every log_interval steps. The host
+        side sums in float64 step by step, so the running means are exactly those of summing
+        .item() values in python.
+"""
+
+
+class MetricAccumulator(object):
+    def __init__(self, names):
+        """
+        Args:
+            names: the names of the scalar metrics passed to add, e.g. ['loss', 'triplet', 'gn'].
+        """
+        self.names = names
+        self.pending = []
+        self.totals = np.zeros(len(names))
+        self.count = 0
+        self.steps = 0
+        self.sums = {}
+
+    def add(self, *scalars, **tensors):
+        """Add one step.
+
+        Args:
+            scalars: the scalar tensors of the step, in the order of names.
+            tensors: other metrics (e.g. per level), summed on the device.
+        """
+        self.pending.append(torch.stack([scalar.detach().reshape(()).float() for scalar in scalars]))
+        for key, value in tensors.items():
+            value = value.detach()
+            self.sums[key] = value if key not in self.sums else self.sums[key] + value
+        self.steps += 1
+
+    def sync(self):
+        """Copy the pending steps to the host.
+
+        Returns:
+            The running means after every pending step, as a list of (step, {name: mean})
+            where step counts the steps added so far.
+        """
+        if not len(self.pending):
+            return []
+        values = torch.stack(self.pending).cpu().double().numpy()
+        self.pending = []
+        means = []
+        for value in values:
+            self.totals = self.totals + value
+            self.count += 1
+            means.append((self.count, dict(zip(self.names, self.totals / self.count))))
+        return means
+
+    def totals_dict(self):
+        """The sums of the scalar metrics over all steps, as python floats."""
+        self.sync()
+        return {name: float(total) for name, total in zip(self.names, self.totals)}
+
+    def means(self):
+        """The means of the scalar metrics over all steps, as python floats."""
+        self.sync()
+        return {name: float(total / max(self.count, 1)) for name, total in zip(self.names, self.totals)}
+
+    def tensor_sum(self, key):
+        """The sum of a metric summed on the device, 0 if it was never added."""
+        return self.sums.get(key, 0)
+
+    def tensor_mean(self, key):
+        """The mean of a metric summed on the device, 0 if it was never added."""
+        return self.sums.get(key, 0) / max(self.steps, 1)
+
+    def state_dict(self):
+        """The sums and counts, synced to the host, to continue the running means after a resume."""
+        self.sync()
+        return {'totals': [float(total) for total in self.totals], 'count': self.count, 'steps': self.steps, 'sums': dict(self.sums)}
+
+    def load_state_dict(self, state):
+        self.pending = []
+        self.totals = np.array(state['totals'])
+        self.count = state['count']
+        self.steps = state['steps']
+        self.sums = dict(state['sums'])
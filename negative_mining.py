@@ -0,0 +1,320 @@
+import numpy as np
+import torch
+
+"""
+Approximate hard-negative mining backends for MyFunctionNegativeTripletSelector.
+        An index is built over the pixels of every target feature map and every anchor
+        only scans the pixels of the inverted lists it probes:
+            ivf: lists are the cells of a k-means coarse quantizer, an anchor probes its num_probe nearest centroids.
+            lsh: lists are the buckets of a random hyperplane hash, an anchor probes its bucket and
+                 the buckets reached by flipping its num_probe least confident bits.
+        Both return the topM closest candidates per anchor, padded with -1 when an anchor
+        saw fewer candidates than topM.
+
+        Coarse-to-fine mining (window_candidates, candidate_search) instead only scans
+        windows of a finer map around the negatives mined on a coarser one.
+"""
+
+
+def squared_distances(x, y):
+    """Squared euclidean distances between the rows of x (NxC) and y (PxC), as batch_pairwise_squared_distances."""
+    dist = (x**2).sum(-1)[:, None] + (y**2).sum(-1)[None, :] - 2.0 * x @ y.t()
+    dist[dist != dist] = 1e-16
+    return torch.clamp(dist, 1e-16, np.inf)
+
+
+def _excluded(keys, excluded_keys):
+    """Which of the n*P + pixel keys are in the sorted excluded_keys."""
+    if not len(excluded_keys):
+        return torch.zeros_like(keys, dtype=torch.bool)
+    pos = torch.searchsorted(excluded_keys, keys).clamp(max=len(excluded_keys) - 1)
+    return excluded_keys[pos] == keys
+
+
+def _list_members(lists, num_lists):
+    """The members of every list as (sorted members, start of every list, count of every list)."""
+    order = torch.argsort(lists)
+    counts = torch.bincount(lists, minlength=num_lists)
+    return order, torch.cumsum(counts, 0) - counts, counts
+
+
+def _list_groups(pixel_counts, probe_counts, budget):
+    """Group the lists with pixels and probes so that the padded (probes x pixels) distances of a group fit into budget.
+
+    Lists are grouped in the order of their number of pixels, so that little padding is needed.
+    A list that does not fit alone is split into chunks of its probes.
+    Returns:
+        A list of (lists, first probe, number of probes), the number of probes None for all.
+    """
+    groups = []
+    group, max_probes, max_pixels = [], 0, 0
+    for l in sorted((l for l in range(len(pixel_counts)) if pixel_counts[l] and probe_counts[l]), key=lambda l: pixel_counts[l]):
+        probes, pixels = probe_counts[l], pixel_counts[l]
+        if probes * pixels > budget:
+            chunk = max(1, budget // pixels)
+            groups += [([l], start, chunk) for start in range(0, probes, chunk)]
+            continue
+        if group and (len(group) + 1) * max(max_probes, probes) * max(max_pixels, pixels) > budget:
+            groups.append((group, 0, None))
+            group, max_probes, max_pixels = [], 0, 0
+        group.append(l)
+        max_probes, max_pixels = max(max_probes, probes), max(max_pixels, pixels)
+    if group:
+        groups.append((group, 0, None))
+    return groups
+
+
+def inverted_list_search(x, y, lists, probes, num_lists, topM, excluded_keys, chunk_mb=256):
+    """Top-M search of the anchors x over the pixels y of the lists they probe.
+
+    The lists are scanned in groups of similar size, each with one batched matmul of
+    (probing anchors x list pixels) per list, padded within the group only. The groups
+    are bounded by chunk_mb, so unbalanced lists do not blow up the memory. Every
+    (anchor, probe) keeps its topM closest pixels, which are merged per anchor at the end.
+
+    Args:
+        x: anchor features, NxC.
+        y: pixel features, PxC.
+        lists: the list of every pixel, P.
+        probes: the lists probed by every anchor, NxK.
+        num_lists: the number of lists.
+        topM: the number of negatives kept per anchor.
+        excluded_keys: n*P + pixel keys of the excluded (anchor, pixel) pairs, set to 1e4 like the exact search.
+        chunk_mb: memory budget of the distances of a group of lists.
+    Returns:
+        The Nxtopm pixel indices (-1 padded), their distances (inf padded) and the number of pixels scanned.
+    """
+    N, K = probes.shape
+    P = y.shape[0]
+    excluded_keys = torch.sort(excluded_keys)[0]
+    probe_lists = probes.flatten()
+    probe_anchors = torch.arange(N, device=x.device).repeat_interleave(K)
+    pixel_order, pixel_starts, pixel_counts = _list_members(lists, num_lists)
+    probe_order, probe_starts, probe_counts = _list_members(probe_lists, num_lists)
+    pixel_counts_host, probe_counts_host = pixel_counts.tolist(), probe_counts.tolist()
+    # bytes per padded (probe, pixel): the distance and the topk scratch
+    budget = max(1, int(chunk_mb * 1024 ** 2 // 8))
+    # the topM candidates of every (anchor, probe)
+    cand_dist = torch.full((N * K, topM), np.inf, dtype=torch.float32, device=y.device)
+    cand_idx = torch.full((N * K, topM), -1, dtype=torch.long, device=y.device)
+    for group, first, num in _list_groups(pixel_counts_host, probe_counts_host, budget):
+        group = torch.tensor(group, device=y.device)
+        max_pixels = max(pixel_counts_host[l] for l in group.tolist())
+        max_probes = max(probe_counts_host[l] for l in group.tolist()) - first if num is None else \
+            min(num, probe_counts_host[int(group[0])] - first)
+        slots = torch.arange(max_pixels, device=y.device)
+        pixel_valid = slots < pixel_counts[group][:, None]
+        pixels = torch.where(pixel_valid, pixel_order[(pixel_starts[group][:, None] + slots).clamp(max=P - 1)],
+                             torch.full_like(slots, -1))
+        slots = first + torch.arange(max_probes, device=y.device)
+        probe_valid = slots < probe_counts[group][:, None]
+        entries = probe_order[(probe_starts[group][:, None] + slots).clamp(max=N * K - 1)]
+        x_lists = x[probe_anchors[entries]].to(torch.float32)
+        y_lists = y[pixels.clamp(min=0)].to(torch.float32)
+        dist = (x_lists**2).sum(-1)[:, :, None] + (y_lists**2).sum(-1)[:, None, :] - 2.0 * torch.bmm(x_lists, y_lists.transpose(1, 2))
+        dist[dist != dist] = 1e-16
+        dist = torch.clamp(dist, 1e-16, np.inf)
+        dist[~pixel_valid[:, None, :].expand_as(dist)] = np.inf
+        keys = probe_anchors[entries][:, :, None] * P + pixels[:, None, :]
+        dist[_excluded(keys, excluded_keys) & pixel_valid[:, None, :]] = 1e4
+        best_dist, k = dist.topk(min(topM, max_pixels), dim=-1, largest=False)
+        best_idx = torch.where(torch.isinf(best_dist), torch.full_like(k, -1),
+                               pixels[:, None, :].expand_as(dist).gather(-1, k))
+        cand_dist[entries[probe_valid], :best_dist.shape[-1]] = best_dist[probe_valid]
+        cand_idx[entries[probe_valid], :best_idx.shape[-1]] = best_idx[probe_valid]
+    best_idx, best_dist, _ = top_candidates(cand_dist.reshape(N, -1), cand_idx.reshape(N, -1), topM, excluded_keys, P)
+    return best_idx, best_dist, int(pixel_counts[probe_lists].sum())
+
+
+def top_candidates(cand_dist, cand_idx, topM, excluded_keys, P):
+    """The topM closest of the NxK candidate pixels cand_idx (-1 for none) of every anchor.
+
+    Returns:
+        The Nxtopm pixel indices (-1 padded), their distances (inf padded) and the number of candidates.
+    """
+    N = cand_idx.shape[0]
+    cand_dist[cand_idx < 0] = np.inf
+    if len(excluded_keys):
+        keys = torch.arange(N, device=cand_idx.device)[:, None] * P + cand_idx
+        cand_dist[_excluded(keys, torch.sort(excluded_keys)[0]) & (cand_idx >= 0)] = 1e4
+    best_dist, k = cand_dist.topk(min(topM, cand_dist.shape[1]), dim=1, largest=False)
+    best_idx = torch.where(torch.isinf(best_dist), torch.full_like(k, -1), cand_idx.gather(1, k))
+    if best_idx.shape[1] < topM:
+        best_idx = torch.cat((best_idx, best_idx.new_full((N, topM - best_idx.shape[1]), -1)), dim=1)
+        best_dist = torch.cat((best_dist, best_dist.new_full((N, topM - best_dist.shape[1]), np.inf)), dim=1)
+    return best_idx, best_dist, int((cand_idx >= 0).sum())
+
+
+# windows holding this fraction of the finer map or more are searched exhaustively instead: the unique
+# candidates of all anchors then cover most of the map, and indexing them costs more than one topk over it
+MAX_WINDOW_FRACTION = 1 / 16
+
+
+def window_side(seed_size, size, margin=1):
+    """The (height, width) in pixels of a finer map of the window around one seed pixel of a coarser map."""
+    (Hc, Wc), (H, W) = seed_size, size
+    return int(np.ceil(H / Hc)) + 2 * margin, int(np.ceil(W / Wc)) + 2 * margin
+
+
+def window_candidates(seeds, seed_size, size, margin=1):
+    """The pixels of a finer map inside the windows around the upsampled seed pixels of a coarser map.
+
+    Args:
+        seeds: NxM pixel indices of the coarser map, -1 for none.
+        seed_size: (H, W) of the coarser map.
+        size: (H, W) of the finer map.
+        margin: the number of finer pixels added on every side of the area covered by a seed.
+    Returns:
+        The NxK candidate pixels of the finer map, -1 for none. Overlapping windows give the same pixel more than once.
+    """
+    (Hc, Wc), (H, W) = seed_size, size
+    side_y, side_x = window_side(seed_size, size, margin)
+    x0 = torch.floor((seeds % Wc).to(torch.float32) * W / Wc).long() - margin
+    y0 = torch.floor((seeds // Wc).to(torch.float32) * H / Hc).long() - margin
+    dx = torch.arange(side_x, device=seeds.device).repeat(side_y)
+    dy = torch.arange(side_y, device=seeds.device).repeat_interleave(side_x)
+    x = x0[..., None] + dx
+    y = y0[..., None] + dy
+    valid = (seeds[..., None] >= 0) & (x >= 0) & (x < W) & (y >= 0) & (y < H)
+    return torch.where(valid, y * W + x, torch.full_like(x, -1)).reshape(seeds.shape[0], -1)
+
+
+def candidate_search(x, y, candidates, topM, excluded_keys, chunk_mb=256):
+    """Top-M search of the anchors x over their own candidate pixels of y.
+
+    The anchors share most of their candidates, so the distances to the unique candidates
+    are computed with one matmul per chunk of anchors, and every anchor gathers its own.
+    The exclusion and repeated candidates are marked on these distances, without sorting
+    the NxK candidates.
+
+    Args:
+        x: anchor features, NxC.
+        y: pixel features, PxC.
+        candidates: NxK candidate pixels of every anchor, -1 for none, may repeat.
+        topM: the number of negatives kept per anchor.
+        excluded_keys: n*P + pixel keys of the excluded (anchor, pixel) pairs.
+        chunk_mb: memory budget of the distances to the unique candidates, anchors are processed in chunks.
+    Returns:
+        The Nxtopm pixel indices (-1 padded), their distances (inf padded) and the number of distinct candidates.
+    """
+    N, K = candidates.shape
+    P = y.shape[0]
+    valid = candidates >= 0
+    # shifted by one, so that the -1 of no candidate marks the first entry only
+    present = torch.zeros(P + 1, dtype=torch.bool, device=y.device)
+    present[candidates + 1] = True
+    present = present[1:]
+    pixels = torch.nonzero(present).squeeze(1)
+    column_of = torch.cumsum(present, 0) - 1
+    columns = column_of[candidates.clamp(min=0)].clamp(min=0)
+    # bytes per anchor and unique candidate: the distance and the owning slot
+    chunk = max(1, int(chunk_mb * 1024 ** 2 // (len(pixels) * 12)))
+    # the excluded pairs among the candidates, ordered by anchor, and where every chunk of anchors starts
+    excluded_keys = torch.sort(excluded_keys)[0]
+    excluded_pixels = excluded_keys % P
+    keep = present[excluded_pixels]
+    excluded_n, excluded_columns = excluded_keys[keep] // P, column_of[excluded_pixels[keep]]
+    bounds = torch.searchsorted(excluded_n, torch.arange(0, N + chunk, chunk, device=y.device)).tolist()
+    y_unique = y[pixels].to(torch.float32)
+    y_norm = (y_unique**2).sum(-1)
+    # slot of every candidate, -1 for none so that a real candidate always owns its column
+    slots = torch.where(valid, torch.arange(K, device=y.device), torch.full_like(candidates, -1))
+    cand_dist = torch.empty((N, K), dtype=torch.float32, device=y.device)
+    duplicate = torch.empty((N, K), dtype=torch.bool, device=y.device)
+    for i, start in enumerate(range(0, N, chunk)):
+        end = min(start + chunk, N)
+        x_chunk = x[start:end].to(torch.float32)
+        dist = (x_chunk**2).sum(-1)[:, None] + y_norm - 2.0 * x_chunk @ y_unique.t()
+        dist[excluded_n[bounds[i]:bounds[i + 1]] - start, excluded_columns[bounds[i]:bounds[i + 1]]] = 1e4
+        cand_dist[start:end] = dist.gather(1, columns[start:end])
+        # overlapping windows give the same pixel more than once, keep only the last slot
+        owner = torch.empty(dist.shape, dtype=torch.long, device=y.device)
+        owner.scatter_reduce_(1, columns[start:end], slots[start:end], 'amax', include_self=False)
+        duplicate[start:end] = owner.gather(1, columns[start:end]) != slots[start:end]
+    cand_dist[cand_dist != cand_dist] = 1e-16
+    cand_dist = torch.clamp(cand_dist, 1e-16, np.inf)
+    candidates = torch.where(duplicate, torch.full_like(candidates, -1), candidates)
+    # the exclusion is already set on the distances
+    return top_candidates(cand_dist, candidates, topM, excluded_keys[:0], P)
+
+
+class IVFMining(object):
+    def __init__(self, num_lists=None, num_probe=8, kmeans_iters=5):
+        """
+        Args:
+            num_lists: the number of k-means cells, defaults to sqrt(H*W).
+            num_probe: the number of cells scanned per anchor.
+            kmeans_iters: the number of Lloyd iterations of the coarse quantizer.
+        """
+        self.num_lists = num_lists
+        self.num_probe = num_probe
+        self.kmeans_iters = kmeans_iters
+
+    def search(self, x, y, topM, excluded_keys, chunk_mb=256):
+        P = y.shape[0]
+        num_lists = min(self.num_lists or int(np.sqrt(P)), P)
+        centroids = y[torch.randperm(P, device=y.device)[:num_lists]]
+        for _ in range(self.kmeans_iters):
+            lists = squared_distances(y, centroids).argmin(1)
+            sums = torch.zeros_like(centroids).index_add_(0, lists, y)
+            counts = torch.bincount(lists, minlength=num_lists)
+            # empty cells keep their centroid
+            centroids = torch.where(counts[:, None] > 0, sums / counts.clamp(min=1)[:, None].to(y), centroids)
+        lists = squared_distances(y, centroids).argmin(1)
+        probes = squared_distances(x, centroids).topk(min(self.num_probe, num_lists), dim=1, largest=False)[1]
+        return inverted_list_search(x, y, lists, probes, num_lists, topM, excluded_keys, chunk_mb)
+
+
+class LSHMining(object):
+    def __init__(self, num_bits=8, num_probe=4):
+        """
+        Args:
+            num_bits: the number of random hyperplanes, there are 2**num_bits buckets.
+            num_probe: the number of additional buckets probed per anchor.
+        """
+        self.num_bits = num_bits
+        self.num_probe = num_probe
+
+    def search(self, x, y, topM, excluded_keys, chunk_mb=256):
+        # hyperplanes through the mean of the map, the (ReLU) features are not centered
+        center = y.mean(0)
+        planes = torch.randn(y.shape[1], self.num_bits, device=y.device)
+        bits = 2 ** torch.arange(self.num_bits, device=y.device)
+        lists = (((y - center) @ planes > 0).long() * bits).sum(1)
+        proj = (x - center) @ planes
+        codes = ((proj > 0).long() * bits).sum(1)
+        # multi-probe: flip the bits whose hyperplanes are closest to the anchor
+        flips = proj.abs().topk(min(self.num_probe, self.num_bits), dim=1, largest=False)[1]
+        probes = torch.cat((codes[:, None], codes[:, None] ^ bits[flips]), dim=1)
+        return inverted_list_search(x, y, lists, probes, 2 ** self.num_bits, topM, excluded_keys, chunk_mb)
+
+
+
+class MemoryBank(object):
+    def __init__(self, capacity):
+        """A FIFO ring buffer of detached fp16 descriptors from recent iterations, used as extra negatives.
+
+        Args:
+            capacity: the number of descriptors kept, the buffer is allocated on the first enqueue.
+        """
+        self.capacity = capacity
+        self.features = None
+        self.ptr = 0
+        self.size = 0
+
+    def enqueue(self, features):
+        """Add the rows of features (KxC), overwriting the oldest ones."""
+        features = features.detach()[-self.capacity:].to(torch.float16)
+        if self.features is None:
+            self.features = torch.zeros((self.capacity, features.shape[1]), dtype=torch.float16, device=features.device)
+        idx = (self.ptr + torch.arange(len(features), device=features.device)) % self.capacity
+        self.features[idx] = features
+        self.ptr = (self.ptr + len(features)) % self.capacity
+        self.size = min(self.size + len(features), self.capacity)
+
+    def __len__(self):
+        return self.size
+
+    def get(self):
+        """The stored descriptors as a float32 (len x C) tensor."""
+        return self.features[:self.size].to(torch.float32)
@@ -0,0 +1,32 @@
+""" Activation checkpointing of the backbone blocks """
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def parse_checkpoint_blocks(blocks, num_blocks):
+    """The set of checkpointed block indices.
+
+    Args:
+        blocks: None for no checkpointing, an empty list for all blocks, or a list of block indices.
+        num_blocks: the number of blocks of the backbone.
+    """
+    if blocks is None:
+        return set()
+    if not len(blocks):
+        return set(range(num_blocks))
+    for block in blocks:
+        if block < 0 or block >= num_blocks:
+            raise Exception('Checkpoint block {} out of range, the backbone has {} blocks'.format(block, num_blocks))
+    return set(blocks)
+
+
+def run_block(block, *inputs, checkpointed=False):
+    """Run block on inputs, without keeping its intermediate activations if checkpointed.
+
+    The activations of a checkpointed block are recomputed in the backward pass. Without
+    autograd (e.g. validation) the block is simply run.
+    """
+    if checkpointed and torch.is_grad_enabled():
+        return checkpoint(block, *inputs, use_reentrant=False)
+    return block(*inputs)
@@ -3,12 +3,12 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 from enum import Enum
-from utils import bilinear_interpolation, batched_eye_like, torch_gradient, MyFunctionNegativeTripletSelector, extract_features, normalize_, np_gradient_filter
+from utils import bilinear_interpolation, inverse_det_2x2, torch_gradient, MyFunctionNegativeTripletSelector, extract_features, extract_gradients, normalize_
 from corres_sampler import random_select_positive_matches
 
 
 cuda = torch.cuda.is_available()
-device = torch.device("cuda:0" if cuda else "cpu")
+device = torch.device("cuda" if cuda else "cpu")
 
 
 class GNLoss(nn.Module):
@@ -16,58 +16,95 @@ class GNLoss(nn.Module):
     GN loss function.
     '''
 
-    def __init__(self, margin_pos=0.2, margin_neg=1, margin=1, contrastive_lamda = 100, gn_lamda=0.3, img_scale=2, e1_lamda = 1, e2_lamda = 2/7, num_matches=1024):
+    def __init__(self, margin_pos=0.2, margin_neg=1, margin=1, contrastive_lamda = 100, gn_lamda=0.3, img_scale=2, e1_lamda = 1, e2_lamda = 2/7, num_matches=1024, mining_memory_mb=None, mining=None, recall_interval=0, coarse_to_fine=False, window_margin=1, memory_bank_size=0, fused=False, levels=None):
         super(GNLoss, self).__init__()
         self.margin = margin
         self.margin_pos = margin_pos
         self.margin_neg = margin_neg
-        self.pair_selector = MyFunctionNegativeTripletSelector(margin_pos=self.margin_pos, margin_neg=self.margin_neg, margin=self.margin)
+        self.pair_selector = MyFunctionNegativeTripletSelector(margin_pos=self.margin_pos, margin_neg=self.margin_neg, margin=self.margin, mining_memory_mb=mining_memory_mb, mining=mining, recall_interval=recall_interval, window_margin=window_margin, memory_bank_size=memory_bank_size)
         self.gn_lamda = gn_lamda
         self.contrastive_lamda = contrastive_lamda
         self.img_scale = img_scale  # original colored image is scaled by a factor img_scale.
         self.e1_lamda = e1_lamda
         self.e2_lamda = e2_lamda
         self.num_matches = num_matches
+        # mine negatives exhaustively on the coarsest level only, finer levels search windows around them
+        self.coarse_to_fine = coarse_to_fine
+        # draw the matches once for all levels and solve the GN steps of all levels in one batched op
+        self.fused = fused
+        # the hypercolumn levels of the feature maps, None for all 5
+        self.levels = levels
+
+    def gn_terms(self, f_t, fb, ub, xs):
+        '''
+        f_t: target features F_a(ua)
+        fb: feature map b, BxCxHxW
+        ub: pos matches of ua in b, BxNx2
+        xs: start points of the GN step, BxNx2
+        returns the entries of the 2x2 Hessian J^T J and of J^T r of every point, with xs and ub, flattened to B*N
+        '''
+        B, N, _ = ub.shape
+        # the normalization and the Hessian are always computed in fp32, also under autocast
+        with torch.autocast(device.type, enabled=False):
+            f_s = extract_features(fb.float(), xs)
+            # compute residual
+            f_t = normalize_(f_t.float())
+            f_s = normalize_(f_s)
+
+            r = f_s - f_t
+            # compute Jacobian, np_gradient_filter(fb) is only evaluated at xs
+            J_xs_x, J_xs_y = extract_gradients(fb.float(), xs)
+            eps = 1e-9  # for invertibility
+            h00 = (J_xs_x * J_xs_x).sum(-1) + eps
+            h01 = (J_xs_x * J_xs_y).sum(-1)
+            h11 = (J_xs_y * J_xs_y).sum(-1) + eps
+            b0 = (J_xs_x * r).sum(-1)
+            b1 = (J_xs_y * r).sum(-1)
+        return h00, h01, h11, b0, b1, xs.reshape(B * N, 2), ub.reshape(B * N, 2).type(torch.float32)
+
+    def gn_errors(self, h00, h01, h11, b0, b1, xs, ub, mask=None):
+        '''
+        Solves the GN steps of gn_terms in closed form, the terms may be stacked along leading dimensions (e.g. levels).
+        h00, h01, h11, b0, b1: ...xM
+        xs, ub: ...xMx2
+        mask: optional validity of the M points
+        returns e, e1, e2 summed over the points, of the leading shape
+        '''
+        # the solve and the log-det are always computed in fp32, also under autocast
+        with torch.autocast(device.type, enabled=False):
+            h00, h01, h11, b0, b1 = (t.float() for t in (h00, h01, h11, b0, b1))
+            i00, i01, i11, det_H = inverse_det_2x2(h00, h01, h11)
+            miu_x = xs[..., 0] - (i00 * b0 + i01 * b1)
+            miu_y = xs[..., 1] - (i01 * b0 + i11 * b1)
+            # first error term
+            d_x = ub[..., 0] - miu_x
+            d_y = ub[..., 1] - miu_y
+            e1 = 0.5 * (h00 * d_x * d_x + 2 * h01 * d_x * d_y + h11 * d_y * d_y)
+            # second error term
+            log_det = torch.log(det_H)
+            if mask is None:
+                e1 = torch.sum(e1, dim=-1)
+                e2 = h00.shape[-1] * torch.log(torch.tensor(2 * np.pi)).to(device) - 0.5 * log_det.sum(-1).to(device)
+            else:
+                valid = mask.reshape(-1).to(log_det)
+                e1 = torch.sum(e1 * valid, dim=-1)
+                e2 = valid.sum() * torch.log(torch.tensor(2 * np.pi)).to(device) - 0.5 * (log_det * valid).sum(-1)
+            # e = e1 + 2 * e2 / 7
+            e = self.e1_lamda * e1 + self.e2_lamda * e2
+        return e, e1, e2
 
-    def compute_gn_loss(self, f_t, fb, ub, train_or_val):
+    def compute_gn_loss(self, f_t, fb, ub, train_or_val, mask=None):
         '''
         f_t: target features F_a(ua)
         fb: feature map b, BxCxHxW
         ub: pos matches of ua in b
+        mask: optional BxN validity of the matches, padded matches do not contribute
         '''
         # compute start point and its feature
         ub = ub.to(device)
-        B, N, _ = ub.shape
         # uniformly sample a perturbation from interval [-1,1]
         xs = torch.FloatTensor(ub.shape).uniform_(-1,1).to(device) + ub
-        f_s = extract_features(fb, xs)
-        # compute residual
-        f_t = normalize_(f_t)
-        f_s = normalize_(f_s)
-
-        r = f_s - f_t
-        # compute Jacobian
-        f_s_gx, f_s_gy = np_gradient_filter(fb)  
-        J_xs_x = extract_features(f_s_gx, xs)
-        J_xs_y = extract_features(f_s_gy, xs)
-        J = torch.stack([J_xs_x, J_xs_y], dim=-1)  
-
-        # compute Heissian
-        eps = 1e-9  # for invertibility
-        H = (J.transpose(1, 2) @ J + eps * batched_eye_like(J, J.shape[2]))
-        b = J.transpose(1, 2) @ r[..., None]
-        miu = xs.reshape(B * N, 2, 1) - torch.inverse(H) @ b
-        # first error term
-        e1 = 0.5 * ((ub.reshape(B * N, 2, 1) - miu).transpose(1, 2)).type(torch.float32) @ H @ \
-            (ub.reshape(B * N, 2, 1) - miu).type(torch.float32)
-        e1 = torch.sum(e1)
-        # second error term
-        det_H = torch.clamp(torch.det(H), min=1e-16)
-        log_det = torch.log(det_H).to(device)
-        e2 = B * N * torch.log(torch.tensor(2 * np.pi)).to(device) - 0.5 * log_det.sum(-1).to(device)
-        # e = e1 + 2 * e2 / 7
-        e = self.e1_lamda * e1 + self.e2_lamda * e2
-        return e, e1, e2
+        return self.gn_errors(*self.gn_terms(f_t, fb, ub, xs), mask=mask)
 
 
     def forward(self, F_a, F_b, positive_matches, iteration, train_or_val):
@@ -79,52 +116,80 @@ class GNLoss(nn.Module):
         4: B x C X H/(scale*16) x W/(scale*16)
         5: B x C X H/(scale*16) x W/(scale*16)
         known_matches is the positive matches sampled by dataloader.
-        {'a':BxNx2,'b':BxNx2}
+        {'a':BxNx2,'b':BxNx2}, with a BxN 'mask' if the dataset already sampled num_matches matches
+        The per-level losses and mean positive/negative distances are returned as tensors with one entry per level.
         '''
+        # feature maps of a mixed precision backbone, the loss is evaluated in fp32
+        F_a = [f.float() for f in F_a]
+        F_b = [f.float() for f in F_b]
         self.max_size_x = F_a[0].shape[3]  # B x C x H x W
         self.max_size_y = F_a[0].shape[2]
 
         '''compute loss for each layer'''
-        loss = 0
-        contrasloss = 0
-        gnloss = 0
-        e1 = 0
-        e2 = 0
-
-        contrasloss_level = []
-        gnloss_level = []
-        loss_pos_mean_level = []
-        loss_neg_mean_level = []
+        num_levels = len(F_a)
+        contrasloss_level = [None] * num_levels
+        loss_pos_mean_level = [None] * num_levels
+        loss_neg_mean_level = [None] * num_levels
+        gn_level = [None] * num_levels
 
         N = positive_matches['a'].shape[1]  # the number of pos and neg matches
+        mask = positive_matches.get('mask')  # only given when the dataset workers sampled the matches
         # compute scaling w.r.t original size (i.e robotcar 1024*1024)
         scaling = [4*self.img_scale, 8*self.img_scale, 8*self.img_scale, 16*self.img_scale, 16*self.img_scale]
-        for i in range(len(F_a)):
+        if self.levels is not None:
+            scaling = [scaling[l] for l in sorted(self.levels)]
+        levels = range(num_levels)
+        if self.coarse_to_fine:
+            # from the coarsest to the finest level, so that the negatives carry over
+            levels = reversed(levels)
+        if mask is None and (self.coarse_to_fine or self.fused):
+            # the same matches on every level
+            positive_matches = random_select_positive_matches(positive_matches['a'], positive_matches['b'], num_of_pairs=self.num_matches)
+        if self.fused:
+            # the perturbations of the GN start points of all levels in one draw
+            perturbation = torch.empty((num_levels,) + tuple(positive_matches['b'].shape), device=device).uniform_(-1, 1)
+        # sample from topM hardest negatives
+        topM = np.clip(300*np.exp(-iteration*0.6/10000), a_min = 5, a_max=None)
+        seeds = None
+        for i in levels:
             # scaling for current layer
             level = scaling[i]
             # randomly select positive matches from dataset
-            positive_matches_sampled = random_select_positive_matches(positive_matches['a'], positive_matches['b'], num_of_pairs=self.num_matches)
+            if mask is None and not (self.coarse_to_fine or self.fused):
+                positive_matches_sampled = random_select_positive_matches(positive_matches['a'], positive_matches['b'], num_of_pairs=self.num_matches)
+            else:
+                positive_matches_sampled = positive_matches
             # slice positive features
             fa_sliced_pos = extract_features(F_a[i], positive_matches_sampled['a'] / level)
             '''compute contrastive loss'''
-            # sample from topM hardest negatives
-            topM = np.clip(300*np.exp(-iteration*0.6/10000), a_min = 5, a_max=None)
             # progressive mining negative samples
-            loss_contras, loss_pos_mean, loss_neg_mean = self.pair_selector.get_triplets(F_a[i], F_b[i], positive_matches_sampled, level, topM = int(topM), dist_threshold=0.2, train_or_val=train_or_val, level=i)            
+            loss_contras, loss_pos_mean, loss_neg_mean = self.pair_selector.get_triplets(F_a[i], F_b[i], positive_matches_sampled, level, topM = int(topM), dist_threshold=0.2, train_or_val=train_or_val, level=i, mask=mask, seeds=seeds)            
+            if self.coarse_to_fine:
+                seeds = self.pair_selector.candidates
 
-            contrasloss_level.append(loss_contras) # check loss on all scales for debugging 
-            loss_pos_mean_level.append(loss_pos_mean)
-            loss_neg_mean_level.append(loss_neg_mean)
+            contrasloss_level[i] = loss_contras # check loss on all scales for debugging 
+            loss_pos_mean_level[i] = loss_pos_mean.mean()
+            loss_neg_mean_level[i] = loss_neg_mean.mean()
 
             '''compute gn loss'''
-            loss_gn_all = self.compute_gn_loss(fa_sliced_pos, F_b[i], positive_matches_sampled['b'] / level, train_or_val)  # //4
-            loss_gn = loss_gn_all[0]
-            gnloss_level.append(loss_gn)
-            loss = self.contrastive_lamda*loss_contras + (self.gn_lamda * loss_gn) + loss 
-            gnloss = (self.gn_lamda * loss_gn) + gnloss # for visualization in trainer.py
-        
-            contrasloss = (self.contrastive_lamda * loss_contras) + contrasloss
-            e1 = e1 + loss_gn_all[1]
-            e2 = e2 + loss_gn_all[2]
-
-        return loss, contrasloss, gnloss, contrasloss_level, gnloss_level, e1, e2, loss_pos_mean_level, loss_neg_mean_level
\ No newline at end of file
+            ub = positive_matches_sampled['b'].to(device) / level
+            if self.fused:
+                # only the terms of the GN step, the steps of all levels are solved together below
+                gn_level[i] = self.gn_terms(fa_sliced_pos, F_b[i], ub, ub + perturbation[i])
+            else:
+                gn_level[i] = self.compute_gn_loss(fa_sliced_pos, F_b[i], ub, train_or_val, mask)  # //4
+
+        if self.fused:
+            # one closed-form solve of the BxN points of all levels
+            gnloss_level, e1_level, e2_level = self.gn_errors(*[torch.stack(terms) for terms in zip(*gn_level)], mask=mask)
+        else:
+            gnloss_level, e1_level, e2_level = [torch.stack(terms) for terms in zip(*gn_level)]
+        contrasloss_level = torch.stack(contrasloss_level)
+        loss_pos_mean_level = torch.stack(loss_pos_mean_level).detach()
+        loss_neg_mean_level = torch.stack(loss_neg_mean_level).detach()
+
+        contrasloss = self.contrastive_lamda * contrasloss_level.sum()
+        gnloss = self.gn_lamda * gnloss_level.sum() # for visualization in trainer.py
+        loss = contrasloss + gnloss
+
+        return loss, contrasloss, gnloss, contrasloss_level.detach(), gnloss_level.detach(), e1_level.sum(), e2_level.sum(), loss_pos_mean_level, loss_neg_mean_level
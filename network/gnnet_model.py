@@ -5,11 +5,21 @@ from network.unet_parts import *
 
 
 class GNNet(nn.Module):
-    def __init__(self, embedding_net):
+    def __init__(self, embedding_net, batched=False):
         super(GNNet, self).__init__()
         self.embedding_net = embedding_net
+        # run both images in one forward of the embedding net, along the batch dimension
+        self.batched = batched
     
     def forward(self, input1, input2):
+        if self.batched and input1.shape == input2.shape:
+            # the embedding nets have no cross-sample layers (GroupNorm is per sample),
+            # so the outputs equal those of two separate forwards
+            outputs = self.embedding_net(torch.cat((input1, input2), dim=0))
+            B = input1.shape[0]
+            output1 = type(outputs)(output[:B] for output in outputs)
+            output2 = type(outputs)(output[B:] for output in outputs)
+            return output1, output2
         output1 = self.embedding_net(input1)
         output2 = self.embedding_net(input2)
         return output1, output2
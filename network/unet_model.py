@@ -1,8 +1,9 @@
 import torch.nn.functional as F
 from network.unet_parts import *
+from network.activation_checkpoint import parse_checkpoint_blocks, run_block
 
 class EmbeddingNet(nn.Module):
-    def __init__(self, n_channels = 3, D = 128, bilinear=False, nearest=True):
+    def __init__(self, n_channels = 3, D = 128, bilinear=False, nearest=True, checkpoint_blocks=None):
         super(EmbeddingNet, self).__init__()
         self.n_channels = n_channels
         self.D = D
@@ -20,20 +21,34 @@ class EmbeddingNet(nn.Module):
         self.F3 = OutConv(128, D)
         self.up4 = Up(128, 64, 8, bilinear, nearest) # gives output features
         self.F4 = OutConv(64, D)
+        # blocks that can be checkpointed, in the order of the forward pass
+        self.blocks = ['inc', 'down1', 'down2', 'down3', 'down4', 'up1', 'up2', 'up3', 'up4']
+        self.set_checkpoint_blocks(checkpoint_blocks)
+
+    def set_checkpoint_blocks(self, blocks):
+        '''blocks: None for none, an empty list for all, or indices into self.blocks'''
+        self._checkpoint_blocks = parse_checkpoint_blocks(blocks, len(self.blocks))
+
+    def checkpoint_block_names(self):
+        return list(self.blocks)
+
+    def run(self, name, *inputs):
+        '''run a block, recomputing its activations in the backward pass if it is checkpointed'''
+        return run_block(getattr(self, name), *inputs, checkpointed=self.blocks.index(name) in self._checkpoint_blocks)
     
     def forward(self, x):
-        x1 = self.inc(x)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
-        x = self.up1(x5, x4)
+        x1 = self.run('inc', x)
+        x2 = self.run('down1', x1)
+        x3 = self.run('down2', x2)
+        x4 = self.run('down3', x3)
+        x5 = self.run('down4', x4)
+        x = self.run('up1', x5, x4)
         f1 = self.F1(x) # D x H/8 x W/8
-        x = self.up2(x, x3)
+        x = self.run('up2', x, x3)
         f2 = self.F2(x) # D x H/4 x W/4
-        x = self.up3(x, x2)
+        x = self.run('up3', x, x2)
         f3 = self.F3(x) # D x H/2 x W/2
-        x = self.up4(x, x1) # output features 64 x H x W
+        x = self.run('up4', x, x1) # output features 64 x H x W
         f4 = self.F4(x) # D x H x W
         # output = f4
         return f1,f2,f3,f4
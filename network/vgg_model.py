@@ -5,11 +5,11 @@ from collections import OrderedDict
 from network.netvlad import NetVLAD
 from tqdm import tqdm
 from typing import List
-import torch
 import torch.nn as nn
 from torch.nn.parallel import DataParallel
 from torch.nn.functional import interpolate
 from torchvision import models
+from network.activation_checkpoint import parse_checkpoint_blocks, run_block
 
 class MyImageRetrievalModel(nn.Module):
     """Build the image retrieval model with intermediate feature extraction.
@@ -17,7 +17,7 @@ class MyImageRetrievalModel(nn.Module):
     The model is made of a VGG-16 backbone combined with a NetVLAD pooling
     layer.
     """
-    def __init__(self, pretrained_flag = False):
+    def __init__(self, pretrained_flag = False, checkpoint_blocks=None):
         """Initialize the Image Retrieval Network.
 
         Args:
@@ -25,26 +25,69 @@ class MyImageRetrievalModel(nn.Module):
             hypercolumn_layers: The hypercolumn layer indices used to compute
                 the intermediate features.
             device: The pytorch device to run on.
+            checkpoint_blocks: The blocks whose activations are recomputed in
+                the backward pass, see set_checkpoint_blocks.
         """
         super(MyImageRetrievalModel, self).__init__()
         self._hypercolumn_layers = [14, 17, 21, 24, 28]
         encoder = models.vgg16(pretrained=pretrained_flag)
         layers = list(encoder.features.children())[:-2]
-        encoder = nn.Sequential(*layers)
-        self._model = encoder
+        # the conv stages of VGG-16 (ending at a max-pooling), also split at the hypercolumn layers.
+        # The layers after the last hypercolumn layer are not needed and dropped.
+        pools = [i for i, layer in enumerate(layers) if isinstance(layer, nn.MaxPool2d)]
+        bounds = sorted(set([0] + [i + 1 for i in pools] + self._hypercolumn_layers))
+        bounds = [i for i in bounds if i <= self._hypercolumn_layers[-1]]
+        self._blocks = list(zip(bounds[:-1], bounds[1:]))
+        self._stages = nn.ModuleList([nn.Sequential(*layers[start:end]) for start, end in self._blocks])
+        # checkpoints store the layers as a single VGG-16 sequential
+        self._register_load_state_dict_pre_hook(self._load_sequential_state_dict)
+        self.set_levels(None)
+        self.set_checkpoint_blocks(checkpoint_blocks)
+
+    def _load_sequential_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        """Map the keys '_model.<layer>.*' of the VGG-16 sequential onto the stages, dropping the truncated layers."""
+        for key in [key for key in state_dict if key.startswith(prefix + '_model.')]:
+            layer, name = key[len(prefix + '_model.'):].split('.', 1)
+            layer = int(layer)
+            value = state_dict.pop(key)
+            for k, (start, end) in enumerate(self._blocks):
+                if start <= layer < end:
+                    state_dict['{}_stages.{}.{}.{}'.format(prefix, k, layer - start, name)] = value
+
+    def set_levels(self, levels):
+        """Select the hypercolumn levels returned by forward.
+
+        Args:
+            levels: None for all, or indices into self._hypercolumn_layers. The
+                stages after the last selected level are not run.
+        """
+        if levels is None:
+            levels = range(len(self._hypercolumn_layers))
+        for level in levels:
+            if level < 0 or level >= len(self._hypercolumn_layers):
+                raise Exception('Level {} out of range, there are {} hypercolumn levels'.format(level, len(self._hypercolumn_layers)))
+        ends = [end for start, end in self._blocks]
+        self._output_stages = sorted(ends.index(self._hypercolumn_layers[level]) for level in levels)
+        self._num_stages = self._output_stages[-1] + 1
+
+    def set_checkpoint_blocks(self, blocks):
+        """Select the blocks whose activations are recomputed in the backward pass.
+
+        Args:
+            blocks: None for none, an empty list for all, or indices into the
+                (start, end) layer ranges of self._blocks.
+        """
+        self._checkpoint_blocks = parse_checkpoint_blocks(blocks, len(self._blocks))
+
+    def checkpoint_block_names(self):
+        """The names of the blocks of set_checkpoint_blocks, by their VGG-16 layer range."""
+        return ['layers {}-{}'.format(start, end - 1) for start, end in self._blocks]
 
     def forward(self, x):
         '''x is the input image tensor'''
-        feature_maps,j = [],0
-        for i, layer in enumerate(list(self._model.children())):
-            if(j==len(self._hypercolumn_layers)):
-                break
-            if(i==self._hypercolumn_layers[j]):
+        feature_maps = []
+        for k in range(self._num_stages):
+            x = run_block(self._stages[k], x, checkpointed=k in self._checkpoint_blocks) # forwarding
+            if k in self._output_stages:
                 feature_maps.append(x)
-                j+=1
-            x = layer(x) # forwarding
-        # Delete and empty cache
-        del x
-        torch.cuda.empty_cache()
         return feature_maps
-        
\ No newline at end of file
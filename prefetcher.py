@@ -0,0 +1,114 @@
+import queue
+import threading
+import torch
+
+"""
+Batch prefetcher.
+        Wraps a DataLoader so that fetching (and pinning) the next batch runs in a
+        background thread, and on CUDA its host-to-device copy is issued on a side
+        stream while the current step computes.
+"""
+
+
+def split_batch(batch):
+    """(img_ab, corres_ab) of a loader batch, img_ab as a tuple and corres_ab a dict or None."""
+    img_ab, corres_ab = batch
+    corres_ab = corres_ab if len(corres_ab) > 0 else None
+    if not type(img_ab) in (tuple, list):
+        img_ab = (img_ab, )
+    return tuple(img_ab), corres_ab
+
+
+def _map_tensors(batch, fn):
+    img_ab, corres_ab = batch
+    img_ab = tuple(fn(d) for d in img_ab)
+    if corres_ab is not None:
+        corres_ab = {key: fn(corres_ab[key]) for key in corres_ab}
+    return img_ab, corres_ab
+
+
+class Prefetcher(object):
+    def __init__(self, loader, device, depth: int = 2):
+        """
+        Args:
+            loader: The DataLoader to iterate over.
+            device: The device batches are moved to, tensors are only staged on CPU.
+            depth: The number of batches fetched ahead by the background thread.
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _staged(self):
+        """Yield the loader batches, fetched ahead (and pinned for CUDA) by a background thread."""
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        pin = self.device.type == 'cuda'
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for batch in self.loader:
+                    batch = split_batch(batch)
+                    if pin:
+                        batch = _map_tensors(batch, lambda d: d if d.is_pinned() else d.pin_memory())
+                    if not put((batch, None)):
+                        return
+                put((None, None))
+            except Exception as e:
+                put((None, e))
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, error = staged.get()
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            # also stops the thread when the consumer breaks out early
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+        batches = self._staged()
+        if self.device.type != 'cuda':
+            yield from batches
+            return
+
+        stream = torch.cuda.Stream(self.device)
+
+        def copy(batch):
+            with torch.cuda.stream(stream):
+                return _map_tensors(batch, lambda d: d.to(self.device, non_blocking=True))
+
+        def ready(batch):
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            # the tensors were allocated on the side stream but are used on the current one
+            _map_tensors(batch, lambda d: d.record_stream(torch.cuda.current_stream(self.device)))
+            return batch
+
+        next_batch = None
+        for batch in batches:
+            if next_batch is not None:
+                current = ready(next_batch)
+                next_batch = copy(batch)
+                yield current
+            else:
+                next_batch = copy(batch)
+        if next_batch is not None:
+            yield ready(next_batch)
@@ -1,17 +1,26 @@
 import os
+import gc
 import torch
 import torch.optim as optim
 import argparse
 from tensorboardX import SummaryWriter
 from pathlib import Path
-from glob import glob
 from torch.utils.data import DataLoader
 from collections import OrderedDict
 
-from utils import save_checkpoint, get_lr
+from utils import get_lr, get_amp_dtype, set_rng_state
 from dataset.cmu_dataset import CMUDataset
 from dataset.robotcar_dataset import RobotcarDataset
+from dataset.manifest import Manifest
+from dataset.image_cache import BatchNormalize
+from dataset.shard_dataset import CMUShardDataset, RobotcarShardDataset
+from dataset.sampler import ResumableRandomSampler, ResumableDistributedSampler
+from negative_mining import IVFMining, LSHMining
+from corres_sampler import collate_pairs
 from trainer import fit
+from logger import AsyncWriter, NullWriter
+from checkpointing import CheckpointWriter
+from distributed import init_distributed, wrap_model, barrier, cleanup
 from network.vgg_model import MyImageRetrievalModel
 from network.gnnet_model import GNNet
 from network.unet_model import EmbeddingNet
@@ -30,6 +39,33 @@ parser.add_argument('--save_root',
 parser.add_argument('--dataset_image_folder', type=str, default='images')
 parser.add_argument('--pair_info_folder', type=str, default='correspondence')
 parser.add_argument('--query_folder', type=str, default='query')
+parser.add_argument('--corres_store',
+                    type=str,
+                    default=None,
+                    help="packed correspondence store, see tools/pack_correspondences.py")
+parser.add_argument('--manifest',
+                    type=str,
+                    default=None,
+                    help="dataset manifest cache, defaults to manifest.json in the pair_info_folder")
+parser.add_argument('--manifest_workers',
+                    type=int,
+                    default=8,
+                    help="Number of processes re-reading new or changed .mat files")
+parser.add_argument('--image_cache',
+                    type=str,
+                    default=None,
+                    help="folder of pre-decoded, pre-resized images, built on first use")
+parser.add_argument('--shard_folder',
+                    type=str,
+                    default=None,
+                    help="stream the pairs from the shards written by tools/write_shards.py")
+parser.add_argument('--shuffle_buffer',
+                    type=int,
+                    default=512,
+                    help="number of pairs shuffled among when streaming shards")
+parser.add_argument('--trust_manifest',
+                    action='store_true',
+                    help="use the cached manifest without re-scanning the pair_info_folder")
 
 # cmu arguments
 parser.add_argument('--all_slice', type=bool, default=True)
@@ -44,6 +80,20 @@ parser.add_argument('--finetune_vgg16_s2d', type=bool, default=True)
 parser.add_argument('--finetune_vgg16_imagenet', type=bool, default=False)
 parser.add_argument('--train_vgg16_from_scratch', type=bool, default=False)
 parser.add_argument('--train_unet_from_scratch', type=bool, default=False)
+parser.add_argument('--levels',
+                    type=int,
+                    nargs='+',
+                    default=None,
+                    help="train on a subset of the 5 VGG-16 hypercolumn levels, later stages are not run")
+parser.add_argument('--batched_siamese',
+                    action='store_true',
+                    help="run both images of a pair through the backbone in one forward")
+parser.add_argument('--checkpoint_blocks',
+                    type=int,
+                    nargs='*',
+                    default=None,
+                    help="recompute the activations of these backbone blocks in the backward pass (no index: all blocks), "
+                         "see tools/memory_report.py")
 
 # learning arguments
 parser.add_argument('--batch_size',
@@ -56,6 +106,24 @@ parser.add_argument('--num_workers',
                     type=int,
                     default=0,
                     help="Number of workers")
+parser.add_argument('--pin_memory',
+                    action='store_true',
+                    help="let the DataLoader workers return batches in pinned memory")
+parser.add_argument('--persistent_workers',
+                    action='store_true',
+                    help="keep the DataLoader workers alive between epochs")
+parser.add_argument('--prefetch_factor',
+                    type=int,
+                    default=None,
+                    help="number of batches loaded ahead by every worker")
+parser.add_argument('--sample_matches',
+                    action='store_true',
+                    help="sample num_matches matches in the dataset workers, needed for batch_size > 1")
+parser.add_argument('--amp',
+                    type=str,
+                    default=None,
+                    choices=['fp16', 'bf16'],
+                    help="run the backbone in mixed precision (fp16 falls back to bf16 on the CPU), the loss stays in fp32")
 parser.add_argument('--lr', type=float, default=1e-6)
 parser.add_argument('--schedule_lr_frequency',
                     type=int,
@@ -73,6 +141,13 @@ parser.add_argument('--transform', type=bool, default=True)
 parser.add_argument('--start_epoch', type=int, default=0)
 parser.add_argument('--total_epochs', type=int, default=50)
 parser.add_argument('--log_interval', type=int, default=100)
+parser.add_argument('--log_downsample',
+                    type=int,
+                    default=1,
+                    help="write the per-iteration TensorBoard series every n iterations")
+parser.add_argument('--log_histograms',
+                    action='store_true',
+                    help="write histograms of the model parameters after every epoch")
 parser.add_argument('--validation_frequency', type=int, default=1)
 parser.add_argument('--init',
                     type=bool,
@@ -80,6 +155,23 @@ parser.add_argument('--init',
                     help="Initialize the network weights")
 parser.add_argument('--resume_checkpoint', type=str, default=None)
 parser.add_argument('--save_initial_weight', type=bool, default=True)
+parser.add_argument('--keep_checkpoints',
+                    type=int,
+                    default=None,
+                    help="keep only the last n checkpoints besides the best one (default: keep all)")
+parser.add_argument('--save_interval',
+                    type=int,
+                    default=0,
+                    help="also save a checkpoint every n iterations within the epochs (0: only at the end of epochs)")
+
+parser.add_argument('--distributed',
+                    action='store_true',
+                    help="data-parallel training with one process per device, launched by torchrun")
+parser.add_argument('--dist_backend',
+                    type=str,
+                    default=None,
+                    choices=['nccl', 'gloo'],
+                    help="process group backend of --distributed (default: nccl with CUDA, gloo otherwise)")
 
 # loss hyperparameters
 parser.add_argument('--gn_loss_lamda', type=float, default=0.003)
@@ -91,6 +183,39 @@ parser.add_argument('--margin',
                     type=float,
                     default=1,
                     help="triplet loss margin")
+parser.add_argument('--mining_memory_mb',
+                    type=float,
+                    default=None,
+                    help="mine hard negatives over tiles of pixels within this memory budget (MB) per level")
+parser.add_argument('--mining',
+                    type=str,
+                    default='exact',
+                    choices=['exact', 'ivf', 'lsh'],
+                    help="hard negative search: exact, k-means inverted lists or random hyperplane hashing")
+parser.add_argument('--mining_probe',
+                    type=int,
+                    default=8,
+                    help="number of inverted lists (ivf) or extra buckets (lsh) scanned per anchor")
+parser.add_argument('--ivf_lists', type=int, default=None, help="number of k-means cells, default sqrt(H*W)")
+parser.add_argument('--lsh_bits', type=int, default=8)
+parser.add_argument('--recall_interval',
+                    type=int,
+                    default=100,
+                    help="log the recall of the approximate mining against the exact search every n iterations")
+parser.add_argument('--coarse_to_fine',
+                    action='store_true',
+                    help="mine negatives on the coarsest level, finer levels only search windows around them")
+parser.add_argument('--window_margin',
+                    type=int,
+                    default=1,
+                    help="pixels added around the upsampled coarse negatives with --coarse_to_fine")
+parser.add_argument('--memory_bank',
+                    type=int,
+                    default=0,
+                    help="keep this many fp16 descriptors of recent iterations per level as extra negatives (0: off)")
+parser.add_argument('--fused_loss',
+                    action='store_true',
+                    help="sample the matches once for all levels and solve the GN steps of all levels together")
 parser.add_argument('--e1_lamda', type=float, default=1)
 parser.add_argument('--e2_lamda', type=float, default=1)
 
@@ -113,29 +238,8 @@ parser.add_argument('--notes', type=str, default=None)
 parser.add_argument('--log_dir', type=str, default='log')
 
 args = parser.parse_args()
-
-# Just for dataset dividing
-pair_file_roots1 = Path(args.dataset_root, args.dataset_name, args.pair_info_folder)
-if args.dataset_name == 'cmu' and args.all_slice == False:
-    suffix1 = 'correspondence_slice{}*.mat'.format(args.slice)
-elif args.dataset_name == 'cmu' and args.all_slice == True:
-    suffix1 = '*.mat'
-elif args.dataset_name == 'robotcar' and args.robotcar_all_weather == True:
-    suffix1 = '*.mat'
-else:
-    suffix1 = 'correspondence_run1_overcast-reference_run2_{}*.mat'.format(args.robotcar_weather)
-pair_files1 = glob(str(Path(pair_file_roots1, suffix1)))
-if not len(pair_files1):
-    raise Exception(
-        'No correspondence file found at {}'.format(pair_file_roots1))
-
-# spilt dataset
-num_dataset = len(pair_files1)
-num_valset = round(0.1 * num_dataset)
-num_trainset = num_dataset - num_valset
-print('\nnum_dataset: {} '.format(num_dataset))
-print('num_trainset: {} '.format(num_trainset))
-print('num_valset: {} \n'.format(num_valset))
+if args.batch_size > 1 and not args.sample_matches:
+    raise Exception('--batch_size > 1 needs --sample_matches')
 
 print('Arguments & hyperparams: ')
 print(args)
@@ -146,48 +250,146 @@ with open(os.path.join(args.log_dir, 'args.txt'), 'w') as f:
     f.write(str(args))
 
 cuda = torch.cuda.is_available()
-device = torch.device("cuda:0" if cuda else "cpu")
+if args.distributed:
+    # one process per device, the gradients are averaged over the processes
+    rank, local_rank, world_size = init_distributed(args.dist_backend)
+    if cuda:
+        torch.cuda.set_device(local_rank)
+else:
+    rank, local_rank, world_size = 0, None, 1
+main = rank == 0
+device = torch.device("cuda:{}".format(local_rank or 0) if cuda else "cpu")
 print('device: ' + str(device) + '\n')
 
 '''set up data loaders'''
-if args.dataset_name == 'cmu':
-    dataset = CMUDataset(root=args.dataset_root,
-                         name=args.dataset_name,
-                         image_folder=args.dataset_image_folder,
-                         pair_info_folder=args.pair_info_folder,
-                         cmu_slice_all=args.all_slice,
-                         cmu_slice=args.slice,
-                         queries_folder=args.query_folder,
-                         transform=args.transform,
-                         img_scale=args.scale,
-                         num_matches=args.num_matches)
+if args.shard_folder is not None:
+    # stream the pairs from sequential shards, tools/write_shards.py already split them
+    shard_dataset = CMUShardDataset if args.dataset_name == 'cmu' else RobotcarShardDataset
+    trainset = shard_dataset(args.shard_folder,
+                             split='train',
+                             img_scale=args.scale,
+                             num_matches=args.num_matches,
+                             sample_matches=args.sample_matches,
+                             shuffle_buffer=args.shuffle_buffer,
+                             rank=rank,
+                             world_size=world_size)
+    valset = shard_dataset(args.shard_folder,
+                           split='val',
+                           img_scale=args.scale,
+                           num_matches=args.num_matches,
+                           sample_matches=args.sample_matches)
+    print('\nnum_trainset: {} '.format(len(trainset)))
+    print('num_valset: {} \n'.format(len(valset)))
+    input_transform = None
+    # shuffling is done by the shard dataset
+    shuffle = False
+    torch.manual_seed(0)
+else:
+    # in a distributed run, rank 0 writes the manifest and the image cache,
+    # the other processes wait and then only read them
+    if not main:
+        barrier()
+    # scan the correspondence folder once, the dataset takes pair files and image paths from the manifest
+    if args.corres_store is None:
+        manifest = Manifest(Path(args.dataset_root, args.dataset_name, args.pair_info_folder),
+                            args.manifest,
+                            num_workers=args.manifest_workers)
+        if not (args.trust_manifest and len(manifest)):
+            manifest.refresh(save=main)
+    else:
+        manifest = None
+
+    if args.dataset_name == 'cmu':
+        dataset = CMUDataset(root=args.dataset_root,
+                             name=args.dataset_name,
+                             image_folder=args.dataset_image_folder,
+                             pair_info_folder=args.pair_info_folder,
+                             cmu_slice_all=args.all_slice,
+                             cmu_slice=args.slice,
+                             queries_folder=args.query_folder,
+                             transform=args.transform,
+                             img_scale=args.scale,
+                             num_matches=args.num_matches,
+                             corres_store=args.corres_store,
+                             manifest=manifest,
+                             image_cache=args.image_cache,
+                             sample_matches=args.sample_matches)
+    else:
+        dataset = RobotcarDataset(root=args.dataset_root,
+                                  name=args.dataset_name,
+                                  image_folder=args.dataset_image_folder,
+                                  pair_info_folder=args.pair_info_folder,
+                                  queries_folder=args.query_folder,
+                                  robotcar_weather_all=args.robotcar_all_weather,
+                                  robotcar_weather=args.robotcar_weather,
+                                  transform=args.transform,
+                                  img_scale=args.scale,
+                                  num_matches=args.num_matches,
+                                  corres_store=args.corres_store,
+                                  manifest=manifest,
+                                  image_cache=args.image_cache,
+                                  sample_matches=args.sample_matches)
+    if main:
+        barrier()
+
+    # cached images are uint8, normalize them batch-wise on the device
+    input_transform = BatchNormalize(dataset.mean, dataset.std) if args.image_cache else None
+
+    # spilt dataset
+    num_dataset = len(dataset)
+    num_valset = round(0.1 * num_dataset)
+    num_trainset = num_dataset - num_valset
+    print('\nnum_dataset: {} '.format(num_dataset))
+    print('num_trainset: {} '.format(num_trainset))
+    print('num_valset: {} \n'.format(num_valset))
+
+    torch.manual_seed(0)
+
+    # number of trainset and number of valset should sum up to len(dataset)
+    trainset, valset = torch.utils.data.random_split(dataset,
+                                                     [num_trainset, num_valset])
+    shuffle = True
+
+if rank > 0:
+    # same split in all processes, but their own random streams (e.g. for the loss perturbations)
+    torch.manual_seed(torch.initial_seed() + rank)
+
+# keep the forked DataLoader workers from touching (and thereby copying) the objects built so far
+gc.freeze()
+
+# fixed-size sampled matches are stacked by collate_pairs, otherwise batch_size is 1
+collate_fn = collate_pairs if args.sample_matches else None
+
+loader_args = {'num_workers': args.num_workers,
+               'collate_fn': collate_fn,
+               'pin_memory': args.pin_memory and cuda}
+if args.num_workers > 0:
+    loader_args['persistent_workers'] = args.persistent_workers
+    if args.prefetch_factor is not None:
+        loader_args['prefetch_factor'] = args.prefetch_factor
+
+# the shuffled order is kept so that a checkpoint saved within an epoch can continue it.
+# In a distributed run, every process trains on its own part of the pairs
+if args.distributed and args.shard_folder is None:
+    sampler = ResumableDistributedSampler(trainset, num_replicas=world_size, rank=rank, shuffle=shuffle)
 else:
-    dataset = RobotcarDataset(root=args.dataset_root,
-                              name=args.dataset_name,
-                              image_folder=args.dataset_image_folder,
-                              pair_info_folder=args.pair_info_folder,
-                              queries_folder=args.query_folder,
-                              robotcar_weather_all=args.robotcar_all_weather,
-                              robotcar_weather=args.robotcar_weather,
-                              transform=args.transform,
-                              img_scale=args.scale,
-                              num_matches=args.num_matches)
-
-torch.manual_seed(0)
-
-# number of trainset and number of valset should sum up to len(dataset)
-trainset, valset = torch.utils.data.random_split(dataset,
-                                                 [num_trainset, num_valset])
+    sampler = ResumableRandomSampler(trainset) if shuffle else None
+# the DataLoader draws the base seed of its workers from its own generator instead of the torch RNG,
+# which a resumed epoch restores before the loader starts
+loader_generator = torch.Generator()
+loader_generator.manual_seed(torch.initial_seed())
 train_loader = DataLoader(trainset,
                           batch_size=args.batch_size,
-                          shuffle=True,
-                          num_workers=args.num_workers)
+                          sampler=sampler,
+                          generator=loader_generator,
+                          **loader_args)
 
-if args.validate:
+# validation runs in rank 0 only
+if args.validate and main:
     val_loader = DataLoader(valset,
                             batch_size=args.batch_size,
                             shuffle=False,
-                            num_workers=args.num_workers)
+                            **loader_args)
 else:
     val_loader = None
 
@@ -212,10 +414,22 @@ elif args.train_unet_from_scratch:
     model = GNNet(embedding_net)
 else:
     raise Exception('Please indicate model')
+embedding_net.set_checkpoint_blocks(args.checkpoint_blocks)
+if args.levels is not None:
+    if not hasattr(embedding_net, 'set_levels'):
+        raise Exception('--levels is only supported by the VGG-16 models')
+    embedding_net.set_levels(args.levels)
+model.batched = args.batched_siamese
 
 model = model.to(device)
 
 # set up loss
+if args.mining == 'ivf':
+    mining = IVFMining(num_lists=args.ivf_lists, num_probe=args.mining_probe)
+elif args.mining == 'lsh':
+    mining = LSHMining(num_bits=args.lsh_bits, num_probe=args.mining_probe)
+else:
+    mining = None
 loss_fn = GNLoss(margin_pos=args.margin_pos, 
                 margin_neg=args.margin_neg, 
                 margin=args.margin,
@@ -224,28 +438,53 @@ loss_fn = GNLoss(margin_pos=args.margin_pos,
                 img_scale=args.scale,
                 e1_lamda=args.e1_lamda,
                 e2_lamda=args.e2_lamda,
-                num_matches=args.num_matches)
+                num_matches=args.num_matches,
+                mining_memory_mb=args.mining_memory_mb,
+                mining=mining,
+                recall_interval=args.recall_interval,
+                coarse_to_fine=args.coarse_to_fine,
+                window_margin=args.window_margin,
+                memory_bank_size=args.memory_bank,
+                fused=args.fused_loss,
+                levels=args.levels)
 optimizer = optim.AdamW(model.parameters(),
                         lr=args.lr,
                         weight_decay=args.weight_decay)
+# fp16 gradients are scaled to avoid underflow, bf16 has the range of fp32
+amp_dtype = get_amp_dtype(args.amp, device)
+scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
 scheduler = optim.lr_scheduler.StepLR(optimizer,
                                       args.schedule_lr_frequency,
                                       gamma=args.schedule_lr_fraction,
                                       last_epoch=-1)  # optional
 
+resume = None
 if (args.resume_checkpoint):
     checkpoint = torch.load(args.resume_checkpoint, map_location=torch.device(device))
-    start_epoch = checkpoint['epoch']+1
+    if 'position' in checkpoint:
+        # saved within the epoch, which is continued at the next batch
+        start_epoch = checkpoint['epoch']
+        resume = checkpoint
+    else:
+        start_epoch = checkpoint['epoch']+1
     model.load_state_dict(checkpoint['model_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+    if 'scaler_state_dict' in checkpoint:
+        scaler.load_state_dict(checkpoint['scaler_state_dict'])
     print("=> loaded checkpoint '{}' (epoch {})" .format(args.resume_checkpoint, checkpoint['epoch']))
 else:
+    checkpoint = None
     start_epoch = args.start_epoch
     print("Did not use any checkpoint")
 
-start_iteration = (start_epoch)*len(train_loader)
-writer = SummaryWriter(args.log_dir, purge_step=start_iteration) #SummaryWriter encapsulates everything
+start_iteration = (start_epoch)*len(train_loader) + (resume['position'] if resume is not None else 0)
+if main:
+    writer = SummaryWriter(args.log_dir, purge_step=start_iteration) #SummaryWriter encapsulates everything
+    # the events are written by a background thread
+    writer = AsyncWriter(writer, downsample=args.log_downsample)
+else:
+    writer = NullWriter()
 
 n_epochs = args.total_epochs
 log_interval = args.log_interval
@@ -253,12 +492,29 @@ save_root = args.save_root
 validation_frequency = args.validation_frequency
 init = args.init
 
+# checkpoints are written in the background by rank 0, the best one is linked
+checkpoints = CheckpointWriter(save_root, keep_last=args.keep_checkpoints) if main else None
+
 # save initial weight
-if args.save_initial_weight:
+if args.save_initial_weight and main:
     print('save initial weight')
-    save_checkpoint(model.state_dict(), optimizer.state_dict(), scheduler.state_dict(), False, save_root, -1)
+    checkpoints.save(model, optimizer, scheduler, -1)
+
+# the stages after the last selected level have no gradients
+model = wrap_model(model, local_rank, find_unused_parameters=args.levels is not None)
+
+# random streams of the checkpoint, restored last so that the setup above does not advance them.
+# Within an epoch, train_epoch restores them at the next batch. The other processes of a distributed
+# run keep their own streams at the start of an epoch
+if checkpoint is not None and resume is None and 'rng_state' in checkpoint and main:
+    set_rng_state(checkpoint['rng_state'])
 
 # fit the model
 print("****** START Training****** \n")
 fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs,
-    cuda, log_interval, validation_frequency, save_root, init, writer, start_epoch)
+    cuda, log_interval, validation_frequency, save_root, init, writer, start_epoch, input_transform, amp_dtype, scaler,
+    args.log_histograms, checkpoints, args.save_interval, resume)
+writer.close()
+if checkpoints is not None:
+    checkpoints.close()
+cleanup()
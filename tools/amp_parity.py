@@ -0,0 +1,94 @@
+"""Check the accuracy of the mixed precision training mode against fp32 on a fixed batch.
+
+The same batch (random images and matches drawn from --seed) is evaluated once in fp32
+and once with the backbone under autocast, the random draws of GNLoss are re-seeded for
+both runs. The losses per level, the feature maps and the gradients are compared. Run
+from the repository root, e.g.
+    python -m tools.amp_parity --amp bf16 --checkpoint checkpoints/10_checkpoint.pth.tar
+"""
+import argparse
+import torch
+import numpy as np
+
+from utils import get_amp_dtype
+from network.vgg_model import MyImageRetrievalModel
+from network.gnnet_model import GNNet
+from network.gn_loss import GNLoss
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--amp', type=str, default='bf16', choices=['fp16', 'bf16'])
+parser.add_argument('--checkpoint', type=str, default=None, help="checkpoint of run.py, random weights otherwise")
+parser.add_argument('--image_size', type=int, nargs=2, default=[384, 512], help="(height, width) of the network input")
+parser.add_argument('--scale', type=int, default=2, help="Scaling factor for input image, as in run.py")
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--num_matches', type=int, default=1024)
+parser.add_argument('--iteration', type=int, default=0, help="iteration of the top-M schedule of the negative mining")
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--tolerance', type=float, default=0.05, help="maximal relative difference of the total loss")
+
+
+def fixed_batch(args, device):
+    """Random images and matches, the matches are given in the coordinates of the original images."""
+    generator = torch.Generator().manual_seed(args.seed)
+    B, N = args.batch_size, args.num_matches
+    h, w = args.image_size
+    img_a = torch.randn(B, 3, h, w, generator=generator)
+    img_b = torch.randn(B, 3, h, w, generator=generator)
+    size = torch.tensor([w * args.scale - 1., h * args.scale - 1.])
+    a = torch.rand(B, N, 2, generator=generator) * size
+    b = torch.minimum(torch.clamp(a + 8 * torch.randn(B, N, 2, generator=generator), min=0), size)
+    corres = {'a': a.to(device), 'b': b.to(device), 'mask': torch.ones(B, N, dtype=torch.bool, device=device)}
+    return img_a.to(device), img_b.to(device), corres
+
+
+def evaluate(model, loss_fn, batch, args, amp_dtype, device):
+    img_a, img_b, corres = batch
+    model.zero_grad()
+    torch.manual_seed(args.seed)
+    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        F_a, F_b = model(img_a, img_b)
+    loss, contrasloss, gnloss, contrasloss_level, gnloss_level, e1, e2, _, _ = loss_fn(F_a, F_b, corres, args.iteration, True)
+    loss.backward()
+    grad = torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+    return {'loss': loss.item(), 'contras': contrasloss_level, 'gn': gnloss_level, 'e1': e1.item(), 'e2': e2.item(),
+            'features': [f.detach().float() for f in F_a + F_b], 'grad': grad}
+
+
+def rdiff(x, y):
+    return float(abs(x - y) / max(abs(y), 1e-12))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    amp_dtype = get_amp_dtype(args.amp, device)
+    torch.manual_seed(args.seed)
+    model = GNNet(MyImageRetrievalModel(pretrained_flag=False))
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location=device)['model_state_dict'])
+    model = model.to(device).train()
+    loss_fn = GNLoss(img_scale=args.scale, num_matches=args.num_matches)
+    batch = fixed_batch(args, device)
+
+    ref = evaluate(model, loss_fn, batch, args, None, device)
+    amp = evaluate(model, loss_fn, batch, args, amp_dtype, device)
+
+    print('>> device: {}, autocast: {}'.format(device, amp_dtype))
+    print('{:>6} {:>14} {:>14} {:>10} {:>14} {:>14} {:>10} {:>12}'.format(
+        'level', 'contras fp32', 'contras amp', 'rdiff', 'gn fp32', 'gn amp', 'rdiff', 'feat rdiff'))
+    num_levels = len(ref['contras'])
+    for i in range(num_levels):
+        feat_rdiff = max(float((amp['features'][j] - ref['features'][j]).norm() / ref['features'][j].norm().clamp(min=1e-12))
+                         for j in (i, i + num_levels))
+        print('{:>6} {:>14.6f} {:>14.6f} {:>10.2e} {:>14.6f} {:>14.6f} {:>10.2e} {:>12.2e}'.format(
+            i, float(ref['contras'][i]), float(amp['contras'][i]), rdiff(float(amp['contras'][i]), float(ref['contras'][i])),
+            float(ref['gn'][i]), float(amp['gn'][i]), rdiff(float(amp['gn'][i]), float(ref['gn'][i])), feat_rdiff))
+    loss_rdiff = rdiff(amp['loss'], ref['loss'])
+    cos = float(torch.nn.functional.cosine_similarity(amp['grad'].double(), ref['grad'].double(), dim=0))
+    norm_ratio = float(amp['grad'].norm() / ref['grad'].norm().clamp(min=1e-12))
+    print('>> loss fp32: {:.6f}, amp: {:.6f}, rdiff: {:.2e}'.format(ref['loss'], amp['loss'], loss_rdiff))
+    print('>> e1 rdiff: {:.2e}, e2 rdiff: {:.2e}'.format(rdiff(amp['e1'], ref['e1']), rdiff(amp['e2'], ref['e2'])))
+    print('>> gradient cosine similarity: {:.6f}, norm ratio: {:.6f}'.format(cos, norm_ratio))
+    if not np.isfinite(amp['loss']) or loss_rdiff > args.tolerance:
+        raise Exception('Mixed precision loss differs from fp32 by {:.2e} (tolerance {:.2e})'.format(loss_rdiff, args.tolerance))
+    print('>> parity check passed')
@@ -0,0 +1,122 @@
+"""Benchmark the closed-form 2x2 Gauss-Newton solve of GNLoss.compute_gn_loss against batched torch.inverse/torch.det.
+
+The Jacobians and residuals are sampled from random feature maps of the sizes of the
+five levels. For every iteration of --mining_iterations (which sets topM), the forward
+and backward of the whole GNLoss on such feature maps is also timed with the exhaustive
+negative mining and with --coarse_to_fine. Run from the repository root, e.g.
+    python -m tools.bench_gn_solver --img_scale 2 --batch_size 1
+"""
+import time
+import argparse
+import torch
+import numpy as np
+
+from utils import batched_eye_like, inverse_det_2x2, extract_features, extract_gradients, normalize_
+from network.gn_loss import GNLoss
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--img_scale', type=int, default=2)
+parser.add_argument('--image_size', type=int, nargs=2, default=[768, 1024], help="original (height, width)")
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--num_matches', type=int, nargs='+', default=[1024, 2048, 4096, 8192])
+parser.add_argument('--repeats', type=int, default=20)
+parser.add_argument('--mining_iterations', type=int, nargs='*', default=[0, 20000, 60000],
+                    help="iterations of the top-M schedule at which the negative mining is timed, none to skip")
+parser.add_argument('--mining_matches', type=int, default=1024)
+parser.add_argument('--mining_repeats', type=int, default=3)
+
+CHANNELS = [256, 256, 512, 512, 512]
+SCALINGS = [4, 8, 8, 16, 16]
+
+
+def solve_batched(J, r, xs, ub):
+    """The former general path: batched torch.inverse and torch.det."""
+    J = torch.stack(J, dim=-1)
+    H = J.transpose(1, 2) @ J + 1e-9 * batched_eye_like(J, J.shape[2])
+    b = J.transpose(1, 2) @ r[..., None]
+    miu = xs[..., None] - torch.inverse(H) @ b
+    e1 = 0.5 * (ub[..., None] - miu).transpose(1, 2) @ H @ (ub[..., None] - miu)
+    log_det = torch.log(torch.clamp(torch.det(H), min=1e-16))
+    return e1.sum(), log_det.sum()
+
+
+def solve_closed_form(J, r, xs, ub):
+    """The closed-form path of compute_gn_loss."""
+    J_x, J_y = J
+    h00 = (J_x * J_x).sum(-1) + 1e-9
+    h01 = (J_x * J_y).sum(-1)
+    h11 = (J_y * J_y).sum(-1) + 1e-9
+    b0 = (J_x * r).sum(-1)
+    b1 = (J_y * r).sum(-1)
+    i00, i01, i11, det = inverse_det_2x2(h00, h01, h11)
+    d_x = ub[:, 0] - xs[:, 0] + (i00 * b0 + i01 * b1)
+    d_y = ub[:, 1] - xs[:, 1] + (i01 * b0 + i11 * b1)
+    e1 = 0.5 * (h00 * d_x * d_x + 2 * h01 * d_x * d_y + h11 * d_y * d_y)
+    return e1.sum(), torch.log(det).sum()
+
+
+def loss_step(loss_fn, F_a, F_b, corres, iteration):
+    """Forward and backward of GNLoss on fixed feature maps."""
+    torch.manual_seed(0)
+    loss = loss_fn(F_a, F_b, corres, iteration, True)[0]
+    loss.backward()
+    return loss.item()
+
+
+def timeit(fn, args, repeats, sync):
+    fn(*args)
+    sync()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn(*args)
+    sync()
+    return (time.perf_counter() - start) / repeats, out
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+    torch.manual_seed(0)
+    print('>> device: {}, img_scale: {}, batch_size: {}'.format(device, args.img_scale, args.batch_size))
+    print('{:>8} {:>6} {:>5} {:>10} {:>12} {:>12} {:>8} {:>10} {:>10}'.format(
+        'matches', 'level', 'C', 'HxW', 'batched ms', 'closed ms', 'speedup', 'e1 rdiff', 'e2 rdiff'))
+    with torch.no_grad():
+        for num_matches in args.num_matches:
+            for level, (C, scaling) in enumerate(zip(CHANNELS, SCALINGS)):
+                h = args.image_size[0] // (scaling * args.img_scale)
+                w = args.image_size[1] // (scaling * args.img_scale)
+                B, N = args.batch_size, num_matches
+                fb = torch.randn(B, C, h, w, device=device)
+                ub = torch.rand(B, N, 2, device=device) * torch.tensor([w - 1., h - 1.], device=device)
+                xs = ub + torch.empty_like(ub).uniform_(-1, 1)
+                f_t = normalize_(torch.randn(B * N, C, device=device))
+                r = normalize_(extract_features(fb, xs)) - f_t
+                J = extract_gradients(fb, xs)
+                xs, ub = xs.reshape(B * N, 2), ub.reshape(B * N, 2)
+                t_batched, (e1_b, e2_b) = timeit(solve_batched, (J, r, xs, ub), args.repeats, sync)
+                t_closed, (e1_c, e2_c) = timeit(solve_closed_form, (J, r, xs, ub), args.repeats, sync)
+                print('{:>8} {:>6} {:>5} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}x {:>10.2e} {:>10.2e}'.format(
+                    N, level, C, '{}x{}'.format(h, w), 1000 * t_batched, 1000 * t_closed, t_batched / t_closed,
+                    float(abs(e1_c - e1_b) / abs(e1_b)), float(abs(e2_c - e2_b) / np.maximum(abs(float(e2_b)), 1e-16))))
+
+    if args.mining_iterations:
+        B = args.batch_size
+        H, W = args.image_size
+        F_a, F_b = ([torch.randn(B, C, H // (scaling * args.img_scale), W // (scaling * args.img_scale),
+                                 device=device, requires_grad=True) for C, scaling in zip(CHANNELS, SCALINGS)]
+                    for _ in range(2))
+        size = torch.tensor([W - 1., H - 1.])
+        a = torch.rand(B, 4 * args.mining_matches, 2) * size
+        b = torch.minimum(torch.clamp(a + 8 * torch.randn_like(a), min=0), size)
+        corres = {'a': a.to(device), 'b': b.to(device)}
+        exhaustive = GNLoss(img_scale=args.img_scale, num_matches=args.mining_matches)
+        coarse_to_fine = GNLoss(img_scale=args.img_scale, num_matches=args.mining_matches, coarse_to_fine=True)
+        print('>> GNLoss forward and backward, {} matches'.format(args.mining_matches))
+        print('{:>10} {:>5} {:>15} {:>18} {:>8}'.format('iteration', 'topM', 'exhaustive ms', 'coarse-to-fine ms', 'speedup'))
+        for iteration in args.mining_iterations:
+            topM = int(np.clip(300 * np.exp(-iteration * 0.6 / 10000), a_min=5, a_max=None))
+            t_exhaustive, _ = timeit(loss_step, (exhaustive, F_a, F_b, corres, iteration), args.mining_repeats, sync)
+            t_coarse, _ = timeit(loss_step, (coarse_to_fine, F_a, F_b, corres, iteration), args.mining_repeats, sync)
+            print('{:>10} {:>5} {:>15.1f} {:>18.1f} {:>7.2f}x'.format(
+                iteration, topM, 1000 * t_exhaustive, 1000 * t_coarse, t_exhaustive / t_coarse))
@@ -1,10 +1,9 @@
 import numpy as np
 from PIL import Image
 from pathlib import Path
-from glob import glob 
 from corres_sampler import random_select_positive_matches
+from dataset.manifest import Manifest
 import scipy.io
-import h5py # for loading v7.3 .mat 
 
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import BatchSampler
@@ -49,7 +48,10 @@ def count():
         suffix  = 'correspondence_slice{}*.mat'.format(cmu_slice)
     else:
         suffix = '*.mat'
-    pair_files = glob(str(Path(pair_file_roots, suffix)))
+    # the manifest only re-reads .mat files changed since the last run
+    manifest = Manifest(pair_file_roots)
+    manifest.refresh()
+    pair_files = manifest.select(suffix)
     if not len(pair_files):
         raise Exception('No correspondence file found at {}'.format(pair_file_roots))
     if not cmu_slice_all:
@@ -57,51 +59,26 @@ def count():
     else:
         print (('>> Found {} image pairs for all slice').format(len(pair_files)))
     data['pair_file_names'] = pair_files
-    # print(pair_files)
 
     filename ='count.txt'
     with open(filename,'a') as file_object:
         file_object.write('total:'+' '+str(len(pair_files))+'\n\n')
 
-    N = len(data['pair_file_names']) # number of image pairs
-    image_pairs = {'a':[], 'b':[]}
-    corres_all_pos = {'a':[], 'b':[]}
-
     num = 0
-
-    # /public_data/cmu/images
-    # query_root = Path(self._data['root'], self._data['name'], self._data['image_folder'], self._data['slice_folder'], self._data['queries_folder'])
-    
     for f in data['pair_file_names']:
-        # pair_info = scipy.io.loadmat(f)
-        pair_info = h5py.File(f)
-        print(pair_info)
-        org_name_a = u''.join(chr(c) for c in pair_info['im_i_path'])
-        org_name_b = u''.join(chr(c) for c in pair_info['im_j_path'])
-        query_root = Path(data['root'], data['name'], data['image_folder'], (f.split('/')[-1]).split('_')[1], data['queries_folder'])
-        image_pairs['a'].append(Path(query_root, org_name_a.split('/')[-1]))
-        image_pairs['b'].append(Path(query_root, org_name_b.split('/')[-1]))
-        # corres_all_pos['a'].append(pair_info['pt_i'].value)
-        corres_all_pos['a'] = pair_info['pt_i'][()]
-        corres_all_pos['b'] = pair_info['pt_j'][()]  # N x 2
-        a = corres_all_pos['a'].squeeze()
-        b = corres_all_pos['b'].squeeze()
-
-        # print(len(a))
-        # print(len(b))
-        if len(a)<500:
+        entry = manifest[f]
+        org_name_a = entry['im_i_path']
+        org_name_b = entry['im_j_path']
+        if entry['num_matches']<500:
             num = num+1
             filename ='count.txt'
             with open(filename,'a') as file_object:
-                file_object.write('a:'+' '+ org_name_a + '\n' + 'b:'+' '+ org_name_b + '\n' + 'num:'+str(len(a))+'\n\n')
+                file_object.write('a:'+' '+ org_name_a + '\n' + 'b:'+' '+ org_name_b + '\n' + 'num:'+str(entry['num_matches'])+'\n\n')
     print(num)
     filename ='count.txt'
     with open(filename,'a') as file_object:
         file_object.write('count:'+' '+str(num)+'\n\n')
 
-    # data['image_pairs_name'] = image_pairs
-    # data['corres_pos_all'] = corres_all_pos
-
 
 if __name__ == '__main__':
     count()
\ No newline at end of file
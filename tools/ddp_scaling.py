@@ -0,0 +1,105 @@
+"""Report the training throughput of run.py --distributed for 1, 2, 4 and 8 worker processes.
+
+For every number of workers, the processes are spawned on this machine and join a process
+group (gloo on CPU, NCCL with one GPU per worker). Each worker trains the siamese model
+wrapped in DistributedDataParallel on its own fixed batch (random images and matches drawn
+from --seed plus its rank), so the per-worker load is constant and the total throughput
+should grow with the number of workers. On CPU, each worker gets its share of the cores.
+Run from the repository root, e.g.
+    python -m tools.ddp_scaling --workers 1 2 4 8 --image_size 192 256 --steps 10
+"""
+import os
+import copy
+import time
+import argparse
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from distributed import wrap_model
+from network.vgg_model import MyImageRetrievalModel
+from network.unet_model import EmbeddingNet
+from network.gnnet_model import GNNet
+from network.gn_loss import GNLoss
+from tools.amp_parity import fixed_batch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="numbers of worker processes to report")
+parser.add_argument('--device', type=str, default=None, choices=['cpu', 'cuda'], help="default: cuda if available")
+parser.add_argument('--threads', type=int, default=None, help="CPU threads per worker, default: the cores divided by the workers")
+parser.add_argument('--model', type=str, default='vgg16', choices=['vgg16', 'unet'])
+parser.add_argument('--image_size', type=int, nargs=2, default=[384, 512], help="(height, width) of the network input")
+parser.add_argument('--scale', type=int, default=2, help="Scaling factor for input image, as in run.py")
+parser.add_argument('--batch_size', type=int, default=1, help="batch size per worker")
+parser.add_argument('--num_matches', type=int, default=1024)
+parser.add_argument('--iteration', type=int, default=0, help="iteration of the top-M schedule of the negative mining")
+parser.add_argument('--warmup', type=int, default=2, help="untimed steps")
+parser.add_argument('--steps', type=int, default=10, help="timed steps")
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--port', type=int, default=29512)
+
+
+def worker(rank, world_size, args, results):
+    device = torch.device('cuda:{}'.format(rank) if args.device == 'cuda' else 'cpu')
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    else:
+        torch.set_num_threads(args.threads or max(os.cpu_count() // world_size, 1))
+    dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo', rank=rank, world_size=world_size)
+
+    torch.manual_seed(args.seed)
+    if args.model == 'vgg16':
+        embedding_net = MyImageRetrievalModel(pretrained_flag=False)
+    else:
+        embedding_net = EmbeddingNet()
+    model = wrap_model(GNNet(embedding_net).to(device).train(), rank if device.type == 'cuda' else None)
+    loss_fn = GNLoss(img_scale=args.scale, num_matches=args.num_matches)
+    optimizer = optim.AdamW(model.parameters(), lr=1e-6)
+    rank_args = copy.copy(args)
+    rank_args.seed = args.seed + rank
+    img_a, img_b, corres = fixed_batch(rank_args, device)
+
+    for i in range(args.warmup + args.steps):
+        if i == args.warmup:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            dist.barrier()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        F_a, F_b = model(img_a, img_b)
+        loss = loss_fn(F_a, F_b, corres, args.iteration, True)[0]
+        loss.backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    dist.barrier()
+    if rank == 0:
+        results.put((time.perf_counter() - start) / args.steps)
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+
+    print('>> device: {}, model: {}, input: {}x{}, batch_size per worker: {}, cores: {}'.format(
+        args.device, args.model, args.image_size[0], args.image_size[1], args.batch_size, os.cpu_count()))
+    print('{:>8} {:>10} {:>12} {:>10} {:>12}'.format('workers', 'step s', 'pairs/s', 'speedup', 'efficiency'))
+    base = None
+    for world_size in args.workers:
+        if args.device == 'cuda' and world_size > torch.cuda.device_count():
+            print('{:>8} skipped, {} GPUs'.format(world_size, torch.cuda.device_count()))
+            continue
+        results = mp.get_context('spawn').SimpleQueue()
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size)
+        elapsed = results.get()
+        throughput = world_size * args.batch_size / elapsed
+        if base is None:
+            # relative to the first configuration, per worker
+            base = throughput / world_size
+        print('{:>8} {:>10.3f} {:>12.2f} {:>10.2f} {:>12.2f}'.format(
+            world_size, elapsed, throughput, throughput / base, throughput / base / world_size))
@@ -0,0 +1,108 @@
+"""Check the rewritten sampling and mining kernels of utils.py against their straightforward versions.
+
+On random feature maps and matches drawn from --seed, compares
+    BilinearSample (extract_features) with the per-image bilinear_interpolation loop, forward and backward,
+    extract_gradients with np_gradient_filter followed by extract_features,
+    the tiled exact_negatives (under --mining_memory_mb) with one topk over the full distance matrix,
+    excluded_pixels with the dense pixel distance mask.
+The exclusion masks may differ at pixels exactly on the radius, where the dense distances
+round differently. Run from the repository root, e.g.
+    python -m tools.kernel_parity --size 96 128 --topM 300
+"""
+import argparse
+import torch
+
+from utils import (BilinearSample, extract_features, extract_gradients, bilinear_interpolation, np_gradient_filter,
+                   batch_pairwise_squared_distances, MyFunctionNegativeTripletSelector)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=int, nargs=2, default=[96, 128], help="(height, width) of the feature maps")
+parser.add_argument('--channels', type=int, default=64)
+parser.add_argument('--batch_size', type=int, default=2)
+parser.add_argument('--num_matches', type=int, default=256)
+parser.add_argument('--topM', type=int, default=300)
+parser.add_argument('--dist_threshold', type=float, default=0.2)
+parser.add_argument('--mining_memory_mb', type=float, default=1, help="small enough to mine over several tiles")
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--tolerance', type=float, default=1e-5, help="maximal relative difference of the float32 results")
+parser.add_argument('--max_mask_diff', type=float, default=1e-3, help="maximal fraction of differing excluded pixels")
+
+
+def reference_features(f, indices):
+    """extract_features before BilinearSample: one bilinear_interpolation per image."""
+    return torch.cat([bilinear_interpolation(f[b], indices[b]) for b in range(f.shape[0])], dim=1).transpose(0, 1)
+
+
+def reference_excluded(a2, dist_threshold, H, W):
+    """The dense mask of the pixels closer than dist_threshold*H to the matches, BxNx(H*W)."""
+    idx_1d = torch.arange(H * W)
+    idx_xy = torch.stack((idx_1d % W, idx_1d // W), dim=1)
+    p_dist = batch_pairwise_squared_distances(a2, idx_xy.repeat(a2.shape[0], 1, 1))
+    return p_dist < (dist_threshold * H) ** 2
+
+
+def rdiff(x, y):
+    x, y = x.detach(), y.detach()
+    return float((x - y).abs().max() / y.abs().max().clamp(min=1e-12))
+
+
+def check(name, value, tolerance):
+    print('>> {}: {:.2e}'.format(name, value))
+    if not value <= tolerance:
+        raise Exception('{} differs by {:.2e} (tolerance {:.2e})'.format(name, value, tolerance))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    generator = torch.Generator().manual_seed(args.seed)
+    B, C, N = args.batch_size, args.channels, args.num_matches
+    H, W = args.size
+    size = torch.tensor([W - 1., H - 1.])
+    points = torch.rand(B, N, 2, generator=generator) * size
+    # integer points and points on the border, where corners coincide or are clamped
+    points[:, :N // 8] = torch.floor(points[:, :N // 8])
+    points[:, N // 8:N // 4, 0] = W - 1
+    points = points.to(device)
+
+    # sampling, in double so that only the summation order can differ
+    f = torch.randn(B, C, H, W, generator=generator, dtype=torch.float64).to(device).requires_grad_()
+    grad_out = torch.randn(B * N, C, generator=generator, dtype=torch.float64).to(device)
+    ref = reference_features(f, points)
+    (ref_grad,) = torch.autograd.grad(ref, f, grad_out)
+    # extract_features casts to float32, BilinearSample keeps the dtype
+    out = BilinearSample.apply(f, points, (0, 0))
+    (out_grad,) = torch.autograd.grad(out, f, grad_out)
+    ref_float = reference_features(f.detach().float(), points)
+    check('sampling forward (float32)', rdiff(extract_features(f.detach().float(), points), ref_float), 0)
+    check('sampling forward (float64)', rdiff(out, ref), 0)
+    check('sampling backward (float64)', rdiff(out_grad, ref_grad), 1e-12)
+
+    # gradients at the sampled points
+    f32 = f.detach().float()
+    ref_x, ref_y = (extract_features(g, points) for g in np_gradient_filter(f32))
+    grad_x, grad_y = extract_gradients(f32, points)
+    check('gradient x', rdiff(grad_x, ref_x), args.tolerance)
+    check('gradient y', rdiff(grad_y, ref_y), args.tolerance)
+
+    # exclusion around the matches
+    selector = MyFunctionNegativeTripletSelector(0.2, 1, 1, mining_memory_mb=args.mining_memory_mb)
+    excluded = selector.excluded_pixels(points, args.dist_threshold, H, W)
+    mask = torch.zeros(B, N, H * W, dtype=torch.bool, device=device)
+    mask[excluded] = True
+    ref_mask = reference_excluded(points, args.dist_threshold, H, W).to(device)
+    differing = int((mask != ref_mask).sum())
+    print('>> excluded pixels: {}, reference: {}, differing: {}'.format(int(mask.sum()), int(ref_mask.sum()), differing))
+    check('excluded pixels differing (fraction)', differing / max(int(ref_mask.sum()), 1), args.max_mask_diff)
+
+    # tiled exact top-M against one topk over all pixels, with the same exclusion
+    e1 = torch.randn(B, N, C, generator=generator).to(device)
+    e2 = torch.randn(B, H * W, C, generator=generator).to(device)
+    dist = batch_pairwise_squared_distances(e1, e2)
+    dist[excluded] = 1e4
+    ref_dist, ref_idx = dist.topk(args.topM, dim=-1, largest=False)
+    best_dist, best_idx = selector.exact_negatives(e1, e2, excluded, args.topM, H, W)
+    same_idx = float((best_idx.sort(-1)[0] == ref_idx.sort(-1)[0]).float().mean())
+    print('>> top-M pixels equal to the reference: {:.4f}'.format(same_idx))
+    check('top-M distances', rdiff(best_dist, ref_dist), args.tolerance)
+    print('>> parity check passed')
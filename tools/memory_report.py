@@ -0,0 +1,112 @@
+"""Report the activation memory of one training step with and without activation checkpointing.
+
+The tensors saved for the backward pass are counted with saved_tensors_hooks, once for the
+siamese backbone forward and once for GNLoss. Tensors saved inside checkpointed blocks
+are dropped by the checkpointing and do not count. Every configuration is timed over a
+forward and backward pass, and on a GPU the peak allocated memory is reported too. Run
+from the repository root, e.g.
+    python -m tools.memory_report --image_size 768 1024 --scale 1 --blocks none all 0 1 2
+"""
+import time
+import argparse
+import torch
+
+from utils import get_amp_dtype
+from network.vgg_model import MyImageRetrievalModel
+from network.unet_model import EmbeddingNet
+from network.gnnet_model import GNNet
+from network.gn_loss import GNLoss
+from tools.amp_parity import fixed_batch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='vgg16', choices=['vgg16', 'unet'])
+parser.add_argument('--image_size', type=int, nargs=2, default=[384, 512], help="(height, width) of the network input")
+parser.add_argument('--scale', type=int, default=2, help="Scaling factor for input image, as in run.py")
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--num_matches', type=int, default=1024)
+parser.add_argument('--iteration', type=int, default=0, help="iteration of the top-M schedule of the negative mining")
+parser.add_argument('--amp', type=str, default=None, choices=['fp16', 'bf16'])
+parser.add_argument('--blocks',
+                    type=str,
+                    nargs='+',
+                    default=['none', 'all'],
+                    help="configurations to report: none, all, or a comma separated list of block indices")
+parser.add_argument('--seed', type=int, default=0)
+
+
+class SavedTensors(object):
+    """Sum of the sizes of the distinct storages saved for the backward pass."""
+    def __init__(self):
+        self.storages = {}
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    def hooks(self):
+        return torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack)
+
+    def nbytes(self):
+        return sum(self.storages.values())
+
+
+def parse_blocks(blocks):
+    if blocks == 'none':
+        return None
+    if blocks == 'all':
+        return []
+    return [int(block) for block in blocks.split(',')]
+
+
+def step(model, loss_fn, batch, args, amp_dtype, device):
+    img_a, img_b, corres = batch
+    model.zero_grad()
+    torch.manual_seed(args.seed)
+    saved_model, saved_loss = SavedTensors(), SavedTensors()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with saved_model.hooks():
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            F_a, F_b = model(img_a, img_b)
+    with saved_loss.hooks():
+        loss = loss_fn(F_a, F_b, corres, args.iteration, True)[0]
+    loss.backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated() if device.type == 'cuda' else None
+    return saved_model.nbytes(), saved_loss.nbytes(), elapsed, peak
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    amp_dtype = get_amp_dtype(args.amp, device)
+    torch.manual_seed(args.seed)
+    if args.model == 'vgg16':
+        embedding_net = MyImageRetrievalModel(pretrained_flag=False)
+    else:
+        embedding_net = EmbeddingNet()
+    model = GNNet(embedding_net).to(device).train()
+    loss_fn = GNLoss(img_scale=args.scale, num_matches=args.num_matches)
+    batch = fixed_batch(args, device)
+
+    print('>> device: {}, model: {}, input: {}x{}, batch_size: {}, autocast: {}'.format(
+        device, args.model, args.image_size[0], args.image_size[1], args.batch_size, amp_dtype))
+    for k, name in enumerate(embedding_net.checkpoint_block_names()):
+        print('>> block {}: {}'.format(k, name))
+    print('{:>16} {:>14} {:>14} {:>12} {:>10}'.format('checkpointed', 'backbone MB', 'loss MB', 'peak MB', 'step s'))
+    for blocks in args.blocks:
+        embedding_net.set_checkpoint_blocks(parse_blocks(blocks))
+        # the first step warms up the allocator
+        step(model, loss_fn, batch, args, amp_dtype, device)
+        saved_model, saved_loss, elapsed, peak = step(model, loss_fn, batch, args, amp_dtype, device)
+        print('{:>16} {:>14.1f} {:>14.1f} {:>12} {:>10.3f}'.format(
+            blocks, saved_model / 1024 ** 2, saved_loss / 1024 ** 2,
+            '-' if peak is None else '{:.1f}'.format(peak / 1024 ** 2), elapsed))
@@ -0,0 +1,24 @@
+"""Pack all correspondence .mat files of a dataset into a single store.
+
+Run once from the repository root, e.g.
+    python -m tools.pack_correspondences --pair_info_dir data/cmu/correspondence --store_dir data/cmu/corres_store
+and train with `run.py --corres_store data/cmu/corres_store`.
+"""
+import argparse
+from glob import glob
+from pathlib import Path
+
+from dataset.corres_store import pack_correspondences
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pair_info_dir', type=str, required=True)
+parser.add_argument('--store_dir', type=str, required=True)
+parser.add_argument('--num_workers', '-n', type=int, default=8, help="Number of reader processes")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    pair_files = sorted(glob(str(Path(args.pair_info_dir, '*.mat'))))
+    if not len(pair_files):
+        raise Exception('No correspondence file found at {}'.format(args.pair_info_dir))
+    pack_correspondences(pair_files, args.store_dir, num_workers=args.num_workers)
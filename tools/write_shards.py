@@ -0,0 +1,67 @@
+"""Write the image pairs of a dataset into sequential shard files.
+
+The train/val split is the same as the one of run.py. Run from the repository root, e.g.
+    python -m tools.write_shards --dataset_name cmu --pair_info_folder correspondence/urban --shard_folder data/cmu/shards/urban
+and train with `run.py --shard_folder data/cmu/shards/urban`.
+"""
+import os
+import json
+import argparse
+import torch
+
+from dataset.cmu_dataset import CMUDataset
+from dataset.robotcar_dataset import RobotcarDataset
+from dataset.shard_dataset import write_shards
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset_name', type=str, default='cmu')
+parser.add_argument('--dataset_root', type=str, default='./data')
+parser.add_argument('--dataset_image_folder', type=str, default='images')
+parser.add_argument('--pair_info_folder', type=str, default='correspondence')
+parser.add_argument('--query_folder', type=str, default='query')
+parser.add_argument('--corres_store', type=str, default=None)
+parser.add_argument('--all_slice', type=bool, default=True)
+parser.add_argument('--slice', type=int, default=7)
+parser.add_argument('--robotcar_all_weather', type=bool, default=True)
+parser.add_argument('--robotcar_weather', type=str, default='sun')
+parser.add_argument('--shard_folder', type=str, required=True)
+parser.add_argument('--shard_size_mb', type=int, default=256)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.dataset_name == 'cmu':
+        dataset = CMUDataset(root=args.dataset_root,
+                             name=args.dataset_name,
+                             image_folder=args.dataset_image_folder,
+                             pair_info_folder=args.pair_info_folder,
+                             cmu_slice_all=args.all_slice,
+                             cmu_slice=args.slice,
+                             queries_folder=args.query_folder,
+                             transform=False,
+                             img_scale=1,
+                             corres_store=args.corres_store)
+    else:
+        dataset = RobotcarDataset(root=args.dataset_root,
+                                  name=args.dataset_name,
+                                  image_folder=args.dataset_image_folder,
+                                  pair_info_folder=args.pair_info_folder,
+                                  queries_folder=args.query_folder,
+                                  robotcar_weather_all=args.robotcar_all_weather,
+                                  robotcar_weather=args.robotcar_weather,
+                                  transform=False,
+                                  img_scale=1,
+                                  corres_store=args.corres_store)
+
+    # same split as run.py
+    num_valset = round(0.1 * len(dataset))
+    torch.manual_seed(0)
+    trainset, valset = torch.utils.data.random_split(dataset, [len(dataset) - num_valset, num_valset])
+
+    index = {}
+    for split, subset in (('train', trainset), ('val', valset)):
+        index[split] = write_shards(dataset, subset.indices, args.shard_folder, split,
+                                    shard_size=args.shard_size_mb * 1024 ** 2)
+        print('>> Wrote {} {} pairs into {} shards'.format(len(subset), split, len(index[split])))
+    with open(os.path.join(args.shard_folder, 'index.json'), 'w') as f:
+        json.dump(index, f)
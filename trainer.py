@@ -2,13 +2,18 @@ import torch
 import numpy as np
 import torch.nn as nn
 import os, copy
-import matplotlib.pyplot as plt
-from utils import save_checkpoint, get_lr
+from utils import get_lr, get_rng_state, set_rng_state
+from prefetcher import Prefetcher
+from metrics import MetricAccumulator
+from logger import plot_losses
+from checkpointing import CheckpointWriter
+from distributed import is_main_process, get_rank, get_world_size, unwrap_model, broadcast_parameters, all_reduce_mean, gather_to_main
 from tqdm import tqdm
 # import wandb
 from tensorboardX import SummaryWriter
 cuda = torch.cuda.is_available()
-device = torch.device("cuda:0" if cuda else "cpu")
+# the current CUDA device, set per process in a distributed run
+device = torch.device("cuda" if cuda else "cpu")
 
 
 def fit(train_loader,
@@ -24,7 +29,14 @@ def fit(train_loader,
         save_root,
         init,
         writer,
-        start_epoch=0):
+        start_epoch=0,
+        input_transform=None,
+        amp_dtype=None,
+        scaler=None,
+        log_histograms=False,
+        checkpoints=None,
+        save_interval=0,
+        resume=None):
     """
     Loaders, model, loss function and metrics should work together for a given task,
     i.e. The model should be able to process data output of loaders,
@@ -32,10 +44,25 @@ def fit(train_loader,
     Examples: Classification: batch loader, classification model, NLL loss, accuracy metric
     Siamese network: Siamese loader, siamese model, contrastive loss
     Online triplet learning: batch loader, embedding model, online triplet loss
+    input_transform: applied to the image batches on the device, e.g. BatchNormalize for cached uint8 images
+    amp_dtype: autocast dtype of the model forward (torch.float16 or torch.bfloat16), None for fp32
+    scaler: GradScaler of the fp16 gradients, None or disabled otherwise
+    writer: logger.AsyncWriter, the events and the loss figure are written by its background thread
+    log_histograms: write histograms of the model parameters after every epoch
+    checkpoints: CheckpointWriter the checkpoints are saved with, one writing to save_root (closed at the end) if None
+    save_interval: also save a checkpoint every save_interval iterations within the epochs, 0 for none
+    resume: checkpoint saved within the epoch start_epoch, the epoch is continued at the next batch
+    In a distributed run, model is the DistributedDataParallel module and the epoch means are averaged
+    over the processes. Checkpoints and validation are done by rank 0 only, the other processes get a
+    logger.NullWriter.
     """
     best_loss = 100000
     if not os.path.exists(save_root):
         os.makedirs(save_root)
+    main = is_main_process()
+    own_checkpoints = checkpoints is None and main
+    if own_checkpoints:
+        checkpoints = CheckpointWriter(save_root)
 
     val_x = []
     val_y = []
@@ -50,6 +77,9 @@ def fit(train_loader,
     iteration = 0
     for epoch in range(start_epoch, n_epochs):
         iteration = epoch*len(train_loader)
+        epoch_resume = resume if epoch == start_epoch else None
+        if epoch_resume is not None:
+            iteration += epoch_resume['position']
         '''
         UserWarning: Detected call of `lr_scheduler.step()` before `optimizer.step()`. 
         In PyTorch 1.1.0 and later, you should call them in the opposite order: `optimizer.step()` before `lr_scheduler.step()`.  
@@ -69,7 +99,16 @@ def fit(train_loader,
             epoch,
             init,
             iteration,
-            writer)
+            writer,
+            input_transform,
+            amp_dtype,
+            scaler,
+            checkpoints,
+            scheduler,
+            save_interval,
+            epoch_resume)
+        train_loss, total_contras_loss, total_gnloss, train_triplet_level, train_gn_level, train_e1, train_e2, total_loss_pos_mean_level, total_loss_neg_mean_level = all_reduce_mean(
+            [train_loss, total_contras_loss, total_gnloss, train_triplet_level, train_gn_level, train_e1, train_e2, total_loss_pos_mean_level, total_loss_neg_mean_level])
         train_x.append(epoch + 1)
         train_y.append(train_loss)
         train_y_contras.append(total_contras_loss)
@@ -80,15 +119,22 @@ def fit(train_loader,
             epoch + 1, n_epochs, train_loss, total_contras_loss, total_gnloss)
         message += ' Lr:{}'.format(get_lr(optimizer))
         # writer.add_scalar('train_loss', train_loss, epoch + 1)
+        writer.add_level_scalars('train_triplet_loss', train_triplet_level, epoch + 1)
+        writer.add_level_scalars('train_gn_loss', train_gn_level, epoch + 1)
+        writer.add_level_scalars('train_pos_mean', total_loss_pos_mean_level, epoch + 1)
+        writer.add_level_scalars('train_neg_mean', total_loss_neg_mean_level, epoch + 1)
+        if log_histograms:
+            for name, param in unwrap_model(model).named_parameters():
+                writer.add_histogram('weights/' + name, param, epoch + 1)
         # Validate stage
-        if val_loader and (epoch % validation_frequency == 0):
+        if val_loader and main and (epoch % validation_frequency == 0):
             val_loss, val_contras_loss, val_gnloss, val_triplet_level, val_gn_level, val_e1, val_e2 = test_epoch(
-                val_loader, model, loss_fn, cuda, epoch)
+                val_loader, unwrap_model(model), loss_fn, cuda, epoch, input_transform, amp_dtype)
             val_loss /= len(val_loader)
             val_contras_loss /= len(val_loader)
             val_gnloss /= len(val_loader)
-            val_triplet_level = [item / len(val_loader) for item in val_triplet_level]
-            val_gn_level = [item / len(val_loader) for item in val_gn_level]
+            val_triplet_level = val_triplet_level / len(val_loader)
+            val_gn_level = val_gn_level / len(val_loader)
             val_e1 /= len(val_loader)
             val_e2 /= len(val_loader)
 
@@ -96,6 +142,8 @@ def fit(train_loader,
             val_y.append(val_loss)
             val_y_contras.append(val_contras_loss)
             val_y_gn.append(val_gnloss)
+            writer.add_level_scalars('val_triplet_loss', val_triplet_level, epoch + 1)
+            writer.add_level_scalars('val_gn_loss', val_gn_level, epoch + 1)
 
             message += '\nEpoch: {}/{}. Validation set: Average loss: {:.4f}\ttriplet loss: {:.6f}\tgn loss: {:.6f}'.format(
                 epoch + 1, n_epochs, val_loss, val_contras_loss, val_gnloss)
@@ -104,75 +152,83 @@ def fit(train_loader,
             if val_loss < best_loss:
                 best_loss = val_loss
                 # best_model_wts = copy.deepcopy(model.state_dict())
-                save_checkpoint(model.state_dict(), optimizer.state_dict(), scheduler.state_dict(), True, save_root, epoch)
+                checkpoints.save(unwrap_model(model), optimizer, scheduler, epoch, is_best=True, extra=training_state(train_loader, scaler=scaler))
                 message += '\nSaving best model ...'
 
         # save the model for every 20 epochs
-        if (epoch % (n_epochs / 10)) == 0:
+        if main and (epoch % (n_epochs / 10)) == 0:
             message += '\nSaving checkpoint ... \n'
-            save_checkpoint(model.state_dict(), optimizer.state_dict(), scheduler.state_dict(), False, save_root, epoch)
-        print(message)
-
-        # draw loss figures
-        plt.figure(figsize=(12, 8))
-        plt.subplot(2, 1, 1)
-        plt.title("train_val_loss_pic")
-        plt.plot(val_x, val_y, "-s", label='val_total')
-        plt.plot(train_x, train_y, "+-", label='train_total')
-        plt.legend(bbox_to_anchor=(1.0, 1), loc=1, borderaxespad=0.)
-
-        plt.subplot(2, 2, 3)
-        plt.title("triplet_loss")
-        plt.plot(val_x, val_y_contras, "-s", label='val_triplet')
-        plt.plot(train_x, train_y_contras, "+-", label='train_triplet')
-
-        plt.subplot(2, 2, 4)
-        plt.title("gn_loss")
-        plt.plot(val_x, val_y_gn, "-s", label='val_gn')
-        plt.plot(train_x, train_y_gn, "+-", label='train_gn')
-        plt.savefig("./train_val_loss_pic.png")
-        plt.close()
+            checkpoints.save(unwrap_model(model), optimizer, scheduler, epoch, extra=training_state(train_loader, scaler=scaler))
+        if main:
+            print(message)
+
+        # draw loss figures in the writer thread, from copies of the curves
+        writer.plot(plot_losses, "./train_val_loss_pic.png", list(train_x), list(train_y), list(train_y_contras), list(train_y_gn),
+                    list(val_x), list(val_y), list(val_y_contras), list(val_y_gn))
+
+    if own_checkpoints:
+        checkpoints.close()
 
 
 def train_epoch(val_loader, train_loader, model, loss_fn, optimizer, cuda,
-                log_interval, save_root, epoch, init, iteration, writer):
+                log_interval, save_root, epoch, init, iteration, writer, input_transform=None, amp_dtype=None, scaler=None,
+                checkpoints=None, scheduler=None, save_interval=0, resume=None):
+    '''
+    iteration: the iteration of the first step, the epoch start plus the steps already done when resuming
+    resume: checkpoint saved within this epoch, see training_state
+    checkpoints: None in the processes other than rank 0 of a distributed run, which do not save
+    '''
+    main = is_main_process()
     # initialize network parameters, oscillates a lot here. not good
-    if init and epoch == 0:
+    if init and epoch == 0 and resume is None:
         for m in model.modules():
             if isinstance(m, nn.Conv2d):
                 nn.init.xavier_normal_(m.weight.data)
                 m.bias.data.fill_(0)
+        # the processes of a distributed run start from the weights of rank 0
+        broadcast_parameters(model)
 
     model.train()
 
-    total_contras_level = [0,0,0,0]
-    total_gnloss_level = [0,0,0,0]
-    total_loss_pos_mean_level = [0,0,0,0]
-    total_loss_neg_mean_level = [0,0,0,0]
-
-    total_loss = 0
-    total_contras_loss = 0
-    total_gnloss = 0
-    total_e1 = 0
-    total_e2 = 0
+    # the losses stay on the device and are only read back every log_interval steps
+    metrics = MetricAccumulator(['loss', 'triplet', 'gn', 'e1', 'e2'])
+    # the distributed samplers shuffle by epoch, the datasets (also behind the Subset of random_split)
+    # seed their shard order and sampled matches with it
+    for source in (train_loader.sampler, train_loader.dataset, getattr(train_loader.dataset, 'dataset', None)):
+        if hasattr(source, 'set_epoch'):
+            source.set_epoch(epoch)
+    skip = 0
+    if resume is not None:
+        # continue the running means, the shuffled order and the random streams of the interrupted epoch,
+        # those of this process in a distributed run
+        rank_states = resume.get('rank_states', [resume])
+        if len(rank_states) != get_world_size():
+            raise Exception('The checkpoint was saved by {} processes, resumed by {}'.format(len(rank_states), get_world_size()))
+        metrics.load_state_dict(rank_states[get_rank()]['metrics_state_dict'])
+        # before the loader is started, the data loading does not draw from these generators
+        set_rng_state(rank_states[get_rank()]['rng_state'])
+        if 'sampler_state_dict' in resume:
+            train_loader.sampler.load_state_dict(resume['sampler_state_dict'])
+        else:
+            # streamed datasets have no sampler, the consumed batches are read again but not trained on
+            skip = resume['position']
+    start_iteration = iteration - metrics.steps
 
     imgA = []
     imgB = []
-    loader = tqdm(train_loader)
+    # the next batch is fetched and copied to the device while the current step computes
+    # the batches of a restored order start at the resumed position
+    loader = tqdm(Prefetcher(train_loader, device if cuda else 'cpu'), initial=metrics.steps - skip, disable=not main)
     for batch_idx, (img_ab, corres_ab) in enumerate(loader):
-        corres_ab = corres_ab if len(corres_ab) > 0 else None
-        if not type(img_ab) in (tuple, list):
-            img_ab = (img_ab, )
-        if cuda:
-            img_ab = tuple(d.to(device) for d in img_ab)
-            if corres_ab is not None:
-                corres_ab = {
-                    key: corres_ab[key].to(device)
-                    for key in corres_ab
-                }
+        if batch_idx < skip:
+            continue
+        if input_transform is not None:
+            img_ab = tuple(input_transform(d) for d in img_ab)
 
         optimizer.zero_grad()
-        outputs = model(*img_ab)
+        # the backbone runs in mixed precision, GNLoss evaluates the loss in fp32
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            outputs = model(*img_ab)
 
         if type(outputs) not in (tuple, list):
             outputs = (outputs, )
@@ -197,76 +253,95 @@ def train_epoch(val_loader, train_loader, model, loss_fn, optimizer, cuda,
         gnloss = gnloss_outputs[0] if type(gnloss_outputs) in (
             tuple, list) else gnloss_outputs
 
-        total_loss += loss.item()
-        total_contras_loss += contras_loss.item()
-        total_gnloss += gnloss.item()
-        total_e1 += e1.item()
-        total_e2 += e2.item()
-
-
-        loader.set_description("Iteration: {}, Train loss: {:.4f}, triplet: {:.6f}, gn: {:.6f}".format(iteration, total_loss / (batch_idx + 1), total_contras_loss / (batch_idx + 1), total_gnloss / (batch_idx + 1)))
-        loader.refresh()
-        
-        writer.add_scalar('train_loss_per_iter', total_loss / (batch_idx + 1), iteration)
-        writer.add_scalar('triplet_loss_per_iter', total_contras_loss / (batch_idx + 1), iteration)
-        writer.add_scalar('gn_loss_per_iter', total_gnloss / (batch_idx + 1), iteration)
+        # the per-level losses are already detached by the loss function
+        metrics.add(loss, contras_loss, gnloss, e1, e2,
+                    contras_level=contrasloss_level, gn_level=gnloss_level,
+                    pos_mean_level=loss_pos_mean_level, neg_mean_level=loss_neg_mean_level)
+        if metrics.steps % log_interval == 0:
+            write_train_metrics(metrics, writer, loader, start_iteration)
+        # recall of the approximate negative mining, measured every recall_interval iterations
+        mining_metrics = getattr(getattr(loss_fn, 'pair_selector', None), 'metrics', None)
+        if mining_metrics:
+            for key, value in mining_metrics.items():
+                writer.add_scalar('mining/' + key, value, iteration)
+            mining_metrics.clear()
         
-        for i in range(4):
-            total_contras_level[i] += contrasloss_level[i]
-            total_gnloss_level[i] += gnloss_level[i]
-            total_loss_pos_mean_level[i] += loss_pos_mean_level[i]
-            total_loss_neg_mean_level[i] += loss_neg_mean_level[i]
-
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
+
+        if save_interval and iteration % save_interval == 0:
+            # snapshot within the epoch, written in the background. The running means are synced
+            # into the checkpoint, so the pending steps are logged first
+            write_train_metrics(metrics, writer, loader, start_iteration)
+            state = training_state(train_loader, metrics, scaler)
+            # the running means and random streams of every process of a distributed run
+            rank_states = gather_to_main({key: state[key] for key in ('rng_state', 'metrics_state_dict')})
+            if get_world_size() > 1 and main:
+                state['rank_states'] = rank_states
+            if checkpoints is not None:
+                checkpoints.save(unwrap_model(model), optimizer, scheduler, epoch, iteration=iteration, extra=state)
 
         del img_ab
         del corres_ab
-        torch.cuda.empty_cache()
-
-    total_loss /= (batch_idx + 1)
-    total_contras_loss /= (batch_idx + 1)
-    total_gnloss /= (batch_idx + 1)
-    total_contras_level = [item / (batch_idx + 1) for item in total_contras_level]
-    total_gnloss_level = [item / (batch_idx + 1) for item in total_gnloss_level]
-    total_loss_pos_mean_level= [item / (batch_idx + 1) for item in total_loss_pos_mean_level]
-    total_loss_neg_mean_level= [item / (batch_idx + 1) for item in total_loss_neg_mean_level]
-    total_e1 /= (batch_idx + 1)
-    total_e2 /= (batch_idx + 1)
 
-    return total_loss, total_contras_loss, total_gnloss, total_contras_level, total_gnloss_level, total_e1, total_e2, total_loss_pos_mean_level, total_loss_neg_mean_level
+    write_train_metrics(metrics, writer, loader, start_iteration)
+    means = metrics.means()
+    return means['loss'], means['triplet'], means['gn'], metrics.tensor_mean('contras_level'), metrics.tensor_mean('gn_level'), \
+        means['e1'], means['e2'], metrics.tensor_mean('pos_mean_level'), metrics.tensor_mean('neg_mean_level')
+
+
+def training_state(train_loader, metrics=None, scaler=None):
+    '''
+    the state saved with the checkpoints besides the model, optimizer and scheduler.
+    With the metrics of a running epoch, it also holds the number of steps done in the epoch
+    ('position'), their running means and the shuffled order of the train loader.
+    '''
+    state = {'rng_state': get_rng_state()}
+    if scaler is not None and scaler.is_enabled():
+        state['scaler_state_dict'] = scaler.state_dict()
+    if metrics is not None:
+        state['position'] = metrics.steps
+        state['metrics_state_dict'] = metrics.state_dict()
+        if hasattr(train_loader.sampler, 'state_dict'):
+            state['sampler_state_dict'] = train_loader.sampler.state_dict(metrics.steps * train_loader.batch_size)
+    return state
+
+
+def write_train_metrics(metrics, writer, loader, start_iteration):
+    '''write the running means of the steps since the last call, start_iteration is the iteration before the first step of the epoch'''
+    steps = metrics.sync()
+    for step, means in steps:
+        writer.add_series('train_loss_per_iter', means['loss'], start_iteration + step)
+        writer.add_series('triplet_loss_per_iter', means['triplet'], start_iteration + step)
+        writer.add_series('gn_loss_per_iter', means['gn'], start_iteration + step)
+    if len(steps):
+        step, means = steps[-1]
+        # the running means per level, read back by the writer thread
+        writer.add_level_scalars('triplet_loss_per_iter', metrics.tensor_mean('contras_level'), start_iteration + step)
+        writer.add_level_scalars('gn_loss_per_iter', metrics.tensor_mean('gn_level'), start_iteration + step)
+        loader.set_description("Iteration: {}, Train loss: {:.4f}, triplet: {:.6f}, gn: {:.6f}".format(start_iteration + step, means['loss'], means['triplet'], means['gn']))
+        loader.refresh()
 
 
-def test_epoch(val_loader, model, loss_fn, cuda, epoch):
+def test_epoch(val_loader, model, loss_fn, cuda, epoch, input_transform=None, amp_dtype=None):
     with torch.no_grad():
         model.eval()
-        val_loss = 0
-        val_contras_loss = 0
-        val_gnloss = 0
-        val_e1 = 0
-        val_e2 = 0
-        # added
-        total_contras_level = [0,0,0,0]
-        total_gnloss_level = [0,0,0,0]
+        metrics = MetricAccumulator(['loss', 'triplet', 'gn', 'e1', 'e2'])
 
         imgA = []
         imgB = []
 
-        for batch_idx, (img_ab, corres_ab) in enumerate(val_loader):
-            corres_ab = corres_ab if len(corres_ab) > 0 else None
-            if not type(img_ab) in (tuple, list):
-                img_ab = (img_ab, )
-            if cuda:
-                img_ab = tuple(d.to(device) for d in img_ab)
-                if corres_ab is not None:
-                    corres_ab = {
-                        key: corres_ab[key].to(device)
-                        for key in corres_ab
-                    }
-                    # for c in corres_ab:
-                    #     c = {key: c[key].to(device) for key in c}
+        for batch_idx, (img_ab, corres_ab) in enumerate(Prefetcher(val_loader, device if cuda else 'cpu')):
+            if input_transform is not None:
+                img_ab = tuple(input_transform(d) for d in img_ab)
 
-            outputs = model(*img_ab)
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(*img_ab)
 
             if type(outputs) not in (tuple, list):
                 outputs = (outputs, )
@@ -289,14 +364,8 @@ def test_epoch(val_loader, model, loss_fn, cuda, epoch):
             gnloss = gnloss_outputs[0] if type(gnloss_outputs) in (
                 tuple, list) else gnloss_outputs
 
-            val_loss += loss.item()
-            val_contras_loss += contras_loss.item()
-            val_gnloss += gnloss.item()
-            val_e1 += e1.item()
-            val_e2 += e2.item()
-
-            for i in range(4):
-                total_contras_level[i] += contrasloss_level[i]
-                total_gnloss_level[i] += gnloss_level[i]
+            metrics.add(loss, contras_loss, gnloss, e1, e2, contras_level=contrasloss_level, gn_level=gnloss_level)
 
-    return val_loss, val_contras_loss, val_gnloss, contrasloss_level, gnloss_level, val_e1, val_e2
\ No newline at end of file
+    # the sums over the validation set, read back once
+    sums = metrics.totals_dict()
+    return sums['loss'], sums['triplet'], sums['gn'], metrics.tensor_sum('contras_level'), metrics.tensor_sum('gn_level'), sums['e1'], sums['e2']
\ No newline at end of file
@@ -1,13 +1,14 @@
 from itertools import combinations
 from enum import Enum
-import shutil, os
+import random
 import numpy as np
 import torch
 import torch.nn.functional as F
+from negative_mining import MAX_WINDOW_FRACTION, window_side, window_candidates, candidate_search, MemoryBank
 # import wandb
 # import torchsnooper
 cuda = torch.cuda.is_available()
-device = torch.device("cuda:0" if cuda else "cpu")
+device = torch.device("cuda" if cuda else "cpu")
 
 def get_pdist(data1, data2, requre_sqrt):
     # data1, data2: BxNx2
@@ -75,20 +76,108 @@ def batched_eye_like(x, n):
     return torch.eye(n).to(x)[None].repeat(len(x), 1, 1)
 
 
-def extract_features(f, indices):
+def inverse_det_2x2(h00, h01, h11, min_det=1e-16):
+    """Closed-form inverse and determinant of a batch of symmetric 2x2 matrices [[h00, h01], [h01, h11]].
+
+    The determinant is clamped to min_det (the matrices are positive semi-definite),
+    which also keeps the inverse finite for degenerate matrices.
+    Returns:
+        The inverse entries (i00, i01, i11) and the clamped determinant.
+    """
+    det = torch.clamp(h00 * h11 - h01 * h01, min=min_det)
+    return h11 / det, -h01 / det, h00 / det, det
+
+
+def extract_features(f, indices, offset=(0, 0)):
     '''
     f: BxCxHxW
     indicies: BxNx2
+    offset: optional integer (dx, dy) shift of the bilinear corners, see BilinearSample
+    return: (BxN)xC features bilinearly sampled at indices, see BilinearSample
     '''
-    # B, C, H, W = f.shape
-    # N = indices.shape[1]
-    for b in range(f.shape[0]):
-        f_bth = bilinear_interpolation(f[b, :, :, :], indices[b, :, :])
-        if not b:
-            f_2d = f_bth
-        else:
-            f_2d = torch.cat((f_2d, f_bth), dim=1)
-    return f_2d.transpose(0, 1).type(torch.float32)
+    return BilinearSample.apply(f, indices, tuple(offset)).type(torch.float32)
+
+
+def extract_gradients(f, indices):
+    '''
+    Sample np_gradient_filter(f) at indices without filtering the whole feature map.
+    The central differences are taken between the features of the neighbouring corners,
+    outside the map they are zero like the zero padding of the filter.
+    f: BxCxHxW
+    indicies: BxNx2
+    return: the (BxN)xC x and y gradients
+    '''
+    grad_x = 0.5 * (extract_features(f, indices, (1, 0)) - extract_features(f, indices, (-1, 0)))
+    grad_y = 0.5 * (extract_features(f, indices, (0, 1)) - extract_features(f, indices, (0, -1)))
+    return grad_x, grad_y
+
+
+def _bilinear_corners(idx, H, W, offset=(0, 0)):
+    """Flat indices and weights of the 4 corners of BxNx2 sample points, same as bilinear_interpolation.
+
+    Integer coordinates have floor == ceil, so all weights are 0 there.
+    With an offset the corners are shifted by (dx, dy) after clamping them to the map,
+    shifted corners outside the map get weight 0.
+    """
+    x = idx[..., 0]
+    y = idx[..., 1]
+    x0 = torch.clamp(torch.floor(x), 0, W - 1)
+    y0 = torch.clamp(torch.floor(y), 0, H - 1)
+    x1 = torch.clamp(torch.ceil(x), 0, W - 1)
+    y1 = torch.clamp(torch.ceil(y), 0, H - 1)
+    weights = ((x1 - x) * (y1 - y), (x1 - x) * (y - y0), (x - x0) * (y1 - y), (x - x0) * (y - y0))
+    x0, y0, x1, y1 = x0.long(), y0.long(), x1.long(), y1.long()
+    dx, dy = offset
+    if dx or dy:
+        x0, x1, y0, y1 = x0 + dx, x1 + dx, y0 + dy, y1 + dy
+        inside = [((cx >= 0) & (cx < W) & (cy >= 0) & (cy < H)).to(x)
+                  for cx, cy in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))]
+        weights = tuple(weight * valid for weight, valid in zip(weights, inside))
+        x0, x1 = torch.clamp(x0, 0, W - 1), torch.clamp(x1, 0, W - 1)
+        y0, y1 = torch.clamp(y0, 0, H - 1), torch.clamp(y1, 0, H - 1)
+    corners = (y0 * W + x0, y0 * W + x1, y1 * W + x0, y1 * W + x1)
+    return corners, weights
+
+
+class BilinearSample(torch.autograd.Function):
+    """Batched bilinear_interpolation of a BxCxHxW feature map at BxNx2 (x, y) points, returns (BxN)xC.
+
+    Everything stays on the device of the feature map. Only the points are kept for
+    backward, the corner indices and weights are recomputed there and the gradient is
+    scattered back into the feature map. The points are treated as constants.
+    """
+    @staticmethod
+    def forward(ctx, f, idx, offset=(0, 0)):
+        B, C, H, W = f.shape
+        N = idx.shape[1]
+        idx = idx.to(f.device)
+        corners, weights = _bilinear_corners(idx, H, W, offset)
+        f_flat = f.reshape(B, C, H * W)
+        out = None
+        for corner, weight in zip(corners, weights):
+            term = weight[:, None, :] * f_flat.gather(2, corner[:, None, :].expand(B, C, N))
+            out = term if out is None else out + term
+        ctx.save_for_backward(idx)
+        ctx.shape = (B, C, H, W)
+        ctx.offset = offset
+        ctx.f_dtype = f.dtype
+        return out.transpose(1, 2).reshape(B * N, C)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        idx, = ctx.saved_tensors
+        B, C, H, W = ctx.shape
+        N = idx.shape[1]
+        grad_f = None
+        if ctx.needs_input_grad[0]:
+            corners, weights = _bilinear_corners(idx, H, W, ctx.offset)
+            grad_out = grad_out.reshape(B, N, C).transpose(1, 2)
+            grad_f = torch.zeros((B, C, H * W), dtype=ctx.f_dtype, device=grad_out.device)
+            for corner, weight in zip(corners, weights):
+                grad_f.scatter_add_(2, corner[:, None, :].expand(B, C, N), (weight[:, None, :] * grad_out).to(ctx.f_dtype))
+            grad_f = grad_f.view(B, C, H, W)
+        return grad_f, None, None
+
 
 def extract_features_int(f, indices):
     '''
@@ -108,6 +197,7 @@ def extract_features_int(f, indices):
 
 
 def bilinear_interpolation(grid, idx):
+    # per-image reference of BilinearSample
     # grid: C x H x W
     # idx: N x 2
     _, H, W = grid.shape
@@ -159,50 +249,255 @@ def np_gradient_filter(f):
     return f_gradx, f_grady
 
 
-def save_checkpoint(model_state,
-                    optimizer_state,
-                    scheduler_state,
-                    is_best,
-                    path,
-                    epoch,
-                    filename='checkpoint.pth.tar'):
-    prefix = str(epoch)
-    prefix_save = os.path.join(path, prefix)
-    name = prefix_save + '_' + filename
-    # torch.save(state, name)
-    torch.save({
-            'epoch': epoch,
-            'model_state_dict': model_state,
-            'optimizer_state_dict': optimizer_state,
-            'scheduler_state_dict': scheduler_state
-            }, name)
-    if is_best:
-        shutil.copyfile(name, prefix_save + '_model_best.pth.tar')
-
-
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group['lr']
 
 
+def get_rng_state():
+    '''the states of the torch (CPU and CUDA), numpy and python random number generators, storable with torch.save'''
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'python': random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    '''restore the states of get_rng_state'''
+    torch.set_rng_state(state['torch'].cpu())
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def get_amp_dtype(amp, device):
+    '''
+    amp: None, 'fp16' or 'bf16'
+    returns the autocast dtype of the backbone on device, None for fp32.
+    fp16 autocast is only used on accelerators, the CPU falls back to bf16.
+    '''
+    if amp is None:
+        return None
+    if amp == 'bf16':
+        return torch.bfloat16
+    if amp == 'fp16':
+        if torch.device(device).type == 'cpu':
+            print('>> fp16 autocast is not supported on the CPU, using bf16')
+            return torch.bfloat16
+        return torch.float16
+    raise Exception('Unknown mixed precision mode {}'.format(amp))
+
+
 
 class MyFunctionNegativeTripletSelector():
     """
     Given positive pairs, sample topM hardest negatives and return double margin contrastive loss. 
     """
-    def __init__(self, margin_pos, margin_neg, margin):
+    def __init__(self, margin_pos, margin_neg, margin, mining_memory_mb=None, mining=None, recall_interval=0, window_margin=1, memory_bank_size=0):
+        '''
+        mining_memory_mb: if given, mine the negatives over tiles of target pixels whose
+            B x N x tile intermediates fit into this budget instead of over all pixels at once
+        mining: an approximate search backend from negative_mining, None for the exact search
+        recall_interval: with an approximate backend, measure its recall of the exact topM every
+            recall_interval training calls per level, the values are kept in self.metrics
+        window_margin: for coarse-to-fine mining, the number of pixels added around the area of a coarse negative
+        memory_bank_size: if > 0, keep this many img2 descriptors of recent training iterations per level
+            (MemoryBank) and mine negatives among them too
+        '''
         super(MyFunctionNegativeTripletSelector, self).__init__()
         self.margin = margin
         self.margin_pos = margin_pos
         self.margin_neg = margin_neg
+        self.mining_memory_mb = mining_memory_mb
+        self.mining = mining
+        self.recall_interval = recall_interval
+        self.window_margin = window_margin
+        self.memory_bank_size = memory_bank_size
+        self.memory_banks = {}
+        # the topM negatives (BxNxM pixels, H, W) of the last call, the seeds of coarse-to-fine mining
+        self.candidates = None
+        self.metrics = {}
+        self._calls = {}
+        self._disc_offsets = {}
+
+    def excluded_pixels(self, a2, dist_threshold, H, W):
+        '''
+        Pixels of img2 closer than dist_threshold*H to the positive matches, without an N x (H*W) distance matrix.
+        Only the pixels of a disc of integer offsets around floor(a2) are tested, the offsets are cached per (H, W).
+        a2: positive matches in img2, BxNx2
+        return: the (b, n, pixel) indices of the excluded pixels, pixel = y*W + x
+        '''
+        radius = dist_threshold * H
+        key = (H, W, dist_threshold, str(a2.device))
+        if key not in self._disc_offsets:
+            # a pixel within radius of a2 is within radius + sqrt(2) of floor(a2)
+            reach = int(np.ceil(radius)) + 1
+            d = torch.arange(-reach, reach + 1, device=a2.device)
+            offsets = torch.stack(torch.meshgrid(d, d, indexing='xy'), dim=-1).reshape(-1, 2)
+            self._disc_offsets[key] = offsets[(offsets**2).sum(-1) < (radius + np.sqrt(2))**2]
+        offsets = self._disc_offsets[key]
+        pixels = torch.floor(a2).long()[:, :, None, :] + offsets  # BxNxKx2
+        diff = pixels.to(a2) - a2[:, :, None, :]
+        inside = (pixels[..., 0] >= 0) & (pixels[..., 0] < W) & (pixels[..., 1] >= 0) & (pixels[..., 1] < H) & \
+            ((diff**2).sum(-1) < radius**2)
+        B, N, K = inside.shape
+        b_idx = torch.arange(B, device=a2.device)[:, None, None].expand(B, N, K)[inside]
+        n_idx = torch.arange(N, device=a2.device)[None, :, None].expand(B, N, K)[inside]
+        return b_idx, n_idx, (pixels[..., 1] * W + pixels[..., 0])[inside]
 
-    def get_triplets(self, embedding1, embedding2, match_pos, scale, topM, dist_threshold, train_or_val, level):
+    def exact_negatives(self, e1_sliced, e2, excluded, topM, H, W):
+        '''
+        The exhaustive search of get_triplets, keeping a running top-M per anchor over tiles of img2
+        that fit into mining_memory_mb (a single tile without a budget).
+        e1_sliced: anchor features, BxNxC
+        e2: features of img2, Bx(H*W)xC
+        excluded: the (b, n, pixel) indices of the excluded pixels
+        return: the BxNxM distances and pixels of the topM negatives
+        '''
+        B, N, C = e1_sliced.shape
+        if topM > H * W:
+            raise Exception('topM {} is larger than the {} pixels of the feature map'.format(topM, H * W))
+        # bytes per anchor and pixel: feature distances, the merged running top-M (distance, index)
+        tile = H * W if self.mining_memory_mb is None else max(1, int(self.mining_memory_mb * 1024 ** 2 // (B * N * 24)))
+        b_excl, n_excl, pixel_excl = excluded
+        best_dist = best_idx = None
+        for start in range(0, H * W, tile):
+            idx_1d = torch.arange(start, min(start + tile, H * W), device=e2.device)
+            dist = batch_pairwise_squared_distances(e1_sliced, e2[:, start:start + len(idx_1d)])
+            in_tile = (pixel_excl >= start) & (pixel_excl < start + len(idx_1d))
+            dist[b_excl[in_tile], n_excl[in_tile], pixel_excl[in_tile] - start] = 1e4
+            idx = idx_1d.expand(B, N, -1)
+            if best_dist is not None:
+                dist = torch.cat((best_dist, dist), dim=-1)
+                idx = torch.cat((best_idx, idx), dim=-1)
+            best_dist, k = dist.topk(min(topM, dist.shape[-1]), dim=-1, largest=False)
+            best_idx = idx.gather(-1, k)
+        return best_dist, best_idx
+
+    def approximate_negatives(self, e1_sliced, e2, excluded_keys, topM, H, W, seeds=None):
+        '''
+        The topM negatives of the approximate backend self.mining, one index per feature map of img2,
+        or with seeds=(BxNxM pixels, H, W) of a coarser level only among the pixels in windows around them
+        (among the seeds themselves for a level of the same size).
+        excluded_keys: (b*N + n)*H*W + pixel keys of the excluded pixels
+        return: the BxNxM distances (inf padded), pixels (-1 padded) and the number of scanned pixels
+        '''
+        B, N, C = e1_sliced.shape
+        b_keys = excluded_keys // (N * H * W)
+        best_dist, best_idx = [], []
+        scanned = 0
+        for b in range(B):
+            excluded_b = excluded_keys[b_keys == b] - b * N * H * W
+            if seeds is None:
+                idx, dist, num_scanned = self.mining.search(e1_sliced[b], e2[b], topM, excluded_b,
+                                                            chunk_mb=self.mining_memory_mb or 256)
+            else:
+                if tuple(seeds[1:]) == (H, W):
+                    # a level of the same scale, only rescore the negatives of the previous level
+                    candidates = seeds[0][b]
+                else:
+                    candidates = window_candidates(seeds[0][b], seeds[1:], (H, W), self.window_margin)
+                idx, dist, num_scanned = candidate_search(e1_sliced[b], e2[b], candidates, topM, excluded_b,
+                                                          chunk_mb=self.mining_memory_mb or 256)
+            best_dist.append(dist)
+            best_idx.append(idx)
+            scanned += num_scanned
+        return torch.stack(best_dist), torch.stack(best_idx), scanned
+
+    def mine(self, e1_sliced, e2, a2, topM, dist_threshold, H, W, level, train_or_val, seeds=None):
+        '''
+        Mine the topM negatives without gradient (exact in tiles, approximate or in coarse-to-fine windows),
+        add the memory bank of the level, and sample one negative per anchor among them.
+        Anchors which saw fewer than topM candidates sample among the ones they saw.
+        return: the squared feature distance (BxN) of the sampled negatives, with gradient
+        '''
+        B, N, C = e1_sliced.shape
+        if seeds is not None and tuple(seeds[1:]) != (H, W) and \
+                seeds[0].shape[-1] * np.prod(window_side(seeds[1:], (H, W), self.window_margin)) >= MAX_WINDOW_FRACTION * H * W:
+            # the windows cover too much of the map to be cheaper than searching all of it
+            seeds = None
+        approximate = self.mining is not None or seeds is not None
+        with torch.no_grad():
+            excluded = self.excluded_pixels(a2.to(e2.device), dist_threshold, H, W)
+            excluded_keys = (excluded[0] * N + excluded[1]) * (H * W) + excluded[2]
+            if approximate:
+                best_dist, best_idx, scanned = self.approximate_negatives(e1_sliced, e2, excluded_keys, topM, H, W, seeds)
+            else:
+                best_dist, best_idx = self.exact_negatives(e1_sliced, e2, excluded, topM, H, W)
+            self.candidates = (best_idx, H, W)
+
+            self._calls[level] = self._calls.get(level, 0) + 1
+            if approximate and train_or_val and self.recall_interval and (self._calls[level] - 1) % self.recall_interval == 0:
+                exact_idx = self.exact_negatives(e1_sliced, e2, excluded, topM, H, W)[1]
+                rows = torch.arange(B * N, device=e2.device)[:, None] * (H * W)
+                found = torch.isin(rows + best_idx.reshape(B * N, -1), rows + exact_idx.reshape(B * N, -1))
+                self.metrics['recall_level{}'.format(level)] = found.sum().item() / (B * N * topM)
+                self.metrics['scanned_level{}'.format(level)] = scanned / (B * N * H * W)
+
+            bank = self.memory_banks.get(level) if self.memory_bank_size else None
+            from_bank = None
+            if bank is not None and len(bank):
+                # the bank entries compete with the image negatives for the topM
+                bank_features = bank.get()
+                bank_dist = batch_pairwise_squared_distances(e1_sliced, bank_features.expand(B, -1, -1))
+                best_dist, k = torch.cat((best_dist, bank_dist), dim=-1).topk(topM, dim=-1, largest=False)
+                from_bank = k >= best_idx.shape[-1]
+                best_idx = torch.where(from_bank, k - best_idx.shape[-1],
+                                       best_idx.gather(-1, k.clamp(max=best_idx.shape[-1] - 1)))
+            num_candidates = torch.isfinite(best_dist).sum(-1).reshape(B * N)
+
+        # randomly sample among topM hardest negative matches
+        sampled_neg_idx = torch.randint(0, topM, (B * N,), device=e2.device) % torch.clamp(num_candidates, min=1)
+        neg_idx = best_idx.reshape(B * N, -1)[torch.arange(B * N), sampled_neg_idx]
+        # anchors without any candidate take a random pixel, drawn only when needed so the
+        # exact search keeps the RNG stream of the dense search
+        if (neg_idx < 0).any():
+            neg_idx = torch.where(neg_idx < 0, torch.randint(0, H * W, (B * N,), device=e2.device), neg_idx)
+        neg_from_bank = None
+        if from_bank is not None:
+            neg_from_bank = from_bank.reshape(B * N, -1)[torch.arange(B * N), sampled_neg_idx]
+            bank_idx = torch.where(neg_from_bank, neg_idx, torch.zeros_like(neg_idx))
+            neg_idx = torch.where(neg_from_bank, torch.zeros_like(neg_idx), neg_idx)
+        neg_excluded = torch.isin(torch.arange(B * N, device=e2.device) * (H * W) + neg_idx, excluded_keys)
+        if neg_from_bank is not None:
+            neg_excluded = neg_excluded & ~neg_from_bank
+        dist = self.negative_distances(e1_sliced, e2, neg_idx.reshape(B, N), neg_excluded)
+        if neg_from_bank is not None:
+            x = e1_sliced.reshape(B * N, C).to(torch.float32)
+            y = bank_features[bank_idx]
+            bank_dist = torch.clamp((x**2).sum(-1) + (y**2).sum(-1) - 2.0 * (x * y).sum(-1), 1e-16, np.inf)
+            dist = torch.where(neg_from_bank, bank_dist, dist)
+        return dist
+
+    def negative_distances(self, e1_sliced, e2, neg_idx, neg_excluded):
+        '''
+        Recompute the squared feature distances to the sampled negatives only, with gradient.
+        neg_idx: the sampled pixels of img2, BxN
+        neg_excluded: (BxN) negatives inside the exclusion radius, their distance is 1e4
+        '''
+        B, N, C = e1_sliced.shape
+        x = e1_sliced.to(torch.float32)
+        y = e2.gather(1, neg_idx[..., None].expand(B, N, C)).to(torch.float32)
+        dist = (x**2).sum(-1) + (y**2).sum(-1) - 2.0 * (x * y).sum(-1)
+        dist = torch.clamp(torch.where(dist != dist, torch.full_like(dist, 1e-16), dist), 1e-16, np.inf)
+        return torch.where(neg_excluded, torch.full_like(dist.reshape(B * N), 1e4), dist.reshape(B * N))
+
+    def get_triplets(self, embedding1, embedding2, match_pos, scale, topM, dist_threshold, train_or_val, level, mask=None, seeds=None):
         """
         embedding1: feature map of image 1, BxCxHxW
         embedding2: feature map of image 2, BxCxHxW
         match_pos: known positive matches, {'a':BxNx2,'b':BxNx2}
         topM: sort the negatives for each sample by loss in decreasing order and sample randomly over the top M
         dist_threshold: (dist_threshold*H)^2 is the minimal sqaured distance between anchor and neg
+        mask: optional BxN validity of the matches, padded matches do not contribute
+        seeds: optional self.candidates of a coarser level for the same matches, only windows around them are mined
         """
 
         a1 = match_pos['a'] / scale  # positive matches in img1
@@ -223,24 +518,22 @@ class MyFunctionNegativeTripletSelector():
         # e2 = F.normalize(e2, p = 2, dim=-1)
         # e2_sliced_ = F.normalize(e2_sliced_, p=2, dim=-1)
         # e1_sliced_ = F.normalize(e1_sliced_, p=2, dim=-1)
-        f_dist_a1_img2 = batch_pairwise_squared_distances(e1_sliced,e2) # dim: B x #a1 x #pixels in img2
-
-        # get all pixel positions of img2
-        idx_1d = torch.arange(H * W)
-        idx_x = idx_1d % W
-        idx_y = idx_1d // W
-        idx_xy = torch.stack((idx_x, idx_y), dim=1)
-        idx_batched_xy = idx_xy.repeat(B, 1, 1)
-        # apply distance constrain. distance smaller than threshold will cause very large loss and won't be sampled 
-        p_dist_12 = batch_pairwise_squared_distances(a2, idx_batched_xy)
-        mask_12 = p_dist_12 < (dist_threshold*H)**2
-        f_dist_a1_img2[mask_12] = 1e4
-        # for each keypoint in img1, compute topM hardest negative matches in img2.
-        dist_nn12, idx_in_2 = f_dist_a1_img2.topk(topM, dim=-1, largest=False)
-        dist_nn12 = dist_nn12.reshape(B * N, -1)
-        idx_in_2 = idx_in_2.reshape(B * N, -1)
-        # randomly sample among topM hardest negative matches 
-        D_feat_neg = torch.clamp(torch.sqrt(dist_nn12[torch.arange(B * N),sampled_neg_idx]), min=1e-16) # avoid invalid operation when taking derivative w.r.t sqrt.
+        if self.mining is not None or seeds is not None or self.mining_memory_mb is not None or self.memory_bank_size:
+            dist_neg = self.mine(e1_sliced, e2, a2, topM, dist_threshold, H, W, level, train_or_val, seeds)
+            D_feat_neg = torch.clamp(torch.sqrt(dist_neg), min=1e-16)
+        else:
+            f_dist_a1_img2 = batch_pairwise_squared_distances(e1_sliced,e2) # dim: B x #a1 x #pixels in img2
+
+            # apply distance constrain. distance smaller than threshold will cause very large loss and won't be sampled 
+            f_dist_a1_img2[self.excluded_pixels(a2.to(f_dist_a1_img2.device), dist_threshold, H, W)] = 1e4
+            # for each keypoint in img1, compute topM hardest negative matches in img2.
+            dist_nn12, idx_in_2 = f_dist_a1_img2.topk(topM, dim=-1, largest=False)
+            dist_nn12 = dist_nn12.reshape(B * N, -1)
+            idx_in_2 = idx_in_2.reshape(B * N, -1)
+            self.candidates = (idx_in_2.reshape(B, N, -1), H, W)
+            # randomly sample among topM hardest negative matches 
+            sampled_neg_idx = torch.randint(0, topM, (B * N,), device=dist_nn12.device)
+            D_feat_neg = torch.clamp(torch.sqrt(dist_nn12[torch.arange(B * N),sampled_neg_idx]), min=1e-16) # avoid invalid operation when taking derivative w.r.t sqrt.
         # compute negative loss
         loss_neg = torch.clamp(self.margin_neg - D_feat_neg, min=0.0)
         loss_neg = loss_neg**2
@@ -250,7 +543,19 @@ class MyFunctionNegativeTripletSelector():
         loss_pos = loss_pos**2
 
         mdist = loss_neg + loss_pos
+
+        # after mining, so that the positives of the current anchors do not become their negatives
+        if self.memory_bank_size and train_or_val:
+            bank_features = e2_sliced_ if mask is None else e2_sliced_[mask.reshape(B * N)]
+            self.memory_banks.setdefault(level, MemoryBank(self.memory_bank_size)).enqueue(bank_features)
         # compute mean loss
-        loss_pos_mean = torch.mean(loss_pos, dim=-1)
-        loss_neg_mean = torch.mean(loss_neg, dim=-1)
+        if mask is None:
+            loss_pos_mean = torch.mean(loss_pos, dim=-1)
+            loss_neg_mean = torch.mean(loss_neg, dim=-1)
+        else:
+            valid = mask.reshape(B * N).to(mdist)
+            num_valid = torch.clamp(valid.sum(), min=1)
+            mdist = mdist * valid
+            loss_pos_mean = torch.sum(loss_pos * valid, dim=-1) / num_valid
+            loss_neg_mean = torch.sum(loss_neg * valid, dim=-1) / num_valid
         return torch.sum(mdist), loss_pos_mean, loss_neg_mean
\ No newline at end of file